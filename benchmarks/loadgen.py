@@ -0,0 +1,396 @@
+"""Нагрузочный тест WebSocket конвейера /ws.
+
+Открывает много соединений, проигрывает записанные реплики (WebM/WAV) бинарными
+фреймами и замеряет задержки этапов со стороны клиента. В конце печатает
+соединения/с, реплики/с, перцентили задержек (клиентские и серверные по /metrics)
+и пиковую память сервера.
+
+Без сети и API ключей сервер запускается с заглушками внешних сервисов:
+
+    FAKE_BACKENDS=all uvicorn main:app --port 8000
+    python benchmarks/loadgen.py --connections 200 --concurrency 50 --turns 3 --audio rec1.webm rec2.wav
+
+или сразу с локальным сервером (FAKE_BACKENDS=all по умолчанию):
+
+    python benchmarks/loadgen.py --spawn --connections 100 --concurrency 20
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.audio_protocol import (  # noqa: E402
+    pack_frame, unpack_frame, MSG_COMPLETE_AUDIO, MSG_AUDIO_RESPONSE, MSG_AUDIO_RESPONSE_CHUNK,
+    CODEC_WAV, CODEC_WEBM, CODEC_UNKNOWN
+)
+from utils.pcm_buffer import wav_header  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Этапы, которые видит клиент (от отправки реплики)
+CLIENT_STAGES = ("connect", "transcription", "llm_first_token", "first_audio", "turn")
+PERCENTILES = (50, 90, 95, 99)
+
+CODECS_BY_EXTENSION = {
+    ".wav": CODEC_WAV,
+    ".webm": CODEC_WEBM,
+}
+
+# voice_stage_seconds_bucket{stage="stt",le="0.5"} 12
+BUCKET_LINE = re.compile(r'^voice_stage_seconds_bucket\{stage="([^"]+)",le="([^"]+)"\} (\S+)$')
+PEAK_RSS_LINE = re.compile(r'^process_peak_resident_memory_bytes (\S+)$')
+
+class TurnResult:
+    """Результат одной реплики: исход и отметки времени этапов"""
+
+    __slots__ = ("outcome", "timings", "queued")
+
+    def __init__(self):
+        self.outcome = "timeout"
+        self.timings: Dict[str, float] = {}
+        self.queued = False
+
+class Stats:
+    """Сводка прогона"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {stage: [] for stage in CLIENT_STAGES}
+        self.outcomes: Dict[str, int] = {}
+        self.connections = 0
+        self.connection_errors = 0
+        self.rejected_connections = 0
+        self.queued_turns = 0
+
+    def add_turn(self, result: TurnResult):
+        self.outcomes[result.outcome] = self.outcomes.get(result.outcome, 0) + 1
+        if result.queued:
+            self.queued_turns += 1
+        if result.outcome == "ok":
+            for stage, value in result.timings.items():
+                self.latencies[stage].append(value)
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль методом ближайшего ранга (values отсортированы)"""
+    if not values:
+        return float("nan")
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+def synthetic_utterance(seconds: float = 1.5, sample_rate: int = 16000) -> bytes:
+    """WAV с тоном, похожим на речь по громкости, если записи не переданы"""
+    count = int(seconds * sample_rate)
+    samples = (
+        int(8000 * math.sin(2 * math.pi * 220 * i / sample_rate) * (0.5 + 0.5 * math.sin(2 * math.pi * 3 * i / sample_rate)))
+        for i in range(count)
+    )
+    pcm = struct.pack(f"<{count}h", *samples)
+    return wav_header(len(pcm), sample_rate) + pcm
+
+def load_utterances(paths: List[str]) -> List[Tuple[int, bytes]]:
+    """Читает записи и определяет их кодек по расширению"""
+    if not paths:
+        return [(CODEC_WAV, synthetic_utterance())]
+
+    utterances = []
+    for path in paths:
+        with open(path, "rb") as f:
+            codec = CODECS_BY_EXTENSION.get(os.path.splitext(path)[1].lower(), CODEC_UNKNOWN)
+            utterances.append((codec, f.read()))
+    return utterances
+
+async def run_turn(ws, codec: int, audio: bytes, timeout: float) -> TurnResult:
+    """Отправляет реплику и читает ответ до audio_response_end, ошибки или отказа"""
+    result = TurnResult()
+    started = time.perf_counter()
+    await ws.send(pack_frame(MSG_COMPLETE_AUDIO, codec, audio))
+
+    def mark(stage: str):
+        result.timings.setdefault(stage, time.perf_counter() - started)
+
+    deadline = started + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return result
+        try:
+            message = await asyncio.wait_for(ws.recv(), remaining)
+        except asyncio.TimeoutError:
+            return result
+
+        if isinstance(message, bytes):
+            msg_type = unpack_frame(message)[0]
+            # Озвучка ошибки (MSG_AUDIO_RESPONSE) до распознавания - не ответ на реплику
+            if msg_type == MSG_AUDIO_RESPONSE_CHUNK or (msg_type == MSG_AUDIO_RESPONSE and "transcription" in result.timings):
+                mark("first_audio")
+            continue
+
+        data = json.loads(message)
+        kind = data.get("type")
+        if kind == "ping":
+            # Heartbeat сервера: без ответа долгая реплика под нагрузкой сочтется обрывом
+            await ws.send(json.dumps({"type": "pong"}))
+        elif kind == "transcription":
+            mark("transcription")
+        elif kind == "ai_response_delta":
+            mark("llm_first_token")
+        elif kind == "audio_response_end":
+            mark("turn")
+            result.outcome = "ok"
+            return result
+        elif kind == "busy":
+            if data.get("reason") == "queued":
+                result.queued = True
+                continue
+            result.outcome = "rejected"
+            return result
+        elif kind == "error":
+            result.outcome = "error"
+            return result
+
+async def run_connection(url: str, utterances: List[Tuple[int, bytes]], index: int,
+                         args: argparse.Namespace, stats: Stats):
+    """Одно соединение: приветствие и несколько реплик подряд"""
+    started = time.perf_counter()
+    try:
+        ws = await asyncio.wait_for(websockets.connect(url, max_size=None), args.timeout)
+    except Exception:
+        stats.connection_errors += 1
+        return
+
+    try:
+        stats.connections += 1
+        stats.latencies["connect"].append(time.perf_counter() - started)
+        await ws.send(json.dumps({
+            "type": "client_hello",
+            "binary_audio": True,
+            "stream_audio": True,
+            "stream_text": True,
+            "audio_formats": args.formats
+        }))
+
+        for turn in range(args.turns):
+            codec, audio = utterances[(index + turn) % len(utterances)]
+            result = await run_turn(ws, codec, audio, args.timeout)
+            stats.add_turn(result)
+            if args.think > 0:
+                await asyncio.sleep(args.think)
+    except websockets.ConnectionClosed as e:
+        if e.code == 1013:
+            # Сервер отказал по лимиту соединений
+            stats.rejected_connections += 1
+        else:
+            stats.connection_errors += 1
+    except Exception:
+        stats.connection_errors += 1
+    finally:
+        await ws.close()
+
+def scrape_metrics(http_url: str) -> Tuple[Dict[str, List[Tuple[float, float]]], Optional[float]]:
+    """Читает /metrics: корзины voice_stage_seconds по этапам и пиковую память сервера"""
+    try:
+        with urllib.request.urlopen(f"{http_url}/metrics", timeout=5) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return {}, None
+
+    buckets: Dict[str, List[Tuple[float, float]]] = {}
+    peak_rss = None
+    for line in text.splitlines():
+        match = BUCKET_LINE.match(line)
+        if match:
+            stage, le, count = match.groups()
+            bound = float("inf") if le == "+Inf" else float(le)
+            buckets.setdefault(stage, []).append((bound, float(count)))
+            continue
+        match = PEAK_RSS_LINE.match(line)
+        if match:
+            peak_rss = float(match.group(1))
+    return buckets, peak_rss
+
+def histogram_quantile(q: float, buckets: List[Tuple[float, float]]) -> float:
+    """Оценка квантиля по кумулятивным корзинам, как histogram_quantile в Prometheus"""
+    total = buckets[-1][1] if buckets else 0
+    if total <= 0:
+        return float("nan")
+
+    rank = q * total
+    lower, previous = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower
+            if count == previous:
+                return bound
+            return lower + (bound - lower) * (rank - previous) / (count - previous)
+        lower, previous = bound, count
+    return lower
+
+def diff_buckets(after: Dict[str, List[Tuple[float, float]]],
+                 before: Dict[str, List[Tuple[float, float]]]) -> Dict[str, List[Tuple[float, float]]]:
+    """Корзины, накопленные за время прогона"""
+    result = {}
+    for stage, series in after.items():
+        previous = dict(before.get(stage, []))
+        result[stage] = [(bound, count - previous.get(bound, 0.0)) for bound, count in series]
+    return result
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def spawn_server(port: int, fake_backends: str) -> subprocess.Popen:
+    """Запускает сервер из корня репозитория с заглушками внешних сервисов"""
+    env = dict(os.environ)
+    env.setdefault("FAKE_BACKENDS", fake_backends)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--ws-max-size", str(64 * 1024 * 1024)],
+        cwd=ROOT, env=env
+    )
+
+def wait_for_server(http_url: str, process: Optional[subprocess.Popen], timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"{http_url}/metrics", timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Сервер не ответил вовремя")
+
+def build_report(stats: Stats, elapsed: float, server_buckets: Dict[str, List[Tuple[float, float]]],
+                 peak_rss: Optional[float]) -> dict:
+    turns_ok = stats.outcomes.get("ok", 0)
+    report = {
+        "elapsed_seconds": round(elapsed, 3),
+        "connections": stats.connections,
+        "connection_errors": stats.connection_errors,
+        "rejected_connections": stats.rejected_connections,
+        "connections_per_second": round(stats.connections / elapsed, 2) if elapsed else 0.0,
+        "turns": dict(stats.outcomes),
+        "queued_turns": stats.queued_turns,
+        "turns_per_second": round(turns_ok / elapsed, 2) if elapsed else 0.0,
+        "client_latency_ms": {},
+        "server_latency_ms": {},
+        "server_peak_rss_bytes": peak_rss,
+        "loadgen_peak_rss_bytes": None,
+    }
+
+    for stage, values in stats.latencies.items():
+        values.sort()
+        report["client_latency_ms"][stage] = {
+            f"p{p}": round(percentile(values, p) * 1000, 1) if values else None for p in PERCENTILES
+        }
+        report["client_latency_ms"][stage]["max"] = round(values[-1] * 1000, 1) if values else None
+
+    for stage, buckets in sorted(server_buckets.items()):
+        if not buckets or buckets[-1][1] <= 0:
+            continue
+        report["server_latency_ms"][stage] = {
+            f"p{p}": round(histogram_quantile(p / 100, buckets) * 1000, 1) for p in PERCENTILES
+        }
+        report["server_latency_ms"][stage]["count"] = int(buckets[-1][1])
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["loadgen_peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    return report
+
+def print_report(report: dict):
+    print(f"\nДлительность: {report['elapsed_seconds']} с")
+    print(f"Соединения: {report['connections']} ({report['connections_per_second']}/с), "
+          f"ошибок {report['connection_errors']}, отказов по лимиту {report['rejected_connections']}")
+    print(f"Реплики: {report['turns']} ({report['turns_per_second']}/с успешных), "
+          f"ждали в очереди {report['queued_turns']}")
+
+    header = "".join(f"{'p' + str(p):>8}" for p in PERCENTILES)
+    for title, key in (("Клиент, мс", "client_latency_ms"), ("Сервер (/metrics), мс", "server_latency_ms")):
+        if not report[key]:
+            continue
+        print(f"\n{title:<24}{header}")
+        for stage, values in report[key].items():
+            cells = "".join(f"{'-' if values[f'p{p}'] is None else values[f'p{p}']:>8}" for p in PERCENTILES)
+            print(f"{stage:<24}{cells}")
+
+    for title, key in (("сервер", "server_peak_rss_bytes"), ("нагрузчик", "loadgen_peak_rss_bytes")):
+        if report[key] is not None:
+            print(f"Пиковая память ({title}): {report[key] / 1024 / 1024:.1f} МБ")
+
+async def run(args: argparse.Namespace) -> dict:
+    utterances = load_utterances(args.audio)
+    http_url = re.sub(r"^ws", "http", args.url).rsplit("/ws", 1)[0]
+    before, _ = scrape_metrics(http_url)
+
+    stats = Stats()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def worker(index: int):
+        async with semaphore:
+            await run_connection(args.url, utterances, index, args, stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.connections)))
+    elapsed = time.perf_counter() - started
+
+    after, peak_rss = scrape_metrics(http_url)
+    return build_report(stats, elapsed, diff_buckets(after, before), peak_rss)
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест голосового WebSocket конвейера")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws", help="адрес WebSocket endpoint")
+    parser.add_argument("--connections", type=int, default=50, help="всего соединений")
+    parser.add_argument("--concurrency", type=int, default=10, help="соединений одновременно")
+    parser.add_argument("--turns", type=int, default=3, help="реплик на соединение")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза между репликами, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="таймаут реплики, с")
+    parser.add_argument("--audio", nargs="*", default=[], help="записи реплик (.webm, .wav)")
+    parser.add_argument("--formats", nargs="+", default=["wav"], help="форматы ответа для client_hello")
+    parser.add_argument("--spawn", action="store_true", help="запустить локальный сервер на свободном порту")
+    parser.add_argument("--fake-backends", default="all", help="FAKE_BACKENDS для --spawn")
+    parser.add_argument("--json", dest="json_path", help="сохранить отчет в JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    process = None
+    if args.spawn:
+        port = free_port()
+        args.url = f"ws://127.0.0.1:{port}/ws"
+        process = spawn_server(port, args.fake_backends)
+
+    try:
+        wait_for_server(re.sub(r"^ws", "http", args.url).rsplit("/ws", 1)[0], process)
+        report = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
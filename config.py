@@ -17,6 +17,80 @@ class Config:
     FRAME_DURATION: int = int(os.getenv("FRAME_DURATION", "30"))
     MAX_SILENCE_FRAMES: int = int(os.getenv("MAX_SILENCE_FRAMES", "30"))
     
+    # Серверное определение конца речи (VAD) для потоковой загрузки
+    AUTO_ENDPOINT: bool = os.getenv("AUTO_ENDPOINT", "True").lower() == "true"
+    ENDPOINT_PADDING_MS: int = int(os.getenv("ENDPOINT_PADDING_MS", "200"))  # тишина, оставляемая вокруг речи
+    MAX_UTTERANCE_SECONDS: float = float(os.getenv("MAX_UTTERANCE_SECONDS", "60"))  # лимит буфера одной реплики
+    DECODE_WORKERS: int = int(os.getenv("DECODE_WORKERS", "2"))  # параллельных процессов ffmpeg
+    DECODE_TIMEOUT: float = float(os.getenv("DECODE_TIMEOUT", "30"))  # секунды
+    MAX_STREAM_DECODERS: int = int(os.getenv("MAX_STREAM_DECODERS", "32"))  # процессов ffmpeg для потоковых реплик
+    
+    # Допуск нагрузки: соединения, очередь реплик, размер аудио
+    MAX_CONNECTIONS: int = int(os.getenv("MAX_CONNECTIONS", "200"))  # WebSocket соединений на процесс
+    MAX_CONCURRENT_TURNS: int = int(os.getenv("MAX_CONCURRENT_TURNS", "8"))  # реплик обрабатывается одновременно
+    MAX_QUEUED_TURNS: int = int(os.getenv("MAX_QUEUED_TURNS", "32"))  # реплик ждет в очереди, остальным - busy
+    MAX_TURNS_PER_SESSION: int = int(os.getenv("MAX_TURNS_PER_SESSION", "1"))
+    MAX_AUDIO_BYTES: int = int(os.getenv("MAX_AUDIO_BYTES", str(5 * 1024 * 1024)))  # размер одной реплики
+    
+    # Очередь исходящих сообщений каждого соединения
+    OUTBOUND_QUEUE_MESSAGES: int = int(os.getenv("OUTBOUND_QUEUE_MESSAGES", "256"))
+    OUTBOUND_QUEUE_BYTES: int = int(os.getenv("OUTBOUND_QUEUE_BYTES", str(4 * 1024 * 1024)))
+    SEND_TIMEOUT: float = float(os.getenv("SEND_TIMEOUT", "10"))  # секунды ожидания места в очереди
+    OUTBOUND_OVERFLOW_POLICY: str = os.getenv("OUTBOUND_OVERFLOW_POLICY", "close")  # close | drop
+    
+    # Heartbeat и закрытие простаивающих соединений (0 - выключено)
+    HEARTBEAT_INTERVAL: float = float(os.getenv("HEARTBEAT_INTERVAL", "20"))  # ping после стольких секунд тишины
+    HEARTBEAT_TIMEOUT: float = float(os.getenv("HEARTBEAT_TIMEOUT", "20"))  # ожидание pong
+    IDLE_TIMEOUT: float = float(os.getenv("IDLE_TIMEOUT", "600"))  # секунды без действий пользователя
+    
+    # Сессии
+    MAX_SESSIONS: int = int(os.getenv("MAX_SESSIONS", "1000"))
+    SESSION_TTL: int = int(os.getenv("SESSION_TTL", "1800"))  # секунды простоя до удаления
+    # Где хранится разговор между переподключениями: memory (один процесс) или sqlite (общий для воркеров)
+    SESSION_BACKEND: str = os.getenv("SESSION_BACKEND", "memory")
+    SESSION_DB_PATH: str = os.getenv("SESSION_DB_PATH", "sessions.db")
+    WORKERS: int = int(os.getenv("WEB_CONCURRENCY", "1"))  # процессов uvicorn (как --workers)
+    
+    # Вызовы Gemini
+    LLM_ASYNC_CLIENT: bool = os.getenv("LLM_ASYNC_CLIENT", "True").lower() == "true"  # нативный async клиент SDK
+    LLM_WORKERS: int = int(os.getenv("LLM_WORKERS", "4"))  # потоков, если async клиент выключен
+    LLM_TIMEOUT: float = float(os.getenv("LLM_TIMEOUT", "30"))  # секунды до ответа (и между фрагментами потока)
+    LLM_WARM_UP: bool = os.getenv("LLM_WARM_UP", "True").lower() == "true"  # открыть соединение с API при старте
+    
+    # Контекст разговора для Gemini
+    LLM_CONTEXT_TOKENS: int = int(os.getenv("LLM_CONTEXT_TOKENS", "1500"))  # бюджет истории в промпте
+    LLM_SUMMARY_TOKENS: int = int(os.getenv("LLM_SUMMARY_TOKENS", "300"))  # из них на краткое содержание
+    LLM_SUMMARIZE: bool = os.getenv("LLM_SUMMARIZE", "True").lower() == "true"  # сворачивать старую историю
+    
+    # Кэш ответов Gemini (по умолчанию выключен)
+    LLM_CACHE_ENABLED: bool = os.getenv("LLM_CACHE_ENABLED", "False").lower() == "true"
+    LLM_CACHE_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+    LLM_CACHE_TTL: int = int(os.getenv("LLM_CACHE_TTL", "3600"))  # секунды
+    LLM_CACHE_HISTORY_WINDOW: int = int(os.getenv("LLM_CACHE_HISTORY_WINDOW", "2"))  # сообщений истории в ключе
+    
+    # Распознавание речи
+    STT_WORKERS: int = int(os.getenv("STT_WORKERS", "4"))  # потоков для распознавания
+    STT_CALIBRATION: str = os.getenv("STT_CALIBRATION", "session")  # session | turn | off
+    STT_TIMEOUT: float = float(os.getenv("STT_TIMEOUT", "30"))  # секунды
+    
+    # Синтез речи
+    TTS_PARALLELISM: int = int(os.getenv("TTS_PARALLELISM", "3"))  # предложений синтезируется одновременно
+    TTS_WORKERS: int = int(os.getenv("TTS_WORKERS", "8"))  # потоков синтеза на весь сервер
+    TTS_TIMEOUT: float = float(os.getenv("TTS_TIMEOUT", "20"))  # секунды на одно предложение
+    TTS_VOICE: str = os.getenv("TTS_VOICE", "com")  # домен Google Translate для gTTS (tld)
+    TTS_CACHE_MAX_BYTES: int = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    TTS_CACHE_DIR: str = os.getenv("TTS_CACHE_DIR", "")  # пусто - без кэша на диске
+    TTS_CACHE_DISK_MAX_BYTES: int = int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+    SPEAK_ERRORS: bool = os.getenv("SPEAK_ERRORS", "True").lower() == "true"  # озвучивать системные ошибки
+    
+    # Локальные заглушки внешних сервисов для бенчмарков: stt, tts, llm через запятую или all
+    FAKE_BACKENDS: str = os.getenv("FAKE_BACKENDS", "")
+    FAKE_STT_MS: float = float(os.getenv("FAKE_STT_MS", "300"))  # задержка распознавания
+    FAKE_TTS_MS: float = float(os.getenv("FAKE_TTS_MS", "150"))  # задержка синтеза предложения
+    FAKE_LLM_FIRST_TOKEN_MS: float = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "400"))
+    FAKE_LLM_CHUNK_MS: float = float(os.getenv("FAKE_LLM_CHUNK_MS", "50"))  # между фрагментами потока
+    FAKE_JITTER: float = float(os.getenv("FAKE_JITTER", "0.25"))  # разброс задержек, доля от среднего
+    
     # Логирование
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
     
@@ -30,7 +104,9 @@ class Config:
         """Проверяет конфигурацию на корректность"""
         errors = []
         
-        if not cls.GEMINI_API_KEY:
+        fake_backends = [name.strip().lower() for name in cls.FAKE_BACKENDS.split(",") if name.strip()]
+        
+        if not cls.GEMINI_API_KEY and not {"llm", "all"} & set(fake_backends):
             errors.append("GEMINI_API_KEY не установлен")
         
         if cls.PORT < 1 or cls.PORT > 65535:
@@ -39,6 +115,34 @@ class Config:
         if cls.SAMPLE_RATE not in [8000, 16000, 44100, 48000]:
             errors.append("SAMPLE_RATE должен быть 8000, 16000, 44100 или 48000")
         
+        if cls.FRAME_DURATION not in [10, 20, 30]:
+            errors.append("FRAME_DURATION должен быть 10, 20 или 30 мс (ограничение WebRTC VAD)")
+        
+        if cls.LLM_SUMMARY_TOKENS >= cls.LLM_CONTEXT_TOKENS:
+            errors.append("LLM_SUMMARY_TOKENS должен быть меньше LLM_CONTEXT_TOKENS")
+        
+        unknown = set(fake_backends) - {"stt", "tts", "llm", "all"}
+        if unknown:
+            errors.append(f"FAKE_BACKENDS: неизвестные сервисы {', '.join(sorted(unknown))}")
+        
+        if not 0 <= cls.FAKE_JITTER <= 1:
+            errors.append("FAKE_JITTER должен быть от 0 до 1")
+        
+        if cls.OUTBOUND_OVERFLOW_POLICY not in ["close", "drop"]:
+            errors.append("OUTBOUND_OVERFLOW_POLICY должен быть close или drop")
+        
+        if cls.HEARTBEAT_INTERVAL > 0 and cls.HEARTBEAT_TIMEOUT <= 0:
+            errors.append("HEARTBEAT_TIMEOUT должен быть больше 0, если включен HEARTBEAT_INTERVAL")
+        
+        if cls.SESSION_BACKEND not in ["memory", "sqlite"]:
+            errors.append("SESSION_BACKEND должен быть memory или sqlite")
+        
+        if cls.WORKERS < 1:
+            errors.append("WEB_CONCURRENCY должен быть не меньше 1")
+        
+        if cls.STT_CALIBRATION not in ["session", "turn", "off"]:
+            errors.append("STT_CALIBRATION должен быть session, turn или off")
+        
         if errors:
             raise ValueError("Ошибки конфигурации:\n" + "\n".join(errors))
         
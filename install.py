@@ -57,7 +57,6 @@ def install_main_dependencies():
         "websockets==12.0",
         "google-generativeai==0.3.2",
         "speechrecognition==3.10.0",
-        "pydub==0.25.1",
         "gtts==2.4.0",
         "numpy==1.24.3",
         "python-multipart==0.0.6",
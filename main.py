@@ -1,122 +1,796 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+# Отсчет фаз запуска начинается до остальных импортов
+from utils.startup import startup_timer, preload
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 import asyncio
 import json
 import base64
 import logging
+import time
 from typing import Dict, List
+from contextlib import asynccontextmanager
 
 from services.gemini_service import GeminiService
-from services.speech_service import SpeechService
+from services.speech_service import SpeechService, PROVIDER_MODULES
+from services.stream_decoder import StreamingDecoder, StreamDecoderLimiter, DecoderUnavailableError
+from services.audio_decoder import AudioTooLongError
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.metrics import (
+    registry as metrics, peak_rss_bytes, STAGE_SECONDS, TURN_SECONDS, FIRST_AUDIO_SECONDS,
+    PAYLOAD_BYTES, AUDIO_BYTES, TURNS
+)
 from utils.connection_manager import ConnectionManager
+from utils.session_store import SessionStore, SessionState
+from utils.session_backend import create_session_backend, WORKER_ID
+from utils.sentences import SentenceSplitter
+from utils.static_assets import StaticAssets
+from utils.system_messages import (
+    SystemMessages, ERROR_NO_AUDIO, ERROR_NOT_RECOGNIZED, ERROR_PROCESSING,
+    ERROR_BAD_FRAME, ERROR_STREAM_UNAVAILABLE, ERROR_AUDIO_TOO_LONG, ERROR_SERVER_BUSY
+)
+from utils.audio_protocol import (
+    unpack_frame, pack_frame, ProtocolError, HEADER_SIZE,
+    MSG_COMPLETE_AUDIO, MSG_AUDIO_RESPONSE, MSG_AUDIO_CHUNK, MSG_AUDIO_RESPONSE_CHUNK,
+    CODEC_WAV, CODEC_WEBM, CODEC_PCM16, CODEC_NAMES, CODEC_MIME_TYPES, OUTPUT_FORMAT_CODECS
+)
+from config import config
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Voice-to-Voice AI Agent", version="1.0.0")
+startup_timer.mark("import")
 
-# Статические файлы
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Жизненный цикл приложения: фоновый прогрев клиентов при старте"""
+    startup_timer.mark("serve")
+    # Прогрев идет в фоне - сервер принимает соединения сразу
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    manager.shutdown()
+    
+    # Пулы этапов не должны держать процесс на выходе
+    for executor in stage_executors():
+        executor.shutdown()
+    session_store.backend.close()
+
+app = FastAPI(title="Voice-to-Voice AI Agent", version="1.0.0", lifespan=lifespan)
+
+# Статические файлы и главная страница - в памяти, сжатые заранее
+static_assets = StaticAssets(reload=config.DEBUG)
+static_assets.add_directory("static", "/static")
+static_assets.add_page("/", "templates/index.html")
+logger.info(f"Статика загружена: {len(static_assets)} файлов, {static_assets.total_bytes()} байт с вариантами")
+
+# Состояние разговоров хранится отдельно для каждой сессии; разговор сохраняется
+# в SESSION_BACKEND и продолжается после переподключения к любому воркеру
+session_store = SessionStore(
+    max_sessions=config.MAX_SESSIONS,
+    ttl=config.SESSION_TTL,
+    backend=create_session_backend(config.SESSION_BACKEND, config.SESSION_DB_PATH, config.SESSION_TTL)
+)
 
-# Сервисы (общие для всех соединений)
-gemini_service = GeminiService()
+# Сервисы (общие для всех соединений, без общего состояния разговора)
+gemini_service = GeminiService(session_store)
 speech_service = SpeechService()
-manager = ConnectionManager()
+# У каждого соединения своя ограниченная очередь исходящих сообщений
+manager = ConnectionManager(
+    max_messages=config.OUTBOUND_QUEUE_MESSAGES,
+    max_bytes=config.OUTBOUND_QUEUE_BYTES,
+    send_timeout=config.SEND_TIMEOUT,
+    overflow_policy=config.OUTBOUND_OVERFLOW_POLICY,
+    heartbeat_interval=config.HEARTBEAT_INTERVAL,
+    heartbeat_timeout=config.HEARTBEAT_TIMEOUT,
+    idle_timeout=config.IDLE_TIMEOUT
+)
+
+# Процессы ffmpeg потоковых реплик; сверх предела поток декодируется в пуле decode
+stream_decoders = StreamDecoderLimiter(config.MAX_STREAM_DECODERS)
+
+# Системные сообщения (ошибки) с заранее синтезированной озвучкой
+system_messages = SystemMessages()
+
+# Ограничение одновременно обрабатываемых реплик и очередь к ним
+admission = AdmissionController(
+    max_concurrent=config.MAX_CONCURRENT_TURNS,
+    max_queue=config.MAX_QUEUED_TURNS,
+    max_per_session=config.MAX_TURNS_PER_SESSION
+)
+
+def register_metrics():
+    """Метрики, которые считываются из состояния сервисов при запросе /metrics"""
+    metrics.gauge("process_peak_resident_memory_bytes", "Пиковый объем резидентной памяти процесса",
+                  peak_rss_bytes)
+    metrics.gauge("voice_active_connections", "Открытые WebSocket соединения",
+                  manager.get_active_connections_count)
+    metrics.gauge("voice_outbound_queued_messages", "Сообщения в очередях отправки соединений",
+                  manager.queued_messages)
+    metrics.gauge("voice_outbound_dropped_total", "Сообщения, выброшенные из-за переполнения очереди",
+                  lambda: manager.dropped, metric_type="counter")
+    metrics.gauge("voice_connections_reaped_total", "Соединения, закрытые сервером, по причине",
+                  lambda: {("slow",): manager.slow_closed,
+                           ("idle",): manager.idle_closed,
+                           ("heartbeat",): manager.heartbeat_closed}, ["reason"], "counter")
+    metrics.gauge("voice_sessions", "Сессии в хранилище", lambda: len(session_store))
+    metrics.gauge("voice_stream_decoders_active", "Процессы ffmpeg потоковых реплик",
+                  lambda: stream_decoders.active)
+    metrics.gauge("voice_stream_decoders_deferred_total", "Потоки, декодированные после конца записи из-за предела",
+                  lambda: stream_decoders.deferred, metric_type="counter")
+    metrics.gauge("voice_startup_phase_seconds", "Длительность фаз запуска процесса",
+                  lambda: {(name,): seconds for name, seconds in startup_timer.phases.items()}, ["phase"])
+    metrics.gauge("voice_executor_queued", "Задачи, ждущие свободного потока этапа",
+                  lambda: {(e.name,): e.queued for e in stage_executors()}, ["stage"])
+    metrics.gauge("voice_executor_active", "Задачи, выполняемые в пуле этапа",
+                  lambda: {(e.name,): e.active for e in stage_executors()}, ["stage"])
+    metrics.gauge("voice_executor_timeouts_total", "Таймауты этапа",
+                  lambda: {(e.name,): e.timeouts for e in stage_executors()}, ["stage"], "counter")
+    metrics.gauge("voice_turns_active", "Реплики в обработке", lambda: admission.active)
+    metrics.gauge("voice_turns_waiting", "Реплики в очереди", lambda: admission.waiting)
+    metrics.gauge("voice_turns_rejected_total", "Реплики, отклоненные из-за нагрузки",
+                  lambda: admission.rejected, metric_type="counter")
+    metrics.gauge("voice_tts_cache_lookups_total", "Обращения к кэшу синтеза по результату",
+                  lambda: {("hit",): speech_service.tts_cache.hits,
+                           ("disk_hit",): speech_service.tts_cache.disk_hits,
+                           ("miss",): speech_service.tts_cache.misses}, ["result"], "counter")
+    metrics.gauge("voice_tts_cache_bytes", "Размер кэша синтеза в памяти",
+                  lambda: speech_service.tts_cache.size)
+    metrics.gauge("voice_llm_cache_lookups_total", "Обращения к кэшу ответов Gemini по результату",
+                  lambda: {("hit",): gemini_service.response_cache.hits,
+                           ("coalesced",): gemini_service.response_cache.coalesced,
+                           ("miss",): gemini_service.response_cache.misses}
+                  if gemini_service.response_cache else {}, ["result"], "counter")
+
+register_metrics()
+
+startup_timer.mark("services")
+
+# Текстовое сообщение с аудио в base64 не длиннее этого (проверяется до разбора JSON)
+MAX_TEXT_MESSAGE_BYTES = config.MAX_AUDIO_BYTES * 4 // 3 + 4096
+
+# Результаты фонового прогрева (для /readyz)
+warm_up_state = {"providers": False, "llm_handshake": False}
+
+def provider_modules() -> List[str]:
+    """Тяжелые модули, которые не импортируются при старте, а догружаются прогревом"""
+    modules = ["services.audio_service"]  # numpy и webrtcvad
+    if speech_service.fake_recognizer is None or speech_service.fake_synthesizer is None:
+        modules.extend(PROVIDER_MODULES)
+    return modules
+
+async def warm_up():
+    """Фоновый прогрев: импорт провайдеров, клиент Gemini, первые обращения к API.
+    
+    Ветки идут параллельно; первая реплика до конца прогрева просто дождется
+    загрузки нужного клиента.
+    """
+    loop = asyncio.get_running_loop()
+    
+    async def load_providers():
+        with startup_timer.phase("providers"):
+            await loop.run_in_executor(None, preload, provider_modules())
+        warm_up_state["providers"] = True
+    
+    async def warm_up_llm():
+        try:
+            with startup_timer.phase("llm_client"):
+                await gemini_service.get_model()
+            with startup_timer.phase("llm_handshake"):
+                warm_up_state["llm_handshake"] = await gemini_service.warm_up()
+        except Exception as e:
+            logger.warning(f"Прогрев Gemini не удался: {e!r}")
+    
+    async def warm_up_tts():
+        # Озвучка фиксированных фраз - заодно первое обращение к синтезу
+        try:
+            with startup_timer.phase("tts_handshake"):
+                await system_messages.warm_up(speech_service)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки системных сообщений: {e}")
+    
+    await asyncio.gather(load_providers(), warm_up_llm(), warm_up_tts())
+    startup_timer.ready()
+
+def stage_executors():
+    """Пулы потоков этапов конвейера"""
+    executors = (
+        speech_service.decoder.executor,
+        speech_service.stt_executor,
+        speech_service.tts_executor,
+        speech_service.tts_disk_executor,
+        gemini_service.llm_executor,
+    )
+    backend_executor = getattr(session_store.backend, "executor", None)
+    return executors + (backend_executor,) if backend_executor is not None else executors
+
+@app.get("/stats")
+async def stats():
+    """Состояние этапов конвейера: очереди, активные задачи, таймауты"""
+    return {
+        "stages": {executor.name: executor.stats() for executor in stage_executors()},
+        "llm_async_client": gemini_service.async_client,
+        "tts_cache": speech_service.tts_cache.stats(),
+        "llm_cache": gemini_service.response_cache.stats() if gemini_service.response_cache else None,
+        "sessions": len(session_store),
+        "session_backend": session_store.backend.name,
+        "worker_id": WORKER_ID,
+        "connections_by_worker": await session_store.backend.connections_by_worker(),
+        "admission": admission.stats(),
+        "stream_decoders": stream_decoders.stats(),
+        "startup": startup_timer.stats()
+    }
 
-@app.get("/")
-async def get():
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    """Проверка живости: процесс отвечает, без обращения к диску и сервисам"""
+    return PlainTextResponse("ok")
+
+@app.get("/readyz")
+async def readyz():
+    """Готовность принимать разговоры: прогрев внешних клиентов завершен"""
+    checks = {
+        "providers": warm_up_state["providers"],
+        "llm_client": gemini_service.model is not None,
+        "system_messages": system_messages.warmed_up,
+        "static_assets": len(static_assets) > 0,
+    }
+    ready = all(checks.values())
+    return JSONResponse({
+        "ready": ready,
+        "checks": checks,
+        # Соединение с API проверено при старте; на готовность не влияет
+        "llm_handshake": warm_up_state["llm_handshake"],
+        "startup": startup_timer.stats()
+    }, status_code=200 if ready else 503)
+
+@app.api_route("/", methods=["GET", "HEAD"])
+async def get(request: Request):
     """Главная страница приложения"""
-    with open("templates/index.html", "r", encoding="utf-8") as f:
-        html_content = f.read()
-    return HTMLResponse(content=html_content)
+    return static_assets.response("/", request)
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"])
+async def static_file(path: str, request: Request):
+    """Статические файлы из памяти"""
+    response = static_assets.response(f"/static/{path}", request)
+    if response is None:
+        raise HTTPException(status_code=404)
+    return response
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint для голосового чата"""
-    await manager.connect(websocket)
+    if manager.get_active_connections_count() >= config.MAX_CONNECTIONS:
+        # Лимит соединений: сразу отказываем, не заводя сессию
+        await websocket.accept()
+        await websocket.send_text(json.dumps({
+            "type": "busy",
+            "reason": "connections",
+            "message": ERROR_SERVER_BUSY
+        }))
+        await websocket.close(code=1013)  # Try Again Later
+        logger.warning(f"Соединение отклонено: достигнут лимит {config.MAX_CONNECTIONS}")
+        return
+    
+    # Клиент может продолжить свой разговор (в том числе начатый на другом воркере),
+    # если этот ID выдал сервер; занятая сессия или чужой ID дают новую сессию
+    session = await session_store.open(websocket.query_params.get("session_id"))
+    session_id = session.session_id
     
     try:
+        await manager.connect(websocket, session_id)
         while True:
-            # Получаем аудио данные от клиента
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            # Получаем данные от клиента: текст (JSON) или бинарный фрейм
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
+            if not manager.touch(websocket):
+                # Соединение закрыто менеджером (медленный клиент, простой) - новые сообщения не обрабатываем
+                raise WebSocketDisconnect(1000)
             
-            if message["type"] == "complete_audio":
-                # Обрабатываем полное аудио ОДНИМ куском
+            if data.get("bytes") is not None:
+                # Бинарный фрейм: аудио без base64 и JSON
+                if len(data["bytes"]) > config.MAX_AUDIO_BYTES + HEADER_SIZE:
+                    await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+                    continue
+                manager.mark_active(websocket)
+                await handle_binary_message(websocket, session, data["bytes"])
+                continue
+            
+            if len(data["text"]) > MAX_TEXT_MESSAGE_BYTES:
+                # Слишком большое сообщение не разбираем и не декодируем из base64
+                await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+                continue
+            
+            message = json.loads(data["text"])
+            
+            if message["type"] == "pong":
+                # Ответ на heartbeat: клиент жив, но это не активность пользователя
+                continue
+            manager.mark_active(websocket)
+            
+            if message["type"] == "client_hello":
+                # Клиент сообщает о поддерживаемых возможностях
+                session.binary_audio = bool(message.get("binary_audio", False))
+                session.stream_audio = bool(message.get("stream_audio", False))
+                session.stream_text = bool(message.get("stream_text", False))
+                # Формат ответа: первый из списка клиента, который умеет сервер
+                session.output_format = speech_service.choose_output_format(message.get("audio_formats"))
+                logger.info(f"Сессия {session.session_id}: формат ответа {session.output_format}")
+                
+            elif message["type"] == "audio_start":
+                # Начало потоковой загрузки реплики: пользователь перебивает ответ
+                codec = CODEC_NAMES.get(message.get("codec", "webm"), CODEC_WEBM)
+                await interrupt_turn(websocket, session)
+                await start_audio_stream(websocket, session, codec)
+                
+            elif message["type"] == "audio_chunk":
+                # Фрагмент реплики в JSON (для клиентов без бинарных фреймов)
+                await feed_audio_stream(websocket, session, base64.b64decode(message["data"]))
+                
+            elif message["type"] == "audio_end":
+                # Конец реплики: дожидаемся декодера и распознаем (если VAD еще не начал)
+                if session.decoder is not None:
+                    await start_turn(websocket, session, finish_audio_stream(websocket, session))
+                
+            elif message["type"] == "complete_audio":
+                # Обрабатываем полное аудио ОДНИМ куском (JSON + base64)
                 audio_data = base64.b64decode(message["data"])
-                await process_complete_audio(websocket, audio_data)
+                await start_turn(websocket, session, process_complete_audio(websocket, audio_data, session))
+                
+            elif message["type"] == "interrupt":
+                # Пользователь перебил ответ: останавливаем генерацию и синтез
+                await interrupt_turn(websocket, session, always_ack=True)
                 
             elif message["type"] == "clear_history":
                 # Очищаем историю разговора
-                gemini_service.clear_history()
-                await websocket.send_text(json.dumps({
+                gemini_service.clear_history(session_id)
+                await save_session(websocket, session)
+                await send_json(websocket, {
                     "type": "history_cleared"
-                }))
+                })
                 
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
         logger.info("Client disconnected")
+    except asyncio.CancelledError:
+        # Менеджер закрыл соединение, а клиент так и не ответил - освобождаем сессию
+        if not manager.was_reaped(websocket):
+            raise
+        logger.info("Client disconnected (reaped)")
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
+    finally:
         manager.disconnect(websocket)
+        # Освобождаем состояние разговора и незавершенную загрузку этой сессии
+        await abort_audio_stream(session)
+        await cancel_turn(session)
+        # Разговор остается в хранилище для переподключения
+        await session_store.release(session_id)
+
+async def save_session(websocket: WebSocket, session: SessionState):
+    """Сохраняет разговор; если сессию продолжили на другом воркере - закрывает соединение"""
+    await session_store.save(session)
+    if session.superseded:
+        manager.close(websocket, "superseded")
+
+async def handle_binary_message(websocket: WebSocket, session: SessionState, data: bytes):
+    """Обработка бинарного аудио фрейма"""
+    try:
+        msg_type, codec, seq, payload = unpack_frame(data)
+    except ProtocolError as e:
+        logger.warning(f"Некорректный бинарный фрейм: {e}")
+        await send_error(websocket, session, ERROR_BAD_FRAME)
+        return
+    
+    # Клиент, приславший бинарный фрейм, умеет принимать их в ответ
+    session.binary_audio = True
+    
+    if msg_type == MSG_COMPLETE_AUDIO:
+        await start_turn(websocket, session, process_complete_audio(websocket, payload, session))
+    elif msg_type == MSG_AUDIO_CHUNK:
+        await feed_audio_stream(websocket, session, payload)
+    else:
+        logger.warning(f"Неизвестный тип бинарного сообщения: {msg_type}")
+
+async def cancel_turn(session: SessionState) -> bool:
+    """Отменяет текущую реплику сессии и дожидается освобождения ее ресурсов.
+    
+    Отмена доходит до ожидания Gemini, очереди синтеза и очередей пулов этапов.
+    Возвращает True, если было что отменять.
+    """
+    task = session.turn_task
+    session.turn_task = None
+    if task is None or task.done():
+        return False
+    
+    task.cancel()
+    # Ждем, пока отмена пройдет по всем await и освободит слот в очереди реплик
+    await asyncio.gather(task, return_exceptions=True)
+    logger.info(f"Реплика сессии {session.session_id} прервана")
+    return True
+
+async def interrupt_turn(websocket: WebSocket, session: SessionState, always_ack: bool = False):
+    """Прерывает ответ и подтверждает это клиенту"""
+    if await cancel_turn(session) or always_ack:
+        await send_json(websocket, {
+            "type": "interrupted"
+        })
+
+def run_turn_task(coro) -> asyncio.Task:
+    """Запускает задачу реплики: ошибки логируются, а не теряются в фоне.
+    
+    Корутина становится задачей напрямую, без обертки: задача, отмененная
+    до первого шага, закрывает ее, и она не остается невызванной.
+    """
+    task = asyncio.create_task(coro)
+    task.add_done_callback(log_turn_error)
+    return task
 
-async def process_complete_audio(websocket: WebSocket, audio_data: bytes):
-    """Обработка полного аудио файла"""
+def log_turn_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Ошибка обработки реплики: {task.exception()}")
+
+async def start_turn(websocket: WebSocket, session: SessionState, coro):
+    """Запускает обработку новой реплики, прерывая предыдущую (barge-in).
+    
+    Реплика выполняется в отдельной задаче, цикл приема продолжает читать сообщения.
+    """
     try:
-        logger.info(f"Received complete audio: {len(audio_data)} bytes")
+        await interrupt_turn(websocket, session)
+    except BaseException:
+        # Реплика так и не началась - закрываем корутину, чтобы она не висела невызванной
+        coro.close()
+        raise
+    session.turn_task = run_turn_task(coro)
+
+async def start_audio_stream(websocket: WebSocket, session: SessionState, codec: int):
+    """Начинает потоковую загрузку: декодер + VAD работают, пока пользователь говорит"""
+    await abort_audio_stream(session)
+    
+    # Модуль с numpy и webrtcvad загружается прогревом; здесь он уже в sys.modules
+    from services.audio_service import AudioService
+    audio_service = AudioService(
+        sample_rate=config.SAMPLE_RATE,
+        frame_duration=config.FRAME_DURATION,
+        max_silence_frames=config.MAX_SILENCE_FRAMES,
+        max_duration=config.MAX_UTTERANCE_SECONDS
+    )
+    endpoint_scheduled = False
+    
+    def on_pcm(pcm: bytes):
+        nonlocal endpoint_scheduled
+        audio_service.add_audio_chunk(pcm)
         
-        if not audio_data or len(audio_data) == 0:
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "message": "Не удалось записать аудио"
-            }))
+        if audio_service.is_overflowed():
+            # Реплика длиннее MAX_UTTERANCE_SECONDS: отказываем, как и для complete_audio,
+            # а не распознаем молча обрезанную запись
+            if session.audio_service is audio_service and not endpoint_scheduled:
+                endpoint_scheduled = True
+                session.turn_task = run_turn_task(reject_audio_stream(websocket, session))
             return
-            
+        
+        # Серверное определение конца речи: не ждем, пока пользователь нажмет стоп
+        if config.AUTO_ENDPOINT and session.audio_service is audio_service \
+                and not endpoint_scheduled and audio_service.is_end_of_speech():
+            endpoint_scheduled = True
+            # Предыдущий ответ уже отменен в audio_start - просто запускаем новую реплику
+            session.turn_task = run_turn_task(
+                finish_audio_stream(websocket, session, endpointed=True)
+            )
+    
+    decoder = StreamingDecoder(
+        on_pcm=on_pcm,
+        sample_rate=config.SAMPLE_RATE,
+        frame_bytes=audio_service.frame_size * 2,
+        passthrough=(codec == CODEC_PCM16),
+        limiter=stream_decoders,
+        fallback=speech_service.decoder
+    )
+    
+    try:
+        await decoder.start()
+    except DecoderUnavailableError as e:
+        logger.error(f"Потоковое декодирование недоступно: {e}")
+        await send_error(websocket, session, ERROR_STREAM_UNAVAILABLE)
+        return
+    
+    session.audio_service = audio_service
+    session.decoder = decoder
+    session.speech_notified = False
+
+async def feed_audio_stream(websocket: WebSocket, session: SessionState, data: bytes):
+    """Передает фрагмент реплики в декодер"""
+    if session.decoder is None:
+        # Реплика уже завершена серверным VAD - клиент досылает хвост записи
+        logger.debug("Получен audio_chunk вне потоковой загрузки")
+        return
+    
+    if session.decoder.bytes_in + len(data) > config.MAX_AUDIO_BYTES:
+        # Реплика превысила лимит размера - прекращаем прием
+        logger.warning(f"Потоковая реплика превысила {config.MAX_AUDIO_BYTES} байт")
+        await abort_audio_stream(session)
+        await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+        return
+    
+    audio_service = session.audio_service
+    await session.decoder.feed(data)
+    
+    # Сообщаем клиенту о начале речи, как только ее увидел VAD
+    if not session.speech_notified and audio_service.is_speech_detected():
+        session.speech_notified = True
+        await send_json(websocket, {
+            "type": "speech_detected"
+        })
+
+async def finish_audio_stream(websocket: WebSocket, session: SessionState, endpointed: bool = False):
+    """Завершает потоковую загрузку и запускает обработку реплики"""
+    decoder, audio_service = session.decoder, session.audio_service
+    if decoder is None:
+        logger.debug("Получен audio_end вне потоковой загрузки")
+        return
+    
+    session.decoder = None
+    session.audio_service = None
+    
+    if endpointed:
+        # Конец речи найден VAD: остаток потока не нужен, сразу сообщаем клиенту
+        await decoder.abort()
+        logger.info(f"Конец речи определен сервером после {audio_service.get_duration():.2f} с")
+        await send_json(websocket, {
+            "type": "speech_end"
+        })
+    else:
+        try:
+            await decoder.finish()
+        except asyncio.CancelledError:
+            # Реплику перебили, пока декодер дочитывал поток
+            await decoder.abort()
+            raise
+    logger.info(f"Поток декодирован: {decoder.bytes_in} байт -> {decoder.bytes_out} байт PCM")
+    
+    if audio_service.is_overflowed():
+        logger.warning(f"Потоковая реплика длиннее {config.MAX_UTTERANCE_SECONDS} с")
+        TURNS.inc("too_long")
+        await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+        return
+    
+    # Распознаем только речь, без тишины в начале и в конце.
+    # Если VAD речь не нашел, отдаем запись целиком - пусть решает распознаватель
+    audio_data = audio_service.get_speech_audio(config.ENDPOINT_PADDING_MS)
+    trimmed = audio_data is not None
+    if audio_data is None:
+        audio_data = audio_service.get_audio_buffer()
+    audio_service.clear_buffer()
+    
+    await process_complete_audio(websocket, audio_data or b"", session, trimmed)
+
+async def reject_audio_stream(websocket: WebSocket, session: SessionState):
+    """Прекращает прием реплики, которая не уместилась в MAX_UTTERANCE_SECONDS"""
+    logger.warning(f"Потоковая реплика длиннее {config.MAX_UTTERANCE_SECONDS} с")
+    await abort_audio_stream(session)
+    TURNS.inc("too_long")
+    await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+
+async def abort_audio_stream(session: SessionState):
+    """Прерывает незавершенную потоковую загрузку"""
+    if session.decoder is not None:
+        await session.decoder.abort()
+    session.decoder = None
+    session.audio_service = None
+
+async def send_json(websocket: WebSocket, message: dict, droppable: bool = False):
+    """Отправляет управляющее сообщение в JSON через очередь соединения.
+    
+    droppable - сообщение можно потерять, если клиент не успевает принимать.
+    """
+    await manager.send(websocket, json.dumps(message), droppable)
+
+async def send_error(websocket: WebSocket, session: SessionState, text: str):
+    """Отправляет системную ошибку: заранее сериализованную и озвученную, если готово"""
+    prerendered = system_messages.get(text)
+    if prerendered is None:
+        await send_json(websocket, {
+            "type": "error",
+            "message": text
+        })
+        return
+    
+    await manager.send(websocket, prerendered.error_json)
+    
+    output_format = session.output_format
+    if config.SPEAK_ERRORS and output_format in prerendered.audio:
+        # Готовые байты в формате сессии отправляются как есть: без синтеза, base64 и сборки фрейма
+        if session.binary_audio:
+            await manager.send(websocket, prerendered.audio_frames[output_format])
+        else:
+            await manager.send(websocket, prerendered.audio_jsons[output_format])
+
+def record_audio_sent(session: SessionState, audio: bytes, started: float):
+    """Учитывает отправленное аудио ответа в метриках"""
+    now = time.perf_counter()
+    # Ожидание места в очереди соединения; саму запись в сокет замеряет ConnectionManager ("send")
+    STAGE_SECONDS.observe(now - started, "send_queue")
+    PAYLOAD_BYTES.observe(len(audio), "out")
+    AUDIO_BYTES.inc("out", amount=len(audio))
+    
+    if not session.first_audio_sent and session.turn_started:
+        session.first_audio_sent = True
+        FIRST_AUDIO_SECONDS.observe(now - session.turn_started)
+
+async def send_audio(websocket: WebSocket, session: SessionState, audio: bytes, codec: int = CODEC_WAV):
+    """Отправляет аудио ответ бинарным фреймом или JSON для старых клиентов"""
+    started = time.perf_counter()
+    if session.binary_audio:
+        await manager.send(websocket, pack_frame(MSG_AUDIO_RESPONSE, codec, audio))
+    else:
+        await send_json(websocket, {
+            "type": "audio_response",
+            "mime_type": CODEC_MIME_TYPES.get(codec, "audio/wav"),
+            "data": base64.b64encode(audio).decode()
+        })
+    record_audio_sent(session, audio, started)
+
+async def send_audio_chunk(websocket: WebSocket, session: SessionState, audio: bytes, seq: int,
+                           codec: int = CODEC_WAV):
+    """Отправляет аудио одного предложения ответа"""
+    started = time.perf_counter()
+    if session.binary_audio:
+        await manager.send(websocket, pack_frame(MSG_AUDIO_RESPONSE_CHUNK, codec, audio, seq))
+    else:
+        await send_json(websocket, {
+            "type": "audio_chunk",
+            "seq": seq,
+            "mime_type": CODEC_MIME_TYPES.get(codec, "audio/wav"),
+            "data": base64.b64encode(audio).decode()
+        })
+    record_audio_sent(session, audio, started)
+
+async def respond(websocket: WebSocket, session: SessionState, text: str):
+    """Получает ответ Gemini потоком и озвучивает его по предложениям.
+    
+    Синтез первого предложения начинается, пока Gemini еще дописывает остальные.
+    """
+    splitter = SentenceSplitter()
+    parts = []
+    output_format = session.output_format
+    codec = OUTPUT_FORMAT_CODECS[output_format]
+    
+    async def sentences():
+        async for delta in gemini_service.stream_response(text, session):
+            parts.append(delta)
+            if session.stream_text:
+                # Полный текст придет в ai_response, поэтому дельты можно терять
+                await send_json(websocket, {
+                    "type": "ai_response_delta",
+                    "text": delta
+                }, droppable=True)
+            for sentence in splitter.feed(delta):
+                yield sentence
+        
+        for sentence in splitter.flush():
+            yield sentence
+        
+        response = "".join(parts).strip()
+        logger.info(f"Gemini response: {response}")
+        await send_json(websocket, {
+            "type": "ai_response",
+            "text": response
+        })
+    
+    if not session.stream_audio:
+        # Старые клиенты получают ответ одним аудио
+        async for _ in sentences():
+            pass
+        audio_response = await speech_service.text_to_speech("".join(parts).strip(), output_format=output_format)
+        if audio_response:
+            await send_audio(websocket, session, audio_response, codec)
+        return
+    
+    # Предложения синтезируются параллельно, клиент начинает играть первое сразу
+    seq = 0
+    async for audio in speech_service.stream_speech(sentences(), output_format=output_format):
+        if not audio:
+            # Синтез предложения не удался - пропускаем его
+            continue
+        await send_audio_chunk(websocket, session, audio, seq, codec)
+        seq += 1
+    
+    await send_json(websocket, {
+        "type": "audio_response_end",
+        "chunks": seq
+    })
+
+async def send_busy(websocket: WebSocket, reason: str, estimated_wait: float, position: int = None):
+    """Сообщает клиенту, что реплика ждет в очереди или отклонена из-за нагрузки"""
+    message = {
+        "type": "busy",
+        "reason": reason,
+        "estimated_wait": estimated_wait
+    }
+    if position is not None:
+        message["position"] = position
+    await send_json(websocket, message)
+
+async def process_complete_audio(websocket: WebSocket, audio_data: bytes, session: SessionState,
+                                 trimmed: bool = False):
+    """Обработка полного аудио файла: проверка лимитов, очередь, затем STT -> LLM -> TTS.
+    
+    trimmed=True - запись уже обрезана VAD до речи (см. finish_audio_stream).
+    """
+    logger.info(f"Received complete audio: {len(audio_data)} bytes")
+    
+    if not audio_data or len(audio_data) == 0:
+        TURNS.inc("no_audio")
+        await send_error(websocket, session, ERROR_NO_AUDIO)
+        return
+    
+    PAYLOAD_BYTES.observe(len(audio_data), "in")
+    AUDIO_BYTES.inc("in", amount=len(audio_data))
+    
+    if len(audio_data) > config.MAX_AUDIO_BYTES:
+        TURNS.inc("too_long")
+        await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+        return
+    
+    async def on_queued(position: int, estimated_wait: float):
+        await send_busy(websocket, "queued", estimated_wait, position)
+    
+    session.turn_started = time.perf_counter()
+    session.first_audio_sent = False
+    try:
+        async with admission.admit(session.session_id, on_queued):
+            outcome = await run_turn(websocket, audio_data, session, trimmed)
+        TURNS.inc(outcome)
+        await save_session(websocket, session)
+        TURN_SECONDS.observe(time.perf_counter() - session.turn_started)
+    except AdmissionRejected as e:
+        TURNS.inc("rejected")
+        logger.warning(f"Реплика сессии {session.session_id} отклонена: {e.reason}")
+        await send_busy(websocket, e.reason, e.estimated_wait)
+    except asyncio.CancelledError:
+        TURNS.inc("interrupted")
+        raise
+
+async def run_turn(websocket: WebSocket, audio_data: bytes, session: SessionState,
+                   trimmed: bool = False) -> str:
+    """Распознает реплику, получает ответ Gemini и озвучивает его.
+    
+    Возвращает результат для метрик: ok, not_recognized, too_long или error.
+    """
+    try:
         # Конвертируем речь в текст НАПРЯМУЮ
-        text = await speech_service.speech_to_text(audio_data)
+        text = await speech_service.speech_to_text(audio_data, session, trimmed)
         
         if text:
             logger.info(f"Transcribed text: {text}")
-            await websocket.send_text(json.dumps({
+            await send_json(websocket, {
                 "type": "transcription",
                 "text": text
-            }))
-            
-            # Получаем ответ от Gemini
-            response = await gemini_service.get_response(text)
-            logger.info(f"Gemini response: {response}")
-            
-            await websocket.send_text(json.dumps({
-                "type": "ai_response",
-                "text": response
-            }))
+            })
             
-            # Конвертируем ответ в речь
-            audio_response = await speech_service.text_to_speech(response)
-            
-            # Отправляем аудио ответ
-            audio_base64 = base64.b64encode(audio_response).decode()
-            await websocket.send_text(json.dumps({
-                "type": "audio_response",
-                "data": audio_base64
-            }))
-        else:
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "message": "Не удалось распознать речь"
-            }))
+            # Получаем ответ от Gemini и озвучиваем его
+            await respond(websocket, session, text)
+            return "ok"
+        
+        await send_error(websocket, session, ERROR_NOT_RECOGNIZED)
+        return "not_recognized"
         
+    except AudioTooLongError as e:
+        logger.warning(f"Реплика отклонена: {e}")
+        await send_error(websocket, session, ERROR_AUDIO_TOO_LONG)
+        return "too_long"
     except Exception as e:
         logger.error(f"Error processing complete audio: {e}")
-        await websocket.send_text(json.dumps({
-            "type": "error",
-            "message": "Ошибка обработки аудио"
-        }))
+        await send_error(websocket, session, ERROR_PROCESSING)
+        return "error"
 
 if __name__ == "__main__":
     import os
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port, ws_max_size=MAX_TEXT_MESSAGE_BYTES) 
\ No newline at end of file
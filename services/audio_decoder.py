@@ -0,0 +1,127 @@
+import logging
+import shutil
+import struct
+import subprocess
+import time
+from typing import List, Optional, Tuple
+
+from utils.pcm_buffer import wav_header
+from utils.stage_executor import StageExecutor
+
+logger = logging.getLogger(__name__)
+
+class AudioDecodeError(RuntimeError):
+    """Не удалось декодировать аудио"""
+
+class AudioTooLongError(AudioDecodeError):
+    """Аудио длиннее допустимого"""
+
+def run_ffmpeg(audio_data: bytes, output_args: List[str], timeout: float = 30.0) -> bytes:
+    """Прогоняет аудио через ffmpeg в памяти (stdin -> stdout) и возвращает результат"""
+    if shutil.which("ffmpeg") is None:
+        raise AudioDecodeError("ffmpeg не найден")
+
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0"] + output_args + ["pipe:1"],
+            input=audio_data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        raise AudioDecodeError(f"ffmpeg не уложился в {timeout} с")
+
+    if result.returncode != 0 or not result.stdout:
+        raise AudioDecodeError(result.stderr.decode(errors="ignore").strip() or "пустой результат")
+
+    return result.stdout
+
+class AudioDecoder:
+    """Декодирует входящее аудио (WebM/Opus, WAV и т.д.) в WAV 16 бит моно в памяти.
+
+    WAV в нужном формате возвращается как есть. Все остальное декодируется
+    ffmpeg через stdin/stdout без временных файлов. Работа ffmpeg выполняется
+    в отдельном пуле этапа decode, чтобы число одновременных процессов
+    не росло вместе с числом клиентов.
+    """
+
+    def __init__(self, sample_rate: int = 16000, max_workers: int = 2, timeout: float = 30.0,
+                 max_duration: float = 60.0):
+        self.sample_rate = sample_rate
+        self.timeout = timeout
+        self.max_duration = max_duration
+        # Предел длины декодированного PCM
+        self.max_pcm_bytes = int(max_duration * sample_rate) * 2
+        self.executor = StageExecutor("decode", max_workers, timeout)
+
+        # Статистика декодирования
+        self.decode_count = 0
+        self.passthrough_count = 0
+        self.decode_seconds = 0.0
+
+    async def decode(self, audio_data: bytes) -> bytes:
+        """Возвращает аудио как WAV (PCM 16 бит моно, sample_rate)"""
+        if self._is_target_wav(audio_data):
+            # Уже нужный формат - длительность видна по размеру, декодировать нечего
+            if len(audio_data) - 44 > self.max_pcm_bytes:
+                raise AudioTooLongError(f"аудио длиннее {self.max_duration:.0f} с")
+            self.passthrough_count += 1
+            return bytes(audio_data)
+
+        return await self.executor.run(self._transcode, audio_data)
+
+    async def decode_pcm(self, audio_data: bytes) -> bytes:
+        """Возвращает сырой PCM 16 бит моно (для потоков, отложенных до конца записи)"""
+        return await self.executor.run(self._decode_pcm, audio_data)
+
+    def _transcode(self, audio_data: bytes) -> bytes:
+        """Перекодирует аудио через ffmpeg в WAV (выполняется в пуле)"""
+        pcm = self._decode_pcm(audio_data)
+        return wav_header(len(pcm), self.sample_rate) + pcm
+
+    def _decode_pcm(self, audio_data: bytes) -> bytes:
+        """Декодирует аудио через ffmpeg в PCM (выполняется в пуле)"""
+        started = time.perf_counter()
+        # ffmpeg декодирует чуть больше предела и останавливается (-t),
+        # так что длинная запись не расходует память и время целиком
+        pcm = run_ffmpeg(
+            audio_data,
+            ["-t", f"{self.max_duration + 0.1:.1f}",
+             "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(self.sample_rate)],
+            timeout=self.timeout
+        )
+        if len(pcm) > self.max_pcm_bytes:
+            raise AudioTooLongError(f"аудио длиннее {self.max_duration:.0f} с")
+
+        elapsed = time.perf_counter() - started
+        self.decode_count += 1
+        self.decode_seconds += elapsed
+        logger.info(f"Аудио декодировано за {elapsed * 1000:.0f} мс: "
+                    f"{len(audio_data)} -> {len(pcm)} байт PCM")
+
+        return pcm
+
+    def _is_target_wav(self, audio_data: bytes) -> bool:
+        """Проверяет, что это WAV PCM 16 бит моно с нужной частотой"""
+        params = self._parse_wav_format(audio_data)
+        return params == (1, 1, self.sample_rate, 16)
+
+    @staticmethod
+    def _parse_wav_format(audio_data: bytes) -> Optional[Tuple[int, int, int, int]]:
+        """Возвращает (формат, каналы, частота, бит на семпл) из заголовка WAV"""
+        if len(audio_data) < 12 or bytes(audio_data[0:4]) != b"RIFF" or bytes(audio_data[8:12]) != b"WAVE":
+            return None
+
+        # Ищем чанк fmt
+        offset = 12
+        while offset + 8 <= len(audio_data):
+            chunk_id = bytes(audio_data[offset:offset + 4])
+            chunk_size = struct.unpack_from("<I", audio_data, offset + 4)[0]
+            if chunk_id == b"fmt " and offset + 24 <= len(audio_data):
+                audio_format, channels, rate = struct.unpack_from("<HHI", audio_data, offset + 8)
+                bits = struct.unpack_from("<H", audio_data, offset + 22)[0]
+                return audio_format, channels, rate, bits
+            offset += 8 + chunk_size + (chunk_size & 1)
+
+        return None
@@ -6,21 +6,25 @@ except ImportError:
     print("⚠️  webrtcvad не установлен. VAD будет отключен.")
 
 import numpy as np
-from pydub import AudioSegment
-from pydub.utils import make_chunks
-import io
 import logging
-from typing import Optional, List
+from typing import Optional
+
+from utils.pcm_buffer import PCMBuffer
 
 logger = logging.getLogger(__name__)
 
 class AudioService:
     """Сервис для обработки аудио и детекции речи"""
     
-    def __init__(self, sample_rate: int = 16000, frame_duration: int = 30):
+    def __init__(self, sample_rate: int = 16000, frame_duration: int = 30,
+                 max_silence_frames: int = 30, max_duration: float = 60.0):
         self.sample_rate = sample_rate
         self.frame_duration = frame_duration  # мс
         self.frame_size = int(sample_rate * frame_duration / 1000)
+        self.frame_bytes = self.frame_size * 2  # 16 бит на семпл
+        
+        # Порог RMS для упрощенной детекции речи (без webrtcvad)
+        self.energy_threshold = 200
         
         # Инициализация VAD (если доступен)
         if WEBRTCVAD_AVAILABLE:
@@ -30,103 +34,155 @@ class AudioService:
             self.vad = None
             logger.warning("WebRTC VAD недоступен, используется упрощенная детекция речи")
         
-        # Буфер для аудио
-        self.audio_buffer = []
-        self.speech_frames = []
+        # Буфер для аудио: сырой PCM, не длиннее max_duration секунд
+        self.audio_buffer = PCMBuffer(
+            max_bytes=int(max_duration * sample_rate) * 2,
+            sample_rate=sample_rate
+        )
+        self.speech_frame_count = 0
         self.silence_frames = 0
-        self.max_silence_frames = 30  # 30 фреймов тишины = ~900мс
+        self.max_silence_frames = max_silence_frames  # 30 фреймов по 30мс = ~900мс
+        
+        # Границы речи как абсолютные смещения в буфере (для обрезки тишины)
+        self.frame_count = 0
+        self.speech_start: Optional[int] = None
+        self.speech_end: Optional[int] = None
         
     def add_audio_chunk(self, audio_data: bytes):
-        """Добавляет аудио чанк в буфер"""
+        """Добавляет аудио чанк (PCM 16 бит моно) в буфер"""
         try:
-            # Конвертируем в AudioSegment
-            audio = AudioSegment.from_raw(
-                io.BytesIO(audio_data),
-                sample_width=2,
-                frame_rate=self.sample_rate,
-                channels=1
-            )
+            # Добавляем в буфер без промежуточных объектов
+            self.audio_buffer.append(audio_data)
             
-            # Добавляем в буфер
-            self.audio_buffer.append(audio)
-            
-            # Проверяем на активность голоса
-            self._check_voice_activity(audio)
+            # Проверяем на активность голоса прямо по PCM, без AudioSegment на фрейм
+            self._check_voice_activity(audio_data)
             
         except Exception as e:
             logger.error(f"Ошибка добавления аудио чанка: {e}")
     
-    def _check_voice_activity(self, audio: AudioSegment):
-        """Проверяет активность голоса в аудио"""
+    def _check_voice_activity(self, pcm_data: bytes):
+        """Проверяет активность голоса во всех фреймах чанка за один проход"""
         try:
-            # Разбиваем на фреймы
-            frames = make_chunks(audio, self.frame_duration)
+            # Неполный фрейм в конце чанка пропускаем, как и раньше
+            n_frames = len(pcm_data) // self.frame_bytes
+            if n_frames == 0:
+                return
             
-            for frame in frames:
-                if len(frame) < self.frame_duration:
-                    continue
-                
-                if self.vad:
-                    # Используем WebRTC VAD если доступен
-                    pcm_data = frame.raw_data
-                    
-                    # Проверяем с помощью VAD
-                    if len(pcm_data) == self.frame_size * 2:  # 2 байта на семпл
-                        is_speech = self.vad.is_speech(pcm_data, self.sample_rate)
-                        
-                        if is_speech:
-                            self.speech_frames.append(frame)
-                            self.silence_frames = 0
-                        else:
-                            self.silence_frames += 1
-                else:
-                    # Упрощенная детекция по уровню звука
-                    rms = frame.rms
-                    if rms > 200:  # Пороговое значение для детекции речи
-                        self.speech_frames.append(frame)
-                        self.silence_frames = 0
-                    else:
-                        self.silence_frames += 1
+            if self.vad:
+                # WebRTC VAD: срезы memoryview передаются без копирования
+                view = memoryview(pcm_data)
+                fb = self.frame_bytes
+                speech_mask = np.fromiter(
+                    (self.vad.is_speech(view[i * fb:(i + 1) * fb], self.sample_rate)
+                     for i in range(n_frames)),
+                    dtype=bool,
+                    count=n_frames
+                )
+            else:
+                # Упрощенная детекция по уровню звука
+                speech_mask = self.frame_rms(pcm_data) > self.energy_threshold
+            
+            self._update_speech_state(pcm_data, speech_mask)
                         
         except Exception as e:
             logger.error(f"Ошибка проверки активности голоса: {e}")
     
+    def frame_rms(self, pcm_data: bytes) -> np.ndarray:
+        """Возвращает RMS каждого полного фрейма чанка"""
+        n_frames = len(pcm_data) // self.frame_bytes
+        
+        # Представление PCM как матрицы (фреймы x семплы) без копирования
+        samples = np.frombuffer(pcm_data, dtype="<i2", count=n_frames * self.frame_size)
+        frames = samples.reshape(n_frames, self.frame_size)
+        
+        # Сумма квадратов по каждому фрейму в int64 - без промежуточных массивов float
+        energy = np.einsum("ij,ij->i", frames, frames, dtype=np.int64)
+        return np.sqrt(energy / self.frame_size)
+    
+    def _update_speech_state(self, pcm_data: bytes, speech_mask: np.ndarray):
+        """Обновляет счетчики речи и тишины по маске фреймов"""
+        n_frames = len(speech_mask)
+        speech_indices = np.flatnonzero(speech_mask)
+        
+        if len(speech_indices):
+            # Чанк уже добавлен в буфер и заканчивается в его конце
+            chunk_offset = self.audio_buffer.end_offset - len(pcm_data)
+            fb = self.frame_bytes
+            
+            self.speech_frame_count += len(speech_indices)
+            if self.speech_start is None:
+                self.speech_start = chunk_offset + int(speech_indices[0]) * fb
+            self.speech_end = chunk_offset + (int(speech_indices[-1]) + 1) * fb
+            
+            # Тишина считается только после последнего фрейма с речью
+            self.silence_frames = n_frames - 1 - int(speech_indices[-1])
+        else:
+            self.silence_frames += n_frames
+        
+        self.frame_count += n_frames
+    
     def is_speech_detected(self) -> bool:
         """Проверяет, обнаружена ли речь"""
-        return len(self.speech_frames) > 0
+        return self.speech_frame_count > 0
     
     def is_silence_detected(self) -> bool:
         """Проверяет, обнаружена ли тишина (пользователь закончил говорить)"""
         return self.silence_frames >= self.max_silence_frames
     
+    def is_end_of_speech(self) -> bool:
+        """Проверяет конец реплики: речь была, и после нее достаточно тишины"""
+        return self.is_speech_detected() and self.is_silence_detected()
+    
     def get_audio_buffer(self) -> Optional[bytes]:
-        """Возвращает накопленное аудио как bytes"""
-        if not self.audio_buffer:
+        """Возвращает накопленное аудио как WAV bytes"""
+        if not len(self.audio_buffer):
             return None
             
         try:
-            # Объединяем все чанки
-            combined_audio = sum(self.audio_buffer)
-            
-            # Конвертируем в WAV
-            output = io.BytesIO()
-            combined_audio.export(output, format="wav")
-            return output.getvalue()
+            # Заголовок WAV + PCM, без перекодирования
+            return self.audio_buffer.to_wav()
             
         except Exception as e:
             logger.error(f"Ошибка получения аудио буфера: {e}")
             return None
     
+    def get_speech_audio(self, padding_ms: int = 200) -> Optional[bytes]:
+        """Возвращает речь без тишины в начале и в конце как WAV bytes"""
+        if not len(self.audio_buffer):
+            return None
+        
+        if self.speech_start is None:
+            # Речь не обнаружена - нечего распознавать
+            return None
+        
+        if self.speech_start < self.audio_buffer.start_offset:
+            # Начало речи вытеснено из буфера - обрезать нечего
+            return None
+            
+        try:
+            padding = int(self.sample_rate * padding_ms / 1000) * 2
+            return self.audio_buffer.to_wav(
+                self.speech_start - padding,
+                self.speech_end + padding
+            )
+            
+        except Exception as e:
+            logger.error(f"Ошибка обрезки тишины: {e}")
+            return None
+    
     def clear_buffer(self):
         """Очищает аудио буфер"""
         self.audio_buffer.clear()
-        self.speech_frames.clear()
+        self.speech_frame_count = 0
         self.silence_frames = 0
+        self.frame_count = 0
+        self.speech_start = None
+        self.speech_end = None
     
     def get_duration(self) -> float:
         """Возвращает продолжительность накопленного аудио в секундах"""
-        if not self.audio_buffer:
-            return 0.0
-        
-        total_duration = sum(len(chunk) for chunk in self.audio_buffer)
-        return total_duration / 1000.0  # Конвертируем в секунды 
\ No newline at end of file
+        return self.audio_buffer.duration
+    
+    def is_overflowed(self) -> bool:
+        """Реплика длиннее max_duration: начало записи уже вытеснено из буфера"""
+        return self.audio_buffer.overflowed
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Iterator, List
+
+from utils.pcm_buffer import wav_header
+
+# Локальные заглушки внешних сервисов (Google STT, gTTS, Gemini) для бенчмарков
+# и нагрузочного тестирования без сети и API ключей. Включаются через FAKE_BACKENDS.
+# Заглушки повторяют интерфейс настоящих клиентов, поэтому весь остальной
+# конвейер (декодирование, пулы этапов, очередь реплик, отправка) работает как обычно.
+
+FAKE_BACKEND_NAMES = ("stt", "tts", "llm")
+
+FAKE_TRANSCRIPTS = (
+    "привет как дела",
+    "расскажи что-нибудь интересное",
+    "какая сегодня погода",
+    "повтори пожалуйста",
+)
+
+FAKE_REPLY = (
+    "Это тестовый ответ без обращения к модели. "
+    "Он состоит из нескольких предложений, чтобы проверить потоковый синтез. "
+    "Задержки и разброс задаются в настройках."
+)
+
+def parse_fake_backends(value: str) -> List[str]:
+    """Разбирает FAKE_BACKENDS: список через запятую из stt, tts, llm или all"""
+    names = [name.strip().lower() for name in value.split(",") if name.strip()]
+    if "all" in names:
+        return list(FAKE_BACKEND_NAMES)
+    return names
+
+class FakeLatency:
+    """Задержка со случайным разбросом: mean_ms ± jitter (доля от mean_ms)"""
+
+    def __init__(self, mean_ms: float, jitter: float = 0.0):
+        self.mean = mean_ms / 1000
+        self.jitter = jitter
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        spread = self.mean * self.jitter
+        return max(0.0, random.uniform(self.mean - spread, self.mean + spread))
+
+    def sleep(self):
+        """Блокирующая задержка (в потоке пула этапа, как у настоящего клиента)"""
+        time.sleep(self.sample())
+
+    async def asleep(self):
+        """Задержка в event loop (для async клиента)"""
+        await asyncio.sleep(self.sample())
+
+class FakeRecognizer:
+    """Заглушка Google Speech Recognition: тот же вызов, что у sr.Recognizer"""
+
+    def __init__(self, latency: FakeLatency, transcripts=FAKE_TRANSCRIPTS):
+        self.latency = latency
+        self.transcripts = transcripts
+
+    def recognize_google(self, audio_data, language: str = "ru-RU") -> str:
+        self.latency.sleep()
+        # Текст зависит от длины записи, чтобы разные записи давали разные реплики
+        frame_data = getattr(audio_data, "frame_data", b"")
+        return self.transcripts[len(frame_data) % len(self.transcripts)]
+
+class FakeSynthesizer:
+    """Заглушка gTTS: отдает тишину в WAV длительностью по длине текста.
+
+    Сжатые форматы не поддерживаются - SpeechService с этой заглушкой
+    предлагает клиентам только WAV.
+    """
+
+    def __init__(self, latency: FakeLatency, sample_rate: int, ms_per_char: float = 60):
+        self.latency = latency
+        self.sample_rate = sample_rate
+        self.ms_per_char = ms_per_char
+
+    def synthesize(self, text: str) -> bytes:
+        self.latency.sleep()
+        data_size = int(self.sample_rate * len(text) * self.ms_per_char / 1000) * 2
+        return wav_header(data_size, self.sample_rate) + bytes(data_size)
+
+class FakeChunk:
+    """Фрагмент ответа с полем text, как у ответа SDK"""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeStreamResponse:
+    """Потоковый ответ: фрагменты приходят с задержкой, первый - после first_token"""
+
+    def __init__(self, model: "FakeGenerativeModel", chunks: List[str]):
+        self.model = model
+        self.chunks = chunks
+
+    def __iter__(self) -> Iterator[FakeChunk]:
+        for index, text in enumerate(self.chunks):
+            (self.model.first_token if index == 0 else self.model.chunk).sleep()
+            yield FakeChunk(text)
+
+    async def __aiter__(self) -> AsyncIterator[FakeChunk]:
+        for index, text in enumerate(self.chunks):
+            await (self.model.first_token if index == 0 else self.model.chunk).asleep()
+            yield FakeChunk(text)
+
+class FakeGenerativeModel:
+    """Заглушка genai.GenerativeModel: generate_content и generate_content_async"""
+
+    def __init__(self, first_token: FakeLatency, chunk: FakeLatency,
+                 reply: str = FAKE_REPLY, chunk_words: int = 4):
+        self.first_token = first_token
+        self.chunk = chunk
+        self.reply = reply
+        self.chunk_words = chunk_words
+
+    def _chunks(self) -> List[str]:
+        # Режем ответ по словам, как модель режет его на фрагменты потока
+        words = self.reply.split(" ")
+        return [
+            " ".join(words[i:i + self.chunk_words]) + (" " if i + self.chunk_words < len(words) else "")
+            for i in range(0, len(words), self.chunk_words)
+        ]
+
+    def _full_latency(self) -> float:
+        return self.first_token.sample() + self.chunk.sample() * (len(self._chunks()) - 1)
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        if stream:
+            return FakeStreamResponse(self, self._chunks())
+        time.sleep(self._full_latency())
+        return FakeChunk(self.reply)
+
+    async def generate_content_async(self, prompt: str, stream: bool = False):
+        if stream:
+            return FakeStreamResponse(self, self._chunks())
+        await asyncio.sleep(self._full_latency())
+        return FakeChunk(self.reply)
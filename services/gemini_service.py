@@ -1,28 +1,49 @@
-import google.generativeai as genai
 import os
 import logging
-from typing import Optional, List
+from typing import AsyncIterator, Optional
 import asyncio
+import threading
+import time
+
+from services.fake_backends import FakeGenerativeModel, FakeLatency, parse_fake_backends
+from utils.conversation_context import ConversationContext
+from utils.response_cache import ResponseCache
+from utils.session_store import SessionState, SessionStore
+from utils.stage_executor import StageExecutor, StageTimeoutError
+from utils.metrics import STAGE_SECONDS
+from utils.system_messages import LLM_APOLOGY
+from config import config
 
 logger = logging.getLogger(__name__)
 
+MODEL_NAME = "gemini-2.0-flash"
+
+# Инструкция для свертки старой части разговора
+SUMMARY_PROMPT = (
+    "Кратко (не больше {words} слов) перескажи содержание разговора пользователя "
+    "с голосовым ассистентом. Сохрани факты о пользователе, его просьбы и договоренности. "
+    "Ответь только пересказом."
+)
+
 class GeminiService:
     """Сервис для работы с Gemini API"""
     
-    def __init__(self):
+    def __init__(self, session_store: Optional[SessionStore] = None):
         # Инициализация Gemini API
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
+        self.api_key = os.getenv("GEMINI_API_KEY")
+        if not self.api_key:
             logger.warning("GEMINI_API_KEY не найден в переменных окружения")
             # Можно установить дефолтный ключ или попросить пользователя
-            
-        genai.configure(api_key=api_key)
         
-        # Настройка модели (используем новую версию gemini-2.0-flash)
-        self.model = genai.GenerativeModel('gemini-2.0-flash')
+        # Клиент модели создается лениво: импорт SDK - самая долгая часть старта.
+        # Его загружает фоновый прогрев (warm_up), первый запрос до прогрева ждет загрузку
+        self.fake = "llm" in parse_fake_backends(config.FAKE_BACKENDS)
+        self.model = None
+        self._model_loading: Optional[asyncio.Future] = None
         
-        # История разговора
-        self.conversation_history: List[dict] = []
+        # История разговоров хранится отдельно для каждой сессии
+        # Пустое хранилище ложно (__len__), поэтому сравниваем с None явно
+        self.sessions = session_store if session_store is not None else SessionStore()
         
         # Системный промпт
         self.system_prompt = """
@@ -36,65 +57,219 @@ class GeminiService:
         Если пользователь задает вопрос, отвечай четко и по существу.
         Если просто общается - поддерживай беседу.
         """
+        
+        # Запросы идут через нативный async клиент SDK; без него - через свой пул потоков,
+        # не общий с синтезом и распознаванием
+        self.async_client = config.LLM_ASYNC_CLIENT
+        self.timeout = config.LLM_TIMEOUT
+        self.llm_executor = StageExecutor("llm", config.LLM_WORKERS, config.LLM_TIMEOUT)
+        
+        # Кэш ответов на повторяющиеся реплики (приветствия, "повтори")
+        self.response_cache: Optional[ResponseCache] = None
+        if config.LLM_CACHE_ENABLED:
+            self.response_cache = ResponseCache(
+                max_entries=config.LLM_CACHE_MAX_ENTRIES,
+                ttl=config.LLM_CACHE_TTL,
+                history_window=config.LLM_CACHE_HISTORY_WINDOW
+            )
+    
+    def _load_model(self):
+        """Импортирует SDK и создает клиента модели (выполняется в потоке)"""
+        if self.fake:
+            # Заглушка с настраиваемой задержкой для бенчмарков - без сети и ключа
+            return FakeGenerativeModel(
+                first_token=FakeLatency(config.FAKE_LLM_FIRST_TOKEN_MS, config.FAKE_JITTER),
+                chunk=FakeLatency(config.FAKE_LLM_CHUNK_MS, config.FAKE_JITTER)
+            )
+        
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        # Настройка модели (используем новую версию gemini-2.0-flash)
+        return genai.GenerativeModel(MODEL_NAME)
+    
+    async def get_model(self):
+        """Клиент модели; загружается один раз, одновременные вызовы ждут одну загрузку"""
+        if self.model is not None:
+            return self.model
+        if self._model_loading is None:
+            self._model_loading = self.llm_executor.submit(self._load_model)
+        loading = self._model_loading
+        try:
+            # shield: отмена реплики не должна отменять общую загрузку
+            model = await asyncio.shield(loading)
+        except Exception:
+            # Следующий запрос попробует загрузить заново
+            if self._model_loading is loading:
+                self._model_loading = None
+            raise
+        self.model = model
+        return model
+    
+    async def warm_up(self) -> bool:
+        """Загружает клиента и устанавливает соединение с API заранее.
+        
+        Возвращает True, если соединение проверено (для заглушки - всегда).
+        """
+        await self.get_model()
+        if self.fake:
+            return True
+        if not self.api_key or not config.LLM_WARM_UP:
+            return False
+        
+        import google.generativeai as genai
+        # Запрос описания модели не тратит токены, но открывает канал к API
+        await asyncio.wait_for(self.llm_executor.submit(genai.get_model, f"models/{MODEL_NAME}"), self.timeout)
+        return True
     
-    async def get_response(self, user_input: str) -> str:
+    async def get_response(self, user_input: str, session: SessionState) -> str:
         """Получает ответ от Gemini на пользовательский ввод"""
         try:
-            # Добавляем пользовательский ввод в историю
-            self.conversation_history.append({
-                "role": "user",
-                "content": user_input
-            })
+            cache_key = self._cache_key(session.context, user_input)
             
-            # Формируем промпт с контекстом
-            prompt = self._build_prompt(user_input)
+            # Добавляем пользовательский ввод в историю и формируем промпт с контекстом
+            session.context.add("user", user_input)
+            prompt = self._build_prompt(session.context)
             
-            # Получаем ответ от Gemini
-            response = await self._generate_response(prompt)
+            # Получаем ответ от Gemini (или из кэша / одновременного такого же запроса)
+            if cache_key is None:
+                response = await self._generate_response(prompt)
+            else:
+                response = await self.response_cache.get_or_generate(
+                    cache_key, lambda: self._generate_response(prompt)
+                )
             
             # Добавляем ответ в историю
-            self.conversation_history.append({
-                "role": "assistant", 
-                "content": response
-            })
-            
-            # Ограничиваем историю последними 10 сообщениями
-            if len(self.conversation_history) > 10:
-                self.conversation_history = self.conversation_history[-10:]
+            self._remember_response(session.context, response)
             
             return response
             
         except Exception as e:
             logger.error(f"Ошибка получения ответа от Gemini: {e}")
-            return "Извините, произошла ошибка при обработке вашего запроса."
+            return LLM_APOLOGY
     
-    def _build_prompt(self, user_input: str) -> str:
-        """Формирует промпт с учетом истории разговора"""
-        prompt_parts = [self.system_prompt]
+    async def stream_response(self, user_input: str, session: SessionState) -> AsyncIterator[str]:
+        """Получает ответ от Gemini по частям, по мере генерации"""
+        cache_key = self._cache_key(session.context, user_input)
         
-        # Добавляем последние несколько сообщений для контекста
-        recent_history = self.conversation_history[-6:]  # Последние 6 сообщений
+        # Добавляем пользовательский ввод в историю
+        session.context.add("user", user_input)
+        prompt = self._build_prompt(session.context)
         
-        for message in recent_history:
-            if message["role"] == "user":
-                prompt_parts.append(f"Пользователь: {message['content']}")
+        parts = []
+        try:
+            cached = None
+            if cache_key is not None:
+                try:
+                    # Такой же запрос уже выполняется - ждем его ответ целиком.
+                    # Если ведущего перебьют, join вернет None и ведущими станем мы
+                    cached = await self.response_cache.join(cache_key)
+                except Exception as e:
+                    logger.error(f"Ошибка ответа от Gemini: {e}")
+                    cached = LLM_APOLOGY
+        
+            if cached is not None:
+                parts.append(cached)
+                yield cached
             else:
-                prompt_parts.append(f"Ассистент: {message['content']}")
+                completed = failed = False
+                try:
+                    async for delta in self._generate_stream(prompt):
+                        parts.append(delta)
+                        yield delta
+                    completed = True
+                except Exception as e:
+                    failed = True
+                    logger.error(f"Ошибка потокового ответа от Gemini: {e}")
+                    if not parts:
+                        parts.append(LLM_APOLOGY)
+                        yield LLM_APOLOGY
+                finally:
+                    # Оборванный или неудачный ответ в кэш не попадает. Если реплику
+                    # прервали, ждущие не получают ошибку: один из них спросит модель сам
+                    if cache_key is not None:
+                        if completed:
+                            self.response_cache.finish(cache_key, "".join(parts).strip())
+                        elif failed:
+                            self.response_cache.finish(cache_key, None)
+                        else:
+                            self.response_cache.abandon(cache_key)
+        finally:
+            # Добавляем ответ в историю - и прерванный тоже (то, что успели сказать)
+            if parts:
+                self._remember_response(session.context, "".join(parts).strip())
+    
+    def _cache_key(self, context: ConversationContext, user_input: str) -> Optional[str]:
+        """Ключ кэша ответа для реплики (None, если кэш выключен)"""
+        if self.response_cache is None:
+            return None
+        window = context.recent(self.response_cache.history_window)
+        return self.response_cache.make_key(user_input, window, self.system_prompt)
+    
+    def _remember_response(self, context: ConversationContext, response: str):
+        """Добавляет ответ в контекст и запускает свертку вытесненной истории"""
+        context.add("assistant", response)
+        
+        if not context.needs_summary:
+            return
         
-        prompt_parts.append(f"Пользователь: {user_input}")
-        prompt_parts.append("Ассистент:")
+        if not config.LLM_SUMMARIZE:
+            # Свертка выключена - вытесненные сообщения просто забываются
+            context.take_pending()
+            return
         
-        return "\n".join(prompt_parts)
+        context.summary_task = asyncio.create_task(self._summarize(context))
+    
+    async def _summarize(self, context: ConversationContext):
+        """Сворачивает вытесненные сообщения в краткое содержание (в фоне)"""
+        while context.pending:
+            turns = context.take_pending()
+            lines = [SUMMARY_PROMPT.format(words=context.summary_tokens // 2)]
+            if context.summary:
+                lines.append(f"Прежнее краткое содержание: {context.summary}")
+            lines.extend(turn.line for turn in turns)
+            
+            try:
+                summary = await self._generate_response("\n".join(lines))
+            except asyncio.CancelledError:
+                # Сессию закрывают (settle_summary) - сообщения вернутся в снимок.
+                # После clear() задача уже отвязана от контекста, возвращать некуда
+                if context.summary_task is asyncio.current_task():
+                    context.return_pending(turns)
+                raise
+            except Exception as e:
+                # Сообщения остаются в pending (и в снимке); повтор - не на каждой реплике
+                context.return_pending(turns)
+                context.summary_failed()
+                logger.error(f"Не удалось свернуть историю разговора "
+                             f"(попытка {context.summary_failures}): {e}")
+                return
+            
+            # set_summary может вытеснить еще сообщения - тогда цикл свернет и их
+            context.set_summary(summary)
+            logger.info(f"История свернута: {len(turns)} сообщений, "
+                        f"в контексте {len(context)} сообщений ({context.tokens} токенов)")
+    
+    def _build_prompt(self, context: ConversationContext) -> str:
+        """Формирует промпт с учетом истории разговора (последняя реплика уже в контексте)"""
+        return context.build_prompt(self.system_prompt)
     
     async def _generate_response(self, prompt: str) -> str:
         """Генерирует ответ от Gemini"""
         try:
-            # Используем asyncio для неблокирующего вызова
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None, 
-                lambda: self.model.generate_content(prompt)
-            )
+            model = await self.get_model()
+            if self.async_client:
+                started = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(prompt),
+                        self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    raise StageTimeoutError(f"llm: превышен таймаут {self.timeout} с")
+                STAGE_SECONDS.observe(time.perf_counter() - started, "llm")
+            else:
+                # Пул llm сам замеряет длительность этапа
+                response = await self.llm_executor.run(model.generate_content, prompt)
             
             return response.text.strip()
             
@@ -102,19 +277,109 @@ class GeminiService:
             logger.error(f"Ошибка генерации ответа: {e}")
             raise
     
-    def clear_history(self):
-        """Очищает историю разговора"""
-        self.conversation_history.clear()
+    async def _generate_stream(self, prompt: str) -> AsyncIterator[str]:
+        """Генерирует ответ от Gemini потоком.
+        
+        Таймаут LLM_TIMEOUT действует на ожидание каждого следующего фрагмента.
+        """
+        started = time.perf_counter()
+        first = True
+        model = await self.get_model()
+        source = self._generate_stream_async(model, prompt) if self.async_client \
+            else self._generate_stream_threaded(model, prompt)
+        
+        async for text in source:
+            if first:
+                first = False
+                STAGE_SECONDS.observe(time.perf_counter() - started, "llm_first_token")
+            yield text
+        
+        STAGE_SECONDS.observe(time.perf_counter() - started, "llm_stream")
+    
+    async def _generate_stream_async(self, model, prompt: str) -> AsyncIterator[str]:
+        """Потоковый ответ через нативный async клиент SDK"""
+        try:
+            response = await asyncio.wait_for(
+                model.generate_content_async(prompt, stream=True),
+                self.timeout
+            )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                text = chunk.text
+                if text:
+                    yield text
+        except asyncio.TimeoutError:
+            raise StageTimeoutError(f"llm: превышен таймаут {self.timeout} с")
+    
+    async def _generate_stream_threaded(self, model, prompt: str) -> AsyncIterator[str]:
+        """Потоковый ответ без async клиента.
+        
+        Блокирующий generate_content(stream=True) читается в потоке пула llm,
+        фрагменты передаются в event loop через очередь.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+        
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # Event loop уже закрыт
+                pass
+        
+        def produce():
+            try:
+                for chunk in model.generate_content(prompt, stream=True):
+                    if stop.is_set():
+                        # Ответ больше никому не нужен - прекращаем чтение
+                        break
+                    text = chunk.text
+                    if text:
+                        put(text)
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+        
+        self.llm_executor.submit(produce)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.timeout)
+                except asyncio.TimeoutError:
+                    raise StageTimeoutError(f"llm: превышен таймаут {self.timeout} с")
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+    
+    def clear_history(self, session_id: str = "default"):
+        """Очищает историю разговора сессии"""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.context.clear()
     
-    def get_conversation_summary(self) -> str:
+    def get_conversation_summary(self, session_id: str = "default") -> str:
         """Возвращает краткое содержание разговора"""
-        if not self.conversation_history:
+        session = self.sessions.get(session_id)
+        if session is None or not session.context:
             return "Разговор еще не начался."
         
         summary = []
-        for message in self.conversation_history[-5:]:  # Последние 5 сообщений
-            role = "Вы" if message["role"] == "user" else "ИИ"
-            content = message["content"][:100] + "..." if len(message["content"]) > 100 else message["content"]
+        if session.context.summary:
+            summary.append(f"Ранее: {session.context.summary}")
+        for turn in session.context.recent(5):  # Последние 5 сообщений
+            role = "Вы" if turn.role == "user" else "ИИ"
+            content = turn.content[:100] + "..." if len(turn.content) > 100 else turn.content
             summary.append(f"{role}: {content}")
         
         return "\n".join(summary) 
\ No newline at end of file
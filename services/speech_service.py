@@ -1,129 +1,353 @@
-import speech_recognition as sr
-from gtts import gTTS
 import io
 import logging
+import shutil
 import asyncio
-from typing import Optional
-from pydub import AudioSegment
-import tempfile
-import os
+import threading
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+
+from services.fake_backends import FakeLatency, FakeRecognizer, FakeSynthesizer, parse_fake_backends
+from services.audio_decoder import AudioDecoder, AudioDecodeError, AudioTooLongError, run_ffmpeg
+from utils.tts_cache import TTSCache
+from utils.stage_executor import StageExecutor, StageTimeoutError
+from utils.pcm_buffer import wav_header
+from config import config
 
 logger = logging.getLogger(__name__)
 
+# gTTS отдает MP3 моно 24 кГц
+TTS_SAMPLE_RATE = 24000
+
+# speech_recognition и gtts импортируются при первом использовании (в потоках пулов
+# или при фоновом прогреве), чтобы не задерживать старт сервера
+PROVIDER_MODULES = ("speech_recognition", "gtts")
+
+class RecognitionServiceError(Exception):
+    """Сервис распознавания речи вернул ошибку"""
+
 class SpeechService:
     """Сервис для работы с распознаванием и синтезом речи"""
     
+    DEFAULT_ENERGY_THRESHOLD = 300
+    
     def __init__(self):
-        # Инициализация распознавателя речи
-        self.recognizer = sr.Recognizer()
+        # Распознавание целиком выполняется в отдельном пуле, а не в event loop.
+        # У каждого потока пула свой Recognizer - их состояние не смешивается
+        self.stt_executor = StageExecutor("stt", config.STT_WORKERS, config.STT_TIMEOUT)
+        self._local = threading.local()
+        
+        # Калибровка по шуму: "session" - один раз на сессию, "turn" - каждую реплику, "off"
+        self.calibration = config.STT_CALIBRATION
+        
+        # Синтез - в своем пуле, чтобы медленный gTTS не занимал потоки других этапов
+        self.tts_executor = StageExecutor("tts", config.TTS_WORKERS, config.TTS_TIMEOUT)
+        
+        # Сколько предложений одного ответа синтезируется одновременно
+        self.tts_parallelism = config.TTS_PARALLELISM
+        
+        # Голос gTTS задается доменом Google Translate (акцент)
+        self.tts_voice = config.TTS_VOICE
+        
+        # Кэш синтеза: повторяющиеся фразы не синтезируются заново.
+        # Чтение и запись диска - в своем небольшом пуле, чтобы попадание не ждало gTTS
+        self.tts_disk_executor = StageExecutor("tts_disk", 2, config.TTS_TIMEOUT)
+        self.tts_cache = TTSCache(
+            max_bytes=config.TTS_CACHE_MAX_BYTES,
+            disk_dir=config.TTS_CACHE_DIR or None,
+            disk_max_bytes=config.TTS_CACHE_DISK_MAX_BYTES,
+            executor=self.tts_disk_executor
+        )
+        
+        # Заранее озвученные фиксированные фразы: (текст, язык, формат) -> аудио, не вытесняются
+        self.prerendered: Dict[Tuple[str, str, str], bytes] = {}
+        
+        # Тишина для ответа при ошибке синтеза готовится один раз
+        self._silence_audio: Dict[int, bytes] = {}
+        self._create_silence_audio()
+        
+        # Заглушки Google STT и gTTS для бенчмарков (FAKE_BACKENDS)
+        fake_backends = parse_fake_backends(config.FAKE_BACKENDS)
+        self.fake_recognizer: Optional[FakeRecognizer] = None
+        if "stt" in fake_backends:
+            self.fake_recognizer = FakeRecognizer(FakeLatency(config.FAKE_STT_MS, config.FAKE_JITTER))
+        self.fake_synthesizer: Optional[FakeSynthesizer] = None
+        if "tts" in fake_backends:
+            self.fake_synthesizer = FakeSynthesizer(
+                FakeLatency(config.FAKE_TTS_MS, config.FAKE_JITTER), TTS_SAMPLE_RATE
+            )
+        
+        # Декодирование входящего аудио в WAV 16 кГц моно - в памяти, в ограниченном пуле
+        self.decoder = AudioDecoder(
+            sample_rate=config.SAMPLE_RATE,
+            max_workers=config.DECODE_WORKERS,
+            timeout=config.DECODE_TIMEOUT,
+            max_duration=config.MAX_UTTERANCE_SECONDS
+        )
+    
+    def _create_recognizer(self) -> "sr.Recognizer":
+        """Создает распознаватель с нашими настройками"""
+        import speech_recognition as sr
+        recognizer = sr.Recognizer()
         
         # Настройки для лучшего распознавания
-        self.recognizer.energy_threshold = 300
-        self.recognizer.dynamic_energy_threshold = True
-        self.recognizer.pause_threshold = 0.8
-        self.recognizer.non_speaking_duration = 0.5
+        recognizer.energy_threshold = self.DEFAULT_ENERGY_THRESHOLD
+        recognizer.dynamic_energy_threshold = True
+        recognizer.pause_threshold = 0.8
+        recognizer.non_speaking_duration = 0.5
+        return recognizer
     
-    async def speech_to_text(self, audio_data: bytes) -> Optional[str]:
-        """Конвертирует аудио в текст"""
+    def _get_worker_recognizer(self) -> "sr.Recognizer":
+        """Возвращает распознаватель текущего потока пула"""
+        recognizer = getattr(self._local, "recognizer", None)
+        if recognizer is None:
+            recognizer = self._create_recognizer()
+            self._local.recognizer = recognizer
+        return recognizer
+    
+    async def speech_to_text(self, audio_data: bytes, session=None, trimmed: bool = False) -> Optional[str]:
+        """Конвертирует аудио в текст.
+        
+        session (SessionState) хранит калибровку по шуму между репликами.
+        trimmed=True - запись обрезана VAD до речи: тишины для калибровки
+        в начале нет, поэтому калибровка пропускается.
+        """
         try:
-            # Создаем временный файл для аудио
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_file:
-                tmp_file.write(audio_data)
-                tmp_file_path = tmp_file.name
+            # Браузер присылает WebM/Opus - приводим к WAV в памяти, без временных файлов
+            wav_data = await self.decoder.decode(audio_data)
             
-            try:
-                # Загружаем аудио в SpeechRecognition
-                with sr.AudioFile(tmp_file_path) as source:
-                    # Настройка для шумоподавления
-                    self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                    audio = self.recognizer.record(source)
-                
-                # Распознаем речь с помощью Google Speech Recognition
-                loop = asyncio.get_event_loop()
-                text = await loop.run_in_executor(
-                    None,
-                    lambda: self.recognizer.recognize_google(
-                        audio, 
-                        language='ru-RU'
-                    )
-                )
-                
-                logger.info(f"Распознанный текст: {text}")
-                return text
-                
-            finally:
-                # Удаляем временный файл
-                if os.path.exists(tmp_file_path):
-                    os.unlink(tmp_file_path)
+            energy_threshold = None
+            if self.calibration == "session" and session is not None:
+                energy_threshold = session.stt_energy_threshold
+            
+            # Чтение, калибровка и распознавание - в пуле STT, event loop свободен
+            text, energy_threshold = await self.stt_executor.run(
+                self._transcribe,
+                wav_data,
+                energy_threshold,
+                not trimmed
+            )
+            
+            if self.calibration == "session" and session is not None and energy_threshold is not None:
+                session.stt_energy_threshold = energy_threshold
+            
+            if text is None:
+                logger.warning("Не удалось распознать речь")
+                return None
+            
+            logger.info(f"Распознанный текст: {text}")
+            return text
                     
-        except sr.UnknownValueError:
-            logger.warning("Не удалось распознать речь")
+        except AudioTooLongError:
+            # Об этом нужно сказать пользователю отдельно - пробрасываем
+            raise
+        except AudioDecodeError as e:
+            logger.error(f"Не удалось декодировать аудио: {e}")
             return None
-        except sr.RequestError as e:
+        except StageTimeoutError as e:
+            logger.error(f"Распознавание речи прервано: {e}")
+            return None
+        except RecognitionServiceError as e:
             logger.error(f"Ошибка сервиса распознавания речи: {e}")
             return None
         except Exception as e:
             logger.error(f"Ошибка при распознавании речи: {e}")
             return None
     
-    async def text_to_speech(self, text: str, lang: str = 'ru') -> bytes:
-        """Конвертирует текст в аудио"""
+    def _transcribe(self, wav_data: bytes, energy_threshold: Optional[float],
+                    calibrate: bool = True) -> Tuple[Optional[str], Optional[float]]:
+        """Распознает WAV (выполняется в потоке пула STT).
+        
+        Возвращает текст (None, если речь не распознана) и порог энергии,
+        с которым шло распознавание (None, если калибровки не было).
+        """
+        import speech_recognition as sr
+        recognizer = self._get_worker_recognizer()
+        
+        if energy_threshold is not None:
+            # Калибровка уже есть - не тратим на нее 0.5 с записи
+            recognizer.energy_threshold = energy_threshold
+        else:
+            # Калибруемся с нуля, не наследуя порог чужой сессии
+            recognizer.energy_threshold = self.DEFAULT_ENERGY_THRESHOLD
+            if calibrate and self.calibration != "off":
+                # Калибровка читает начало записи, а AudioFile не перематывается -
+                # открываем файл отдельно, чтобы record() получил запись целиком
+                with sr.AudioFile(io.BytesIO(wav_data)) as source:
+                    recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                energy_threshold = recognizer.energy_threshold
+        
+        with sr.AudioFile(io.BytesIO(wav_data)) as source:
+            audio = recognizer.record(source)
+        
+        # Распознаем речь с помощью Google Speech Recognition
+        backend = self.fake_recognizer or recognizer
         try:
-            # Создаем TTS объект
-            tts = gTTS(text=text, lang=lang, slow=False)
-            
-            # Сохраняем в буфер
-            audio_buffer = io.BytesIO()
-            
-            # Генерируем аудио в отдельном потоке
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: tts.write_to_fp(audio_buffer)
-            )
-            
-            # Возвращаем в начало буфера
-            audio_buffer.seek(0)
-            audio_data = audio_buffer.getvalue()
-            
-            # Конвертируем MP3 в WAV для лучшей совместимости
-            audio_segment = AudioSegment.from_mp3(io.BytesIO(audio_data))
-            
-            # Экспортируем как WAV
-            wav_buffer = io.BytesIO()
-            audio_segment.export(wav_buffer, format="wav")
-            wav_buffer.seek(0)
-            
-            logger.info(f"Сгенерировано аудио для текста: {text[:50]}...")
-            return wav_buffer.getvalue()
+            text = backend.recognize_google(audio, language='ru-RU')
+        except sr.UnknownValueError:
+            return None, energy_threshold
+        except sr.RequestError as e:
+            raise RecognitionServiceError(str(e)) from e
+        return text, energy_threshold
+    
+    def supported_output_formats(self) -> List[str]:
+        """Форматы ответа, которые сервер может отдать, в порядке предпочтения"""
+        if self.fake_synthesizer is not None:
+            # Заглушка синтеза отдает только WAV
+            return ["wav"]
+        formats = ["mp3"]
+        if shutil.which("ffmpeg"):
+            formats.append("opus")
+        formats.append("wav")
+        return formats
+    
+    def choose_output_format(self, requested: Optional[Iterable[str]]) -> str:
+        """Выбирает первый поддерживаемый формат из списка клиента (по умолчанию WAV)"""
+        supported = self.supported_output_formats()
+        for fmt in requested or ():
+            if isinstance(fmt, str) and fmt.lower() in supported:
+                return fmt.lower()
+        return "wav"
+    
+    async def text_to_speech(self, text: str, lang: str = 'ru', output_format: str = "wav") -> bytes:
+        """Конвертирует текст в аудио в формате output_format (wav, mp3, opus)"""
+        # Фиксированные фразы подготовлены при старте
+        prerendered = self.prerendered.get((text, lang, output_format))
+        if prerendered is not None:
+            return prerendered
+        
+        try:
+            return await self._render(text, lang, output_format)
             
         except Exception as e:
             logger.error(f"Ошибка при синтезе речи: {e}")
-            # Возвращаем пустой аудио файл в случае ошибки
-            return self._create_silence_audio()
+            # Тишина есть только в WAV; для сжатых форматов ответ пропускается
+            return self._create_silence_audio() if output_format == "wav" else b""
     
-    def _create_silence_audio(self, duration_ms: int = 1000) -> bytes:
-        """Создает аудио файл с тишиной"""
+    async def _render(self, text: str, lang: str, output_format: str = "wav") -> bytes:
+        """Синтезирует речь с учетом кэша; ошибки пробрасываются"""
+        cache_key = TTSCache.make_key(text, lang, self.tts_voice, output_format)
+        cached = await self.tts_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Синтез и перекодирование выполняются в пуле TTS,
+        # чтобы несколько предложений могли синтезироваться параллельно
+        audio_data = await self.tts_executor.run(self._synthesize, text, lang, output_format)
+        self.tts_cache.put(cache_key, audio_data)
+        
+        logger.info(f"Сгенерировано аудио ({output_format}) для текста: {text[:50]}...")
+        return audio_data
+    
+    async def prerender(self, texts: Iterable[str], lang: str = 'ru',
+                        output_format: str = "wav") -> Dict[str, bytes]:
+        """Синтезирует фиксированные фразы один раз и закрепляет их в памяти"""
+        texts = list(texts)
+        results = await asyncio.gather(
+            *(self._render(text, lang, output_format) for text in texts),
+            return_exceptions=True
+        )
+        
+        rendered = {}
+        for text, result in zip(texts, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось заранее озвучить \"{text}\": {result}")
+                continue
+            self.prerendered[(text, lang, output_format)] = result
+            rendered[text] = result
+        
+        return rendered
+    
+    def _synthesize(self, text: str, lang: str, output_format: str = "wav") -> bytes:
+        """Синтезирует речь в нужном формате (выполняется в потоке)"""
+        if self.fake_synthesizer is not None:
+            return self.fake_synthesizer.synthesize(text)
+        
+        from gtts import gTTS
+        
+        # Создаем TTS объект
+        tts = gTTS(text=text, lang=lang, tld=self.tts_voice, slow=False)
+        
+        # Сохраняем в буфер
+        audio_buffer = io.BytesIO()
+        tts.write_to_fp(audio_buffer)
+        
+        # gTTS отдает MP3 - если клиент его понимает, отправляем как есть
+        if output_format == "mp3":
+            return audio_buffer.getvalue()
+        
+        if output_format == "opus":
+            return run_ffmpeg(
+                audio_buffer.getvalue(),
+                ["-vn", "-ac", "1", "-c:a", "libopus", "-b:a", "32k", "-f", "webm"]
+            )
+        
+        # WAV для клиентов без поддержки сжатых форматов: ffmpeg пишет в pipe
+        # заголовок без размеров, поэтому берем сырой PCM и добавляем свой
+        pcm = run_ffmpeg(
+            audio_buffer.getvalue(),
+            ["-vn", "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(TTS_SAMPLE_RATE)]
+        )
+        return wav_header(len(pcm), TTS_SAMPLE_RATE) + pcm
+    
+    async def stream_speech(self, sentences: Union[Iterable[str], AsyncIterable[str]],
+                            lang: str = 'ru', output_format: str = "wav") -> AsyncIterator[bytes]:
+        """Синтезирует предложения параллельно и отдает аудио строго по порядку.
+        
+        Одновременно синтезируется не больше TTS_PARALLELISM предложений.
+        Первое предложение отдается, как только оно готово, не дожидаясь остальных.
+        """
+        semaphore = asyncio.Semaphore(self.tts_parallelism)
+        tasks: asyncio.Queue = asyncio.Queue()
+        
+        async def synthesize(sentence: str) -> bytes:
+            async with semaphore:
+                return await self.text_to_speech(sentence, lang, output_format)
+        
+        async def schedule():
+            # Запускаем синтез каждого предложения сразу по его появлению
+            try:
+                if hasattr(sentences, "__aiter__"):
+                    async for sentence in sentences:
+                        tasks.put_nowait(asyncio.create_task(synthesize(sentence)))
+                else:
+                    for sentence in sentences:
+                        tasks.put_nowait(asyncio.create_task(synthesize(sentence)))
+            finally:
+                tasks.put_nowait(None)
+        
+        scheduler = asyncio.create_task(schedule())
         try:
-            # Создаем тишину
-            silence = AudioSegment.silent(duration=duration_ms)
-            
-            # Экспортируем как WAV
-            buffer = io.BytesIO()
-            silence.export(buffer, format="wav")
-            buffer.seek(0)
+            while True:
+                task = await tasks.get()
+                if task is None:
+                    break
+                yield await task
             
-            return buffer.getvalue()
-            
-        except Exception as e:
-            logger.error(f"Ошибка создания аудио тишины: {e}")
-            return b''
+            # Пробрасываем ошибку источника предложений, если она была
+            await scheduler
+        finally:
+            # Клиент ушел или источник упал - отменяем оставшийся синтез
+            scheduler.cancel()
+            while not tasks.empty():
+                task = tasks.get_nowait()
+                if task is not None:
+                    task.cancel()
+    
+    def _create_silence_audio(self, duration_ms: int = 1000) -> bytes:
+        """Возвращает аудио файл с тишиной (создается один раз на длительность)"""
+        silence = self._silence_audio.get(duration_ms)
+        if silence is None:
+            # Заголовок WAV + нулевые семплы, без pydub и ffmpeg
+            data_size = int(config.SAMPLE_RATE * duration_ms / 1000) * 2
+            silence = wav_header(data_size, config.SAMPLE_RATE) + bytes(data_size)
+            self._silence_audio[duration_ms] = silence
+        return silence
     
     async def test_microphone(self) -> bool:
         """Тестирует доступность микрофона"""
         try:
+            import speech_recognition as sr
             with sr.Microphone() as source:
-                self.recognizer.adjust_for_ambient_noise(source, duration=1)
+                self._create_recognizer().adjust_for_ambient_noise(source, duration=1)
                 return True
         except Exception as e:
             logger.error(f"Микрофон недоступен: {e}")
@@ -132,6 +356,7 @@ class SpeechService:
     def get_available_microphones(self) -> list:
         """Возвращает список доступных микрофонов"""
         try:
+            import speech_recognition as sr
             return sr.Microphone.list_microphone_names()
         except Exception as e:
             logger.error(f"Ошибка получения списка микрофонов: {e}")
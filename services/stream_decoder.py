@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import shutil
+import time
+from typing import Callable, Optional
+
+from services.audio_decoder import AudioDecoder, AudioDecodeError
+from utils.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+class DecoderUnavailableError(RuntimeError):
+    """ffmpeg не найден, потоковое декодирование невозможно"""
+
+class StreamDecoderLimiter:
+    """Ограничение числа одновременных процессов ffmpeg потокового декодирования.
+
+    Процесс живет всю реплику, но почти все время ждет входных данных,
+    поэтому предел отдельный от пула decode. Сверх предела поток копится
+    в памяти и декодируется в пуле decode, когда запись закончена.
+    Вызывается только из event loop.
+    """
+
+    def __init__(self, max_decoders: int):
+        self.max_decoders = max_decoders
+        self.active = 0
+        self.started = 0
+        self.deferred = 0  # потоки, отложенные до конца записи
+
+    def acquire(self) -> bool:
+        if self.active >= self.max_decoders:
+            self.deferred += 1
+            return False
+        self.active += 1
+        self.started += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "max_decoders": self.max_decoders,
+            "active": self.active,
+            "started": self.started,
+            "deferred": self.deferred,
+        }
+
+class StreamingDecoder:
+    """Инкрементальный декодер аудио потока в PCM 16 бит моно.
+
+    Сжатые чанки (WebM/Opus от MediaRecorder) подаются в stdin процесса
+    ffmpeg по мере поступления, а PCM читается из stdout параллельно.
+    Поэтому декодирование идет, пока пользователь еще говорит.
+    Для сырого PCM ffmpeg не запускается.
+
+    Если limiter не дает запустить еще один процесс, сжатый поток копится
+    и декодируется через fallback (AudioDecoder) в finish. Серверный VAD
+    в этом случае видит речь только после конца записи.
+
+    PCM отдается в on_pcm кусками, кратными frame_bytes, чтобы фреймы VAD
+    не разрывались на границах чанков.
+    """
+
+    READ_SIZE = 16384
+
+    def __init__(self, on_pcm: Callable[[bytes], None], sample_rate: int = 16000,
+                 frame_bytes: int = 960, passthrough: bool = False,
+                 limiter: Optional[StreamDecoderLimiter] = None, fallback: Optional[AudioDecoder] = None):
+        self.on_pcm = on_pcm
+        self.sample_rate = sample_rate
+        self.frame_bytes = frame_bytes
+        self.passthrough = passthrough
+        self.limiter = limiter
+        self.fallback = fallback
+
+        # Поток, отложенный до конца записи (нет свободного слота ffmpeg)
+        self._pending: Optional[bytearray] = None
+        self._has_slot = False
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._remainder = b""
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @staticmethod
+    def is_available() -> bool:
+        """Проверяет наличие ffmpeg"""
+        return shutil.which("ffmpeg") is not None
+
+    async def start(self):
+        """Запускает процесс декодирования"""
+        if self.passthrough:
+            return
+
+        if not self.is_available():
+            raise DecoderUnavailableError("ffmpeg не найден")
+
+        if self.limiter is not None:
+            if not self.limiter.acquire():
+                if self.fallback is None:
+                    raise DecoderUnavailableError("нет свободного декодера")
+                logger.info("Все потоковые декодеры заняты - поток декодируется после конца записи")
+                self._pending = bytearray()
+                return
+            self._has_slot = True
+
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0",
+                "-f", "s16le", "-acodec", "pcm_s16le",
+                "-ac", "1", "-ar", str(self.sample_rate),
+                "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        except BaseException:
+            self._release()
+            raise
+        self._reader_task = asyncio.create_task(self._read_pcm())
+
+    async def feed(self, data: bytes):
+        """Передает очередной чанк в декодер"""
+        self.bytes_in += len(data)
+
+        if self.passthrough:
+            self._emit(data)
+            return
+
+        if self._pending is not None:
+            self._pending += data
+            return
+
+        if self._process is None or self._process.stdin.is_closing():
+            return
+
+        try:
+            self._process.stdin.write(data)
+            await self._process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.error(f"Декодер прервал поток: {e}")
+
+    async def finish(self):
+        """Завершает поток и дожидается оставшегося PCM"""
+        started = time.perf_counter()
+        if self._pending is not None:
+            data, self._pending = bytes(self._pending), None
+            try:
+                # Пул decode сам замеряет этап и ограничивает число процессов
+                self._emit(await self.fallback.decode_pcm(data))
+            except AudioDecodeError as e:
+                logger.error(f"Не удалось декодировать отложенный поток: {e}")
+        elif self._process is not None:
+            if not self._process.stdin.is_closing():
+                self._process.stdin.close()
+            if self._reader_task is not None:
+                await self._reader_task
+            await self._process.wait()
+            self._process = None
+            self._release()
+            # Сколько реплика ждала хвост декодирования после конца записи
+            STAGE_SECONDS.observe(time.perf_counter() - started, "stream_decode")
+
+        self._flush_remainder()
+
+    async def abort(self):
+        """Прерывает декодирование без ожидания результата"""
+        self._pending = None
+        self._remainder = b""
+        # Слот освобождается сразу: процесс уже убит, ждать осталось только его завершения
+        self._release()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._process is not None and self._process.returncode is None:
+            try:
+                self._process.kill()
+            except ProcessLookupError:
+                pass
+            await self._process.wait()
+        self._process = None
+
+    def _release(self):
+        """Возвращает слот ограничителя (один раз)"""
+        if self._has_slot:
+            self._has_slot = False
+            self.limiter.release()
+
+    async def _read_pcm(self):
+        """Читает PCM из stdout ffmpeg по мере готовности"""
+        try:
+            while True:
+                chunk = await self._process.stdout.read(self.READ_SIZE)
+                if not chunk:
+                    break
+                self._emit(chunk)
+        except Exception as e:
+            logger.error(f"Ошибка чтения PCM из декодера: {e}")
+
+    def _emit(self, data: bytes):
+        """Отдает PCM кусками, кратными размеру фрейма"""
+        if self._remainder:
+            data = self._remainder + data
+
+        aligned = len(data) - len(data) % self.frame_bytes
+        self._remainder = bytes(data[aligned:])
+
+        if aligned:
+            self.bytes_out += aligned
+            self.on_pcm(data[:aligned])
+
+    def _flush_remainder(self):
+        """Отдает последний неполный фрейм"""
+        if self._remainder:
+            self.bytes_out += len(self._remainder)
+            self.on_pcm(self._remainder)
+            self._remainder = b""
@@ -3,6 +3,7 @@
 Скрипт запуска Voice-to-Voice ИИ Агента
 """
 
+import importlib.util
 import os
 import sys
 import logging
@@ -24,17 +25,21 @@ def check_dependencies():
         'google.generativeai',
         'speech_recognition',
         'gtts',
-        'pydub',
         'webrtcvad',
         'numpy'
     ]
     
     missing_packages = []
     
+    # find_spec только ищет пакет, не выполняя его: импорт google.generativeai
+    # и numpy здесь лишь задержал бы запуск, а сервер все равно загрузит их сам
     for package in required_packages:
         try:
-            __import__(package.replace('-', '_'))
+            found = importlib.util.find_spec(package) is not None
         except ImportError:
+            # Не найден родительский пакет (google для google.generativeai)
+            found = False
+        if not found:
             missing_packages.append(package)
     
     if missing_packages:
@@ -79,7 +84,12 @@ def start_server():
         import uvicorn
         from config import config
         
-        print(f"🚀 Запуск сервера на http://{config.HOST}:{config.PORT}")
+        workers = 1 if config.DEBUG else config.WORKERS  # reload работает только с одним процессом
+        if workers > 1 and config.SESSION_BACKEND == "memory":
+            print("⚠️  Несколько воркеров с SESSION_BACKEND=memory: разговор не переживет переподключение "
+                  "к другому воркеру, используйте SESSION_BACKEND=sqlite")
+        
+        print(f"🚀 Запуск сервера на http://{config.HOST}:{config.PORT} (воркеров: {workers})")
         print("📱 Откройте браузер и перейдите по адресу выше")
         print("🎤 Разрешите доступ к микрофону для начала работы")
         print("\n⏹️  Для остановки нажмите Ctrl+C")
@@ -89,7 +99,10 @@ def start_server():
             host=config.HOST,
             port=config.PORT,
             reload=config.DEBUG,
-            log_level=config.LOG_LEVEL.lower()
+            workers=workers,
+            log_level=config.LOG_LEVEL.lower(),
+            # Фреймы больше лимита реплики отклоняются еще на уровне протокола
+            ws_max_size=config.MAX_AUDIO_BYTES * 4 // 3 + 4096
         )
         
     except KeyboardInterrupt:
@@ -1,3 +1,40 @@
+// Бинарный аудио протокол (см. utils/audio_protocol.py)
+// Заголовок 4 байта: тип сообщения, кодек, порядковый номер (uint16, big-endian)
+const AudioProtocol = {
+    HEADER_SIZE: 4,
+    MSG_COMPLETE_AUDIO: 0x01,
+    MSG_AUDIO_RESPONSE: 0x02,
+    MSG_AUDIO_CHUNK: 0x03,
+    MSG_AUDIO_RESPONSE_CHUNK: 0x04,
+    CODEC_WEBM: 0x01,
+    CODEC_WAV: 0x02,
+    CODEC_MP3: 0x03,
+    MIME_TYPES: {
+        0x01: 'audio/webm',
+        0x02: 'audio/wav',
+        0x03: 'audio/mpeg'
+    },
+
+    header(msgType, codec, seq = 0) {
+        const header = new Uint8Array(this.HEADER_SIZE);
+        const view = new DataView(header.buffer);
+        view.setUint8(0, msgType);
+        view.setUint8(1, codec);
+        view.setUint16(2, seq & 0xFFFF);
+        return header;
+    },
+
+    parse(buffer) {
+        const view = new DataView(buffer);
+        return {
+            msgType: view.getUint8(0),
+            codec: view.getUint8(1),
+            seq: view.getUint16(2),
+            payload: new Uint8Array(buffer, this.HEADER_SIZE)
+        };
+    }
+};
+
 class VoiceChat {
     constructor() {
         this.ws = null;
@@ -7,7 +44,16 @@ class VoiceChat {
         this.isProcessing = false;
         this.isConnected = false;
         this.sessionId = null;
-        this.audioChunks = []; // Собираем все аудио здесь
+        this.audioChunks = []; // Собираем все аудио здесь (режим без потоковой загрузки)
+        this.streamUpload = true; // Отправляем аудио фрагментами во время записи
+        this.chunkSeq = 0;
+        this.chunkInterval = 250; // мс между фрагментами MediaRecorder
+        this.serverEndpointed = false; // Конец речи определил сервер (VAD)
+        this.playbackQueue = []; // Аудио предложений ответа в порядке воспроизведения
+        this.isPlaying = false;
+        this.responseComplete = false; // Сервер прислал все части ответа
+        this.streamingMessage = null; // Сообщение ИИ, которое еще дописывается
+        this.awaitingInterrupt = false; // Ответ прерван, ждем подтверждения от сервера
         
         this.initElements();
         this.connectWebSocket();
@@ -26,24 +72,47 @@ class VoiceChat {
 
     connectWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        // Сохраненный session_id продолжает разговор после перезагрузки страницы
+        const savedSessionId = sessionStorage.getItem('voiceChatSessionId');
+        const query = savedSessionId ? `?session_id=${encodeURIComponent(savedSessionId)}` : '';
+        const wsUrl = `${protocol}//${window.location.host}/ws${query}`;
         
         this.ws = new WebSocket(wsUrl);
+        this.ws.binaryType = 'arraybuffer';
         
         this.ws.onopen = () => {
             this.isConnected = true;
+            // Сообщаем серверу, что умеем принимать бинарные аудио фреймы
+            this.ws.send(JSON.stringify({
+                type: 'client_hello',
+                binary_audio: true,
+                stream_audio: true,
+                stream_text: true,
+                audio_formats: this.getAudioFormats()
+            }));
             this.updateStatus('waiting', '🎤 Нажмите микрофон чтобы начать говорить');
             this.updateConnectionInfo('Подключено');
         };
 
         this.ws.onmessage = (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                this.handleBinaryMessage(event.data);
+                return;
+            }
             const message = JSON.parse(event.data);
             this.handleMessage(message);
         };
 
-        this.ws.onclose = () => {
+        this.ws.onclose = (event) => {
             this.isConnected = false;
-            this.updateStatus('error', 'Соединение потеряно. Обновите страницу.');
+            // 4000 - сервер закрыл соединение из-за долгого бездействия,
+            // 4002 - разговор продолжен в другом соединении (другой вкладке)
+            const reasons = {
+                4000: 'Соединение закрыто из-за неактивности. Обновите страницу.',
+                4002: 'Разговор продолжен в другой вкладке.'
+            };
+            const reason = reasons[event.code] || 'Соединение потеряно. Обновите страницу.';
+            this.updateStatus('error', reason);
             this.updateConnectionInfo('Отключено');
         };
 
@@ -72,15 +141,10 @@ class VoiceChat {
     toggleRecording() {
         console.log(`Toggle recording - current state: recording=${this.isRecording}, processing=${this.isProcessing}`);
         
-        // Не позволяем начать запись если уже обрабатываем или говорит ИИ
-        if (this.isProcessing) {
-            console.log('Recording blocked - processing in progress');
-            // Визуально показываем что кнопка временно недоступна
-            this.micButton.style.transform = 'scale(0.95)';
-            setTimeout(() => {
-                this.micButton.style.transform = 'scale(1)';
-            }, 100);
-            return;
+        // ИИ еще отвечает - перебиваем его и сразу начинаем новую запись
+        if (this.isProcessing && !this.isRecording) {
+            console.log('Interrupting current response');
+            this.interrupt();
         }
         
         if (this.isRecording) {
@@ -109,26 +173,57 @@ class VoiceChat {
 
             // Очищаем предыдущие аудио данные
             this.audioChunks = [];
+            this.chunkSeq = 0;
+            this.serverEndpointed = false;
 
             // Настраиваем MediaRecorder (простой режим)
             this.mediaRecorder = new MediaRecorder(this.audioStream);
 
-            // Собираем ВСЕ аудио данные в массив
-            this.mediaRecorder.ondataavailable = (event) => {
-                if (event.data.size > 0) {
-                    console.log('Audio chunk received:', event.data.size, 'bytes');
-                    this.audioChunks.push(event.data);
-                }
-            };
-
-            // Когда запись завершена - отправляем все разом
-            this.mediaRecorder.onstop = () => {
-                console.log('MediaRecorder stopped, chunks count:', this.audioChunks.length);
-                this.sendCompleteAudio();
-            };
+            if (this.streamUpload) {
+                // Потоковый режим: сервер декодирует и слушает речь, пока мы записываем
+                this.ws.send(JSON.stringify({
+                    type: 'audio_start',
+                    codec: 'webm'
+                }));
 
-            // Начинаем запись (БЕЗ timeslice - записываем все подряд)
-            this.mediaRecorder.start();
+                this.mediaRecorder.ondataavailable = (event) => {
+                    if (event.data.size > 0) {
+                        // Копия записи - на случай, если сервер не сможет принять поток
+                        this.audioChunks.push(event.data);
+                        this.sendAudioChunk(event.data);
+                    }
+                };
+
+                this.mediaRecorder.onstop = () => {
+                    console.log('MediaRecorder stopped, chunks sent:', this.chunkSeq);
+                    if (!this.streamUpload) {
+                        // Сервер ответил stream_unavailable - отправляем запись целиком
+                        this.sendCompleteAudio();
+                    } else if (!this.serverEndpointed) {
+                        // Если конец речи определил сервер, реплика уже обрабатывается
+                        this.sendAudioEnd();
+                    }
+                };
+
+                this.mediaRecorder.start(this.chunkInterval);
+            } else {
+                // Собираем ВСЕ аудио данные в массив
+                this.mediaRecorder.ondataavailable = (event) => {
+                    if (event.data.size > 0) {
+                        console.log('Audio chunk received:', event.data.size, 'bytes');
+                        this.audioChunks.push(event.data);
+                    }
+                };
+
+                // Когда запись завершена - отправляем все разом
+                this.mediaRecorder.onstop = () => {
+                    console.log('MediaRecorder stopped, chunks count:', this.audioChunks.length);
+                    this.sendCompleteAudio();
+                };
+
+                // Начинаем запись (БЕЗ timeslice - записываем все подряд)
+                this.mediaRecorder.start();
+            }
             this.isRecording = true;
             console.log('Recording started');
             
@@ -215,6 +310,47 @@ class VoiceChat {
         updateVolume();
     }
 
+    interrupt() {
+        // Останавливаем воспроизведение и просим сервер прекратить генерацию
+        this.playbackQueue = [];
+        this.isPlaying = false;
+        this.audioPlayer.onended = null;
+        this.audioPlayer.pause();
+        this.streamingMessage = null;
+        this.isProcessing = false;
+
+        if (this.ws.readyState === WebSocket.OPEN) {
+            // Аудио старого ответа, пришедшее до подтверждения, игнорируется
+            this.awaitingInterrupt = true;
+            this.ws.send(JSON.stringify({
+                type: 'interrupt'
+            }));
+        }
+    }
+
+    sendAudioChunk(blob) {
+        if (this.ws.readyState !== WebSocket.OPEN) {
+            console.error('WebSocket not connected when trying to send audio chunk');
+            return;
+        }
+
+        const header = AudioProtocol.header(AudioProtocol.MSG_AUDIO_CHUNK, AudioProtocol.CODEC_WEBM, this.chunkSeq++);
+        this.ws.send(new Blob([header, blob]));
+    }
+
+    sendAudioEnd() {
+        if (this.ws.readyState !== WebSocket.OPEN) {
+            console.error('WebSocket not connected when trying to finish audio');
+            this.isProcessing = false;
+            this.updateStatus('error', 'Потеряно соединение с сервером');
+            return;
+        }
+
+        this.ws.send(JSON.stringify({
+            type: 'audio_end'
+        }));
+    }
+
     sendCompleteAudio() {
         if (this.audioChunks.length === 0) {
             console.error('No audio chunks to send');
@@ -227,43 +363,67 @@ class VoiceChat {
         const completeAudioBlob = new Blob(this.audioChunks, { type: 'audio/webm' });
         console.log('Complete audio blob size:', completeAudioBlob.size, 'bytes');
 
-        // Конвертируем в base64 и отправляем ОДНИМ сообщением
-        const reader = new FileReader();
-        reader.onload = () => {
-            const base64Audio = btoa(
-                new Uint8Array(reader.result).reduce(
-                    (data, byte) => data + String.fromCharCode(byte), 
-                    ''
-                )
-            );
-            
-            console.log('Sending complete audio to server, base64 length:', base64Audio.length);
-            
-            if (this.ws.readyState === WebSocket.OPEN) {
-                this.ws.send(JSON.stringify({
-                    type: 'complete_audio',
-                    data: base64Audio
-                }));
-            } else {
-                console.error('WebSocket not connected when trying to send audio');
-                this.isProcessing = false;
-                this.updateStatus('error', 'Потеряно соединение с сервером');
-            }
-        };
-        
-        reader.onerror = () => {
-            console.error('Failed to read audio blob');
+        if (this.ws.readyState !== WebSocket.OPEN) {
+            console.error('WebSocket not connected when trying to send audio');
             this.isProcessing = false;
-            this.updateStatus('error', 'Ошибка чтения аудио');
-        };
-        
-        reader.readAsArrayBuffer(completeAudioBlob);
+            this.updateStatus('error', 'Потеряно соединение с сервером');
+            return;
+        }
+
+        // Отправляем ОДНИМ бинарным фреймом: заголовок + сырые байты, без base64
+        const header = AudioProtocol.header(AudioProtocol.MSG_COMPLETE_AUDIO, AudioProtocol.CODEC_WEBM);
+        console.log('Sending complete audio to server, bytes:', completeAudioBlob.size);
+        this.ws.send(new Blob([header, completeAudioBlob]));
+    }
+
+    handleBinaryMessage(buffer) {
+        if (buffer.byteLength < AudioProtocol.HEADER_SIZE) {
+            console.error('Binary frame too short:', buffer.byteLength);
+            return;
+        }
+
+        const frame = AudioProtocol.parse(buffer);
+        if (this.awaitingInterrupt) {
+            // Хвост прерванного ответа
+            return;
+        }
+
+        switch (frame.msgType) {
+            case AudioProtocol.MSG_AUDIO_RESPONSE: {
+                const mimeType = AudioProtocol.MIME_TYPES[frame.codec] || 'audio/wav';
+                this.playAudioBlob(new Blob([frame.payload], { type: mimeType }));
+                break;
+            }
+            case AudioProtocol.MSG_AUDIO_RESPONSE_CHUNK: {
+                const mimeType = AudioProtocol.MIME_TYPES[frame.codec] || 'audio/wav';
+                this.enqueueAudio(new Blob([frame.payload], { type: mimeType }));
+                break;
+            }
+            default:
+                console.warn('Unknown binary message type:', frame.msgType);
+        }
     }
 
     handleMessage(message) {
+        if (this.awaitingInterrupt && ['ai_response_delta', 'ai_response', 'audio_response', 'audio_chunk',
+                'audio_response_end'].includes(message.type)) {
+            // Хвост прерванного ответа
+            return;
+        }
+
         switch (message.type) {
+            case 'ping':
+                // Heartbeat сервера: подтверждаем, что вкладка жива
+                this.ws.send(JSON.stringify({ type: 'pong' }));
+                break;
+
+            case 'interrupted':
+                this.awaitingInterrupt = false;
+                break;
+
             case 'connection_established':
                 this.sessionId = message.session_id;
+                sessionStorage.setItem('voiceChatSessionId', this.sessionId);
                 this.updateConnectionInfo(`Подключено (${this.sessionId})`);
                 break;
 
@@ -271,37 +431,158 @@ class VoiceChat {
                 this.updateStatus('listening', 'Обнаружена речь... Продолжайте говорить.');
                 break;
 
+            case 'speech_end':
+                // Сервер определил конец речи - останавливаем запись сами
+                this.serverEndpointed = true;
+                this.stopRecording();
+                break;
+
             case 'transcription':
                 this.addMessage('transcription', `Вы сказали: "${message.text}"`);
                 break;
 
+            case 'ai_response_delta':
+                // Показываем ответ по мере генерации
+                if (!this.streamingMessage) {
+                    this.responseComplete = false;
+                    this.streamingMessage = this.addMessage('ai', '');
+                    this.updateStatus('speaking', 'ИИ отвечает...');
+                }
+                this.streamingMessage.textContent += message.text;
+                this.conversation.scrollTop = this.conversation.scrollHeight;
+                break;
+
             case 'ai_response':
-                this.addMessage('ai', message.text);
-                this.updateStatus('speaking', 'ИИ отвечает...');
+                if (this.streamingMessage) {
+                    this.streamingMessage.textContent = message.text;
+                    this.streamingMessage = null;
+                } else {
+                    this.responseComplete = false;
+                    this.addMessage('ai', message.text);
+                    this.updateStatus('speaking', 'ИИ отвечает...');
+                }
                 break;
 
             case 'audio_response':
-                this.playAudioResponse(message.data);
+                this.playAudioResponse(message.data, message.mime_type);
+                break;
+
+            case 'audio_chunk':
+                // Часть ответа в JSON-режиме
+                this.enqueueAudio(this.base64ToBlob(message.data, message.mime_type || 'audio/wav'));
+                break;
+
+            case 'audio_response_end':
+                this.responseComplete = true;
+                if (!this.isPlaying && this.playbackQueue.length === 0) {
+                    this.finishPlayback();
+                }
+                break;
+
+            case 'busy':
+                if (message.reason === 'queued') {
+                    // Реплика ждет своей очереди на сервере
+                    this.updateStatus('processing', `Сервер занят, ожидание ~${Math.ceil(message.estimated_wait)} с...`);
+                } else {
+                    this.updateStatus('error', message.message || `Сервер перегружен, повторите через ~${Math.ceil(message.estimated_wait)} с`);
+                    this.isProcessing = false;
+                }
                 break;
 
             case 'error':
+                if (message.code === 'stream_unavailable') {
+                    // Сервер не может декодировать поток: дальше работаем без потоковой загрузки.
+                    // Идущая запись уйдет целиком в onstop, уже завершенная - сейчас
+                    console.warn('Streaming upload unavailable, falling back to complete_audio');
+                    this.streamUpload = false;
+                    if (!this.isRecording && this.audioChunks.length > 0) {
+                        this.sendCompleteAudio();
+                    }
+                    break;
+                }
                 this.updateStatus('error', message.message);
                 this.isProcessing = false; // Разблокируем после ошибки
                 break;
         }
     }
 
-    playAudioResponse(base64Audio) {
+    base64ToBlob(base64Audio, mimeType) {
+        const audioData = atob(base64Audio);
+        const view = new Uint8Array(audioData.length);
+        
+        for (let i = 0; i < audioData.length; i++) {
+            view[i] = audioData.charCodeAt(i);
+        }
+        
+        return new Blob([view], { type: mimeType });
+    }
+
+    getAudioFormats() {
+        // Форматы ответа в порядке предпочтения: сжатые экономят трафик,
+        // WAV остается запасным вариантом. MP3 первым - gTTS отдает его
+        // сам, и сервер не тратит ffmpeg на перекодирование
+        const probe = document.createElement('audio');
+        const formats = [];
+        if (probe.canPlayType('audio/mpeg')) {
+            formats.push('mp3');
+        }
+        if (probe.canPlayType('audio/webm; codecs=opus')) {
+            formats.push('opus');
+        }
+        formats.push('wav');
+        return formats;
+    }
+
+    playAudioResponse(base64Audio, mimeType = 'audio/wav') {
+        // JSON-режим (старый протокол): декодируем base64
         try {
-            const audioData = atob(base64Audio);
-            const arrayBuffer = new ArrayBuffer(audioData.length);
-            const view = new Uint8Array(arrayBuffer);
-            
-            for (let i = 0; i < audioData.length; i++) {
-                view[i] = audioData.charCodeAt(i);
+            this.playAudioBlob(this.base64ToBlob(base64Audio, mimeType));
+        } catch (error) {
+            console.error('Ошибка декодирования аудио:', error);
+            this.updateStatus('waiting', 'Готов к следующему вопросу');
+        }
+    }
+
+    enqueueAudio(blob) {
+        // Предложения ответа играются одно за другим по мере поступления
+        this.playbackQueue.push(blob);
+        if (!this.isPlaying) {
+            this.playNext();
+        }
+    }
+
+    playNext() {
+        const blob = this.playbackQueue.shift();
+        if (!blob) {
+            this.isPlaying = false;
+            if (this.responseComplete) {
+                this.finishPlayback();
             }
-            
-            const blob = new Blob([arrayBuffer], { type: 'audio/wav' });
+            return;
+        }
+
+        this.isPlaying = true;
+        const audioUrl = URL.createObjectURL(blob);
+        const next = () => {
+            URL.revokeObjectURL(audioUrl);
+            this.playNext();
+        };
+
+        this.audioPlayer.src = audioUrl;
+        this.audioPlayer.onended = next;
+        this.audioPlayer.play().catch((error) => {
+            console.error('Ошибка воспроизведения аудио:', error);
+            next();
+        });
+    }
+
+    finishPlayback() {
+        this.updateStatus('waiting', '🎤 Нажмите микрофон для следующего вопроса');
+        this.isProcessing = false; // Разблокируем новые записи
+    }
+
+    playAudioBlob(blob) {
+        try {
             const audioUrl = URL.createObjectURL(blob);
             
             this.audioPlayer.src = audioUrl;
@@ -326,6 +607,7 @@ class VoiceChat {
         
         this.conversation.appendChild(messageDiv);
         this.conversation.scrollTop = this.conversation.scrollHeight;
+        return messageDiv;
     }
 
     clearConversation() {
@@ -0,0 +1,146 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """Реплика не принята в обработку: сервер или сессия перегружены"""
+
+    def __init__(self, reason: str, estimated_wait: float):
+        super().__init__(reason)
+        self.reason = reason  # "queue_full" | "session_busy"
+        self.estimated_wait = estimated_wait
+
+class AdmissionController:
+    """Ограничивает число одновременно обрабатываемых реплик (STT -> LLM -> TTS).
+
+    Не больше max_concurrent реплик на сервер и max_per_session на сессию.
+    Реплики сверх лимита ждут в очереди длиной не больше max_queue (FIFO),
+    остальные сразу отклоняются с оценкой времени ожидания. Оценка строится
+    по скользящему среднему длительности реплики.
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 32, max_per_session: int = 1,
+                 initial_turn_seconds: float = 3.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_session = max_per_session
+
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._per_session: Dict[str, int] = {}
+
+        # Скользящее среднее длительности реплики для оценки ожидания
+        self.avg_turn_seconds = initial_turn_seconds
+
+        # Статистика
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = 0
+
+    @property
+    def waiting(self) -> int:
+        """Сколько реплик ждет в очереди"""
+        return len(self._waiters)
+
+    def estimate_wait(self, position: Optional[int] = None) -> float:
+        """Оценка ожидания (с) для реплики на позиции position в очереди"""
+        if position is None:
+            position = len(self._waiters)
+        return round(self.avg_turn_seconds * (position // self.max_concurrent + 1), 1)
+
+    @asynccontextmanager
+    async def admit(self, session_id: str,
+                    on_queued: Optional[Callable[[int, float], Awaitable[None]]] = None) -> AsyncIterator[None]:
+        """Занимает слот обработки на время блока with.
+
+        on_queued(позиция, оценка ожидания) вызывается, если реплике пришлось встать в очередь.
+        """
+        if self._per_session.get(session_id, 0) >= self.max_per_session:
+            self.rejected += 1
+            raise AdmissionRejected("session_busy", self.estimate_wait(0))
+
+        self._per_session[session_id] = self._per_session.get(session_id, 0) + 1
+        try:
+            await self._acquire(on_queued)
+        except BaseException:
+            self._release_session(session_id)
+            raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.avg_turn_seconds = 0.8 * self.avg_turn_seconds + 0.2 * elapsed
+            self._release_session(session_id)
+            self._release()
+
+    async def _acquire(self, on_queued):
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("queue_full", self.estimate_wait())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued_total += 1
+        try:
+            if on_queued is not None:
+                position = len(self._waiters) - 1
+                await on_queued(position + 1, self.estimate_wait(position))
+            # Слот передается напрямую из _release, active уже увеличен
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже был передан нам - возвращаем его следующему
+                self._release()
+            else:
+                waiter.cancel()
+                self._remove_waiter(waiter)
+            raise
+
+        self.admitted += 1
+
+    def _release(self):
+        # Передаем слот первой ожидающей реплике, не уменьшая active
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _remove_waiter(self, waiter: asyncio.Future):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _release_session(self, session_id: str):
+        count = self._per_session.get(session_id, 0) - 1
+        if count > 0:
+            self._per_session[session_id] = count
+        else:
+            self._per_session.pop(session_id, None)
+
+    def stats(self) -> dict:
+        """Возвращает состояние очереди обработки"""
+        return {
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected": self.rejected,
+            "avg_turn_seconds": round(self.avg_turn_seconds, 2)
+        }
@@ -0,0 +1,65 @@
+import struct
+from typing import Tuple
+
+# Бинарный протокол для аудио по WebSocket.
+#
+# Каждый бинарный фрейм начинается с 4-байтового заголовка (network order):
+#   [0]    тип сообщения (MSG_*)
+#   [1]    кодек полезной нагрузки (CODEC_*)
+#   [2:4]  порядковый номер (для упорядочивания фрагментов)
+# Дальше идут сырые байты аудио без base64 и JSON.
+# Управляющие сообщения по-прежнему передаются текстом в JSON.
+
+HEADER = struct.Struct("!BBH")
+HEADER_SIZE = HEADER.size
+
+# Типы сообщений
+MSG_COMPLETE_AUDIO = 0x01   # клиент -> сервер: полная запись
+MSG_AUDIO_RESPONSE = 0x02   # сервер -> клиент: аудио ответ
+MSG_AUDIO_CHUNK = 0x03      # клиент -> сервер: фрагмент записи (между audio_start и audio_end)
+MSG_AUDIO_RESPONSE_CHUNK = 0x04  # сервер -> клиент: аудио одного предложения ответа, seq - номер
+
+# Кодеки
+CODEC_UNKNOWN = 0x00
+CODEC_WEBM = 0x01
+CODEC_WAV = 0x02
+CODEC_MP3 = 0x03
+CODEC_PCM16 = 0x04  # сырой PCM 16 бит моно с частотой Config.SAMPLE_RATE
+
+CODEC_MIME_TYPES = {
+    CODEC_WEBM: "audio/webm",
+    CODEC_WAV: "audio/wav",
+    CODEC_MP3: "audio/mpeg",
+}
+
+CODEC_NAMES = {
+    "webm": CODEC_WEBM,
+    "wav": CODEC_WAV,
+    "mp3": CODEC_MP3,
+    "pcm16": CODEC_PCM16,
+}
+
+# Форматы аудио ответа, которые может запросить клиент (client_hello.audio_formats)
+OUTPUT_FORMAT_CODECS = {
+    "mp3": CODEC_MP3,    # как отдает gTTS, без перекодирования
+    "opus": CODEC_WEBM,  # Opus в контейнере WebM - самый компактный
+    "wav": CODEC_WAV,    # несжатый PCM - максимальная совместимость
+}
+
+class ProtocolError(ValueError):
+    """Некорректный бинарный фрейм"""
+
+def pack_frame(msg_type: int, codec: int, payload: bytes, seq: int = 0) -> bytes:
+    """Собирает бинарный фрейм: заголовок + полезная нагрузка"""
+    return HEADER.pack(msg_type, codec, seq & 0xFFFF) + payload
+
+def unpack_frame(data: bytes) -> Tuple[int, int, int, memoryview]:
+    """Разбирает бинарный фрейм.
+
+    Полезная нагрузка возвращается как memoryview без копирования.
+    """
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError(f"Слишком короткий фрейм: {len(data)} байт")
+
+    msg_type, codec, seq = HEADER.unpack_from(data)
+    return msg_type, codec, seq, memoryview(data)[HEADER_SIZE:]
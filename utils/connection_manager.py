@@ -1,132 +1,459 @@
 from fastapi import WebSocket
-from typing import List, Dict
+from collections import deque
+from heapq import heappush, heappop, heapify
+from itertools import count
+from typing import Deque, Dict, List, Optional, Tuple, Union
+import asyncio
 import logging
 import json
+import time
+import secrets
+
+from utils.metrics import STAGE_SECONDS
+from utils.system_messages import GREETING
 
 logger = logging.getLogger(__name__)
 
+# Приветствие сериализуется один раз, для каждого соединения подставляется только session_id
+GREETING_JSON_PREFIX = json.dumps({
+    "type": "connection_established",
+    "message": GREETING
+}, ensure_ascii=False)[:-1]
+
+# Heartbeat: сервер шлет ping, клиент отвечает {"type": "pong"}
+PING_JSON = json.dumps({"type": "ping"})
+
+# WebSocket close codes
+CLOSE_SLOW_CONSUMER = 1013  # Try Again Later: клиент не успевает принимать сообщения
+CLOSE_IDLE = 4000           # нет активности пользователя дольше IDLE_TIMEOUT
+CLOSE_HEARTBEAT = 4001      # клиент не ответил на ping (полуоткрытое соединение)
+CLOSE_SUPERSEDED = 4002     # сессию продолжило соединение на другом воркере
+
+CLOSE_CODES = {
+    "slow": CLOSE_SLOW_CONSUMER,
+    "idle": CLOSE_IDLE,
+    "heartbeat": CLOSE_HEARTBEAT,
+    "superseded": CLOSE_SUPERSEDED,
+}
+
+Message = Union[str, bytes]
+
+def _ignore_result(task: asyncio.Task):
+    """Забирает исключение фоновой задачи: соединение уже могло быть закрыто"""
+    if not task.cancelled():
+        task.exception()
+
+class Connection:
+    """Запись об одном соединении и его очередь исходящих сообщений.
+
+    Сообщения отправляет отдельная задача writer, поэтому медленный клиент
+    задерживает только свою очередь. Время - time.monotonic().
+    """
+
+    __slots__ = (
+        "websocket", "session_id", "connected_at", "last_activity", "last_seen", "ping_sent",
+        "is_recording", "queue", "queued_bytes", "has_data", "has_space", "writer", "handler",
+        "closed", "close_reason", "dropped"
+    )
+
+    def __init__(self, websocket: WebSocket, session_id: str):
+        self.websocket = websocket
+        self.session_id = session_id
+        self.connected_at = time.monotonic()
+        # Последнее сообщение пользователя (pong не считается) - для IDLE_TIMEOUT
+        self.last_activity = self.connected_at
+        # Последнее любое входящее сообщение - клиент жив
+        self.last_seen = self.connected_at
+        # Когда отправлен ping без ответа (0 - не отправлен)
+        self.ping_sent = 0.0
+        self.is_recording = False
+
+        self.queue: Deque[Message] = deque()
+        self.queued_bytes = 0
+        self.has_data = asyncio.Event()
+        self.has_space = asyncio.Event()
+        self.has_space.set()
+        self.writer: Optional[asyncio.Task] = None
+        # Задача обработчика /ws - отменяется, если закрытое соединение не завершилось само
+        self.handler: Optional[asyncio.Task] = None
+        self.closed = False
+        self.close_reason: Optional[str] = None  # slow | idle | heartbeat
+        self.dropped = 0
+
 class ConnectionManager:
-    """Менеджер для управления WebSocket соединениями"""
-    
-    def __init__(self):
-        # Активные соединения
-        self.active_connections: List[WebSocket] = []
-        # Метаданные соединений
-        self.connection_metadata: Dict[WebSocket, dict] = {}
-    
-    async def connect(self, websocket: WebSocket):
-        """Принимает новое WebSocket соединение"""
+    """Менеджер для управления WebSocket соединениями.
+
+    Соединения хранятся в словарях по websocket и по session_id - поиск,
+    добавление и удаление стоят O(1). У каждого соединения ограниченная
+    очередь исходящих сообщений (max_messages штук и max_bytes байт):
+    - send ждет места в очереди до send_timeout (обратное давление на конвейер
+      реплики), затем применяет политику переполнения;
+    - enqueue (broadcast и необязательные сообщения) не ждет никогда.
+    Политика "close" закрывает соединение медленного клиента, "drop" - выбрасывает
+    сообщение. Необязательные сообщения (droppable) при переполнении выбрасываются всегда.
+
+    Фоновая задача-сборщик держит кучу (deadline, соединение) и просыпается к ближайшему
+    сроку: шлет ping клиенту, молчащему heartbeat_interval, закрывает соединения без
+    ответа на ping за heartbeat_timeout и без активности пользователя за idle_timeout.
+    Входящие сообщения только обновляют отметки времени - куча не перестраивается,
+    срок соединения пересчитывается, когда до него доходит очередь (0 - проверка выключена).
+    """
+
+    def __init__(self, max_messages: int = 256, max_bytes: int = 4 * 1024 * 1024,
+                 send_timeout: float = 10.0, overflow_policy: str = "close",
+                 heartbeat_interval: float = 20.0, heartbeat_timeout: float = 20.0,
+                 idle_timeout: float = 600.0, close_timeout: float = 5.0):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.send_timeout = send_timeout
+        self.overflow_policy = overflow_policy
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.close_timeout = close_timeout
+
+        self._connections: Dict[WebSocket, Connection] = {}
+        self._by_session: Dict[str, Connection] = {}
+
+        # Куча сроков проверки: (deadline, порядковый номер, соединение)
+        self._timers: List[Tuple[float, int, Connection]] = []
+        self._timer_seq = count()
+        self._reaper: Optional[asyncio.Task] = None
+        self._reaper_wakeup: Optional[asyncio.Event] = None
+
+        # Статистика
+        self.dropped = 0
+        self.slow_closed = 0
+        self.idle_closed = 0
+        self.heartbeat_closed = 0
+
+    async def connect(self, websocket: WebSocket, session_id: Optional[str] = None):
+        """Принимает новое WebSocket соединение (session_id - продолжить существующий разговор)"""
         await websocket.accept()
-        self.active_connections.append(websocket)
-        
-        # Инициализируем метаданные
-        self.connection_metadata[websocket] = {
-            "connected_at": self._get_current_timestamp(),
-            "session_id": self._generate_session_id(),
-            "is_recording": False,
-            "last_activity": self._get_current_timestamp()
-        }
-        
-        logger.info(f"Новое WebSocket соединение. Всего активных: {len(self.active_connections)}")
-        
+
+        connection = Connection(websocket, session_id or self._generate_session_id())
+        connection.writer = asyncio.create_task(self._writer(connection))
+        connection.handler = asyncio.current_task()
+        self._connections[websocket] = connection
+        self._by_session[connection.session_id] = connection
+        self._schedule(connection)
+
+        logger.info(f"Новое WebSocket соединение. Всего активных: {len(self._connections)}")
+
         # Отправляем приветственное сообщение
-        await self.send_personal_message({
-            "type": "connection_established",
-            "message": "Соединение установлено. Можете начать говорить!",
-            "session_id": self.connection_metadata[websocket]["session_id"]
-        }, websocket)
-    
+        await self.send(
+            websocket,
+            f'{GREETING_JSON_PREFIX}, "session_id": {json.dumps(connection.session_id)}}}'
+        )
+
     def disconnect(self, websocket: WebSocket):
-        """Отключает WebSocket соединение"""
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-            
-        if websocket in self.connection_metadata:
-            session_id = self.connection_metadata[websocket]["session_id"]
-            del self.connection_metadata[websocket]
-            logger.info(f"WebSocket соединение отключено. Session ID: {session_id}")
-        
-        logger.info(f"Всего активных соединений: {len(self.active_connections)}")
-    
+        """Отключает WebSocket соединение (повторный вызов ничего не делает)"""
+        connection = self._connections.pop(websocket, None)
+        if connection is None:
+            return
+
+        if self._by_session.get(connection.session_id) is connection:
+            del self._by_session[connection.session_id]
+        self._stop(connection)
+        logger.info(f"WebSocket соединение отключено. Session ID: {connection.session_id}")
+        logger.info(f"Всего активных соединений: {len(self._connections)}")
+
+    async def send(self, websocket: WebSocket, data: Message, droppable: bool = False) -> bool:
+        """Ставит сообщение в очередь соединения, дожидаясь места не дольше send_timeout.
+
+        Возвращает False, если сообщение не будет отправлено.
+        """
+        connection = self._connections.get(websocket)
+        if connection is None or connection.closed:
+            # Соединение уже закрыто - сообщение никому не нужно
+            return False
+
+        if droppable or self._has_room(connection, data):
+            return self._offer(connection, data, droppable)
+
+        # Очередь полна: ждем, пока writer ее разгрузит
+        deadline = time.monotonic() + self.send_timeout
+        while not self._has_room(connection, data):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or connection.closed:
+                return self._overflow(connection)
+            connection.has_space.clear()
+            try:
+                await asyncio.wait_for(connection.has_space.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        return self._offer(connection, data, droppable)
+
+    def enqueue(self, websocket: WebSocket, data: Message, droppable: bool = True) -> bool:
+        """Ставит сообщение в очередь без ожидания (переполнение - по политике)"""
+        connection = self._connections.get(websocket)
+        if connection is None or connection.closed:
+            return False
+        return self._offer(connection, data, droppable)
+
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         """Отправляет личное сообщение конкретному клиенту"""
-        try:
-            if websocket in self.active_connections:
-                await websocket.send_text(json.dumps(message, ensure_ascii=False))
-                self._update_last_activity(websocket)
-            else:
-                logger.warning("Попытка отправить сообщение отключенному клиенту")
-                
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения: {e}")
-            # Удаляем проблемное соединение
-            self.disconnect(websocket)
-    
+        await self.send(websocket, json.dumps(message, ensure_ascii=False))
+
+    async def send_personal_text(self, text: str, websocket: WebSocket):
+        """Отправляет клиенту уже сериализованное сообщение"""
+        await self.send(websocket, text)
+
     async def broadcast(self, message: dict):
-        """Отправляет сообщение всем подключенным клиентам"""
-        if not self.active_connections:
+        """Отправляет сообщение всем подключенным клиентам.
+
+        Сообщение сериализуется один раз и ставится в очереди без ожидания,
+        поэтому медленный клиент не задерживает остальных.
+        """
+        if not self._connections:
             return
-            
-        disconnected_clients = []
-        
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json.dumps(message, ensure_ascii=False))
-                self._update_last_activity(connection)
-            except Exception as e:
-                logger.error(f"Ошибка broadcast сообщения: {e}")
-                disconnected_clients.append(connection)
-        
-        # Удаляем отключенные соединения
-        for client in disconnected_clients:
-            self.disconnect(client)
-    
+
+        text = json.dumps(message, ensure_ascii=False)
+        for connection in list(self._connections.values()):
+            if not connection.closed:
+                self._offer(connection, text, droppable=True)
+
+    def get_connection(self, websocket: WebSocket) -> Optional[Connection]:
+        """Возвращает запись соединения"""
+        return self._connections.get(websocket)
+
+    def get_by_session(self, session_id: str) -> Optional[Connection]:
+        """Возвращает соединение сессии"""
+        return self._by_session.get(session_id)
+
     def get_connection_info(self, websocket: WebSocket) -> dict:
         """Возвращает информацию о соединении"""
-        return self.connection_metadata.get(websocket, {})
-    
+        connection = self._connections.get(websocket)
+        return self._describe(connection, time.monotonic()) if connection is not None else {}
+
     def set_recording_status(self, websocket: WebSocket, is_recording: bool):
         """Устанавливает статус записи для соединения"""
-        if websocket in self.connection_metadata:
-            self.connection_metadata[websocket]["is_recording"] = is_recording
-            self._update_last_activity(websocket)
-    
+        connection = self._connections.get(websocket)
+        if connection is not None:
+            connection.is_recording = is_recording
+
+    def touch(self, websocket: WebSocket) -> bool:
+        """Отмечает любое входящее сообщение (клиент жив); False - соединение уже закрыто"""
+        connection = self._connections.get(websocket)
+        if connection is None or connection.closed:
+            return False
+        connection.last_seen = time.monotonic()
+        connection.ping_sent = 0.0
+        return True
+
+    def mark_active(self, websocket: WebSocket):
+        """Отмечает действие пользователя (все, кроме служебных pong)"""
+        connection = self._connections.get(websocket)
+        if connection is not None:
+            connection.last_activity = connection.last_seen
+
+    def close(self, websocket: WebSocket, reason: str):
+        """Закрывает соединение с кодом из CLOSE_CODES (например, superseded)"""
+        connection = self._connections.get(websocket)
+        if connection is not None and not connection.closed:
+            logger.info(f"Соединение {connection.session_id} закрыто: {reason}")
+            self._reap(connection, reason)
+
+    def was_reaped(self, websocket: WebSocket) -> bool:
+        """Соединение закрыл сам менеджер (медленный клиент, простой, нет ответа на ping)"""
+        connection = self._connections.get(websocket)
+        return connection is not None and connection.close_reason is not None
+
     def get_active_connections_count(self) -> int:
         """Возвращает количество активных соединений"""
-        return len(self.active_connections)
-    
+        return len(self._connections)
+
+    def queued_messages(self) -> int:
+        """Сколько сообщений ждет отправки во всех очередях"""
+        return sum(len(connection.queue) for connection in self._connections.values())
+
     def get_connections_summary(self) -> dict:
         """Возвращает сводку по всем соединениям"""
-        summary = {
-            "total_connections": len(self.active_connections),
-            "recording_connections": 0,
-            "connections": []
+        now = time.monotonic()
+        connections = [self._describe(connection, now) for connection in self._connections.values()]
+        return {
+            "total_connections": len(connections),
+            "recording_connections": sum(1 for info in connections if info["is_recording"]),
+            "dropped_messages": self.dropped,
+            "slow_clients_closed": self.slow_closed,
+            "idle_closed": self.idle_closed,
+            "heartbeat_closed": self.heartbeat_closed,
+            "connections": connections
+        }
+
+    def _describe(self, connection: Connection, now: float) -> dict:
+        return {
+            "session_id": connection.session_id,
+            "connected_seconds": round(now - connection.connected_at, 1),
+            "idle_seconds": round(now - connection.last_activity, 1),
+            "last_seen_seconds": round(now - connection.last_seen, 1),
+            "is_recording": connection.is_recording,
+            "queued_messages": len(connection.queue),
+            "queued_bytes": connection.queued_bytes,
+            "dropped_messages": connection.dropped
         }
-        
-        for websocket, metadata in self.connection_metadata.items():
-            if metadata["is_recording"]:
-                summary["recording_connections"] += 1
-            
-            summary["connections"].append({
-                "session_id": metadata["session_id"],
-                "connected_at": metadata["connected_at"],
-                "last_activity": metadata["last_activity"],
-                "is_recording": metadata["is_recording"]
-            })
-        
-        return summary
-    
-    def _update_last_activity(self, websocket: WebSocket):
-        """Обновляет время последней активности"""
-        if websocket in self.connection_metadata:
-            self.connection_metadata[websocket]["last_activity"] = self._get_current_timestamp()
-    
-    def _get_current_timestamp(self) -> str:
-        """Возвращает текущее время в формате ISO"""
-        from datetime import datetime
-        return datetime.now().isoformat()
-    
+
+    def _has_room(self, connection: Connection, data: Message) -> bool:
+        # Одно сообщение больше max_bytes все равно проходит в пустую очередь
+        if not connection.queue:
+            return True
+        return (len(connection.queue) < self.max_messages and
+                connection.queued_bytes + len(data) <= self.max_bytes)
+
+    def _offer(self, connection: Connection, data: Message, droppable: bool) -> bool:
+        if not self._has_room(connection, data):
+            if droppable:
+                connection.dropped += 1
+                self.dropped += 1
+                return False
+            return self._overflow(connection)
+
+        connection.queue.append(data)
+        connection.queued_bytes += len(data)
+        connection.has_data.set()
+        return True
+
+    def _overflow(self, connection: Connection) -> bool:
+        """Очередь переполнена обязательным сообщением - применяем политику"""
+        connection.dropped += 1
+        self.dropped += 1
+        if self.overflow_policy == "close" and not connection.closed:
+            self.slow_closed += 1
+            logger.warning(f"Клиент {connection.session_id} не успевает принимать сообщения - закрываем соединение")
+            self._reap(connection, "slow")
+        return False
+
+    def _reap(self, connection: Connection, reason: str):
+        """Закрывает соединение по решению менеджера"""
+        connection.close_reason = reason
+        self._stop(connection)
+        asyncio.create_task(self._close(connection))
+
+    def _stop(self, connection: Connection):
+        connection.closed = True
+        connection.queue.clear()
+        connection.queued_bytes = 0
+        # Будим отправителей, ждущих места, чтобы они увидели closed
+        connection.has_space.set()
+        if connection.writer is not None and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    async def _close(self, connection: Connection):
+        deadline = time.monotonic() + self.close_timeout
+        # Отдельная задача, а не wait_for: на полуоткрытом соединении close ждет
+        # рукопожатия и после отмены, а wait_for дождался бы ее завершения
+        closing = asyncio.create_task(connection.websocket.close(code=CLOSE_CODES[connection.close_reason]))
+        closing.add_done_callback(_ignore_result)
+        await asyncio.wait((closing,), timeout=self.close_timeout)
+
+        # Полуоткрытое соединение может так и не сообщить обработчику о закрытии -
+        # даем ему остаток close_timeout, затем завершаем сами, чтобы освободить сессию
+        await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        if self._connections.get(connection.websocket) is connection and connection.handler is not None:
+            connection.handler.cancel()
+
+    def _schedule(self, connection: Connection):
+        """Ставит соединение в кучу сроков и будит сборщик, если срок ближайший"""
+        deadline = self._next_deadline(connection)
+        if deadline is None:
+            return
+
+        heappush(self._timers, (deadline, next(self._timer_seq), connection))
+        if self._reaper is None or self._reaper.done() or self._reaper.get_loop() is not asyncio.get_running_loop():
+            self._reaper_wakeup = asyncio.Event()
+            self._reaper = asyncio.create_task(self._run_reaper())
+        elif self._timers[0][2] is connection:
+            self._reaper_wakeup.set()
+
+    def _next_deadline(self, connection: Connection) -> Optional[float]:
+        deadlines = []
+        if self.idle_timeout > 0:
+            deadlines.append(connection.last_activity + self.idle_timeout)
+        if self.heartbeat_interval > 0:
+            if connection.ping_sent:
+                deadlines.append(connection.ping_sent + self.heartbeat_timeout)
+            else:
+                deadlines.append(connection.last_seen + self.heartbeat_interval)
+        return min(deadlines) if deadlines else None
+
+    async def _run_reaper(self):
+        """Фоновая задача: heartbeat и закрытие простаивающих соединений"""
+        timers = self._timers
+        while True:
+            now = time.monotonic()
+            while timers and timers[0][0] <= now:
+                _, _, connection = heappop(timers)
+                if connection.closed or self._connections.get(connection.websocket) is not connection:
+                    continue
+                self._check(connection, now)
+                if not connection.closed:
+                    self._schedule(connection)
+
+            # Записи закрытых соединений удаляются лениво; если их накопилось много - чистим
+            if len(timers) > 2 * len(self._connections) + 64:
+                timers[:] = [entry for entry in timers if not entry[2].closed and entry[2].websocket in self._connections]
+                heapify(timers)
+
+            self._reaper_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._reaper_wakeup.wait(), timers[0][0] - now if timers else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def _check(self, connection: Connection, now: float):
+        """Проверяет сроки соединения: простой, ответ на ping, отправка ping"""
+        if self.idle_timeout > 0 and now - connection.last_activity >= self.idle_timeout:
+            self.idle_closed += 1
+            logger.info(f"Соединение {connection.session_id} закрыто: нет активности {self.idle_timeout:.0f} с")
+            self._reap(connection, "idle")
+        elif self.heartbeat_interval <= 0:
+            return
+        elif connection.ping_sent:
+            if now - connection.ping_sent >= self.heartbeat_timeout:
+                self.heartbeat_closed += 1
+                logger.info(f"Соединение {connection.session_id} закрыто: нет ответа на ping")
+                self._reap(connection, "heartbeat")
+        elif now - connection.last_seen >= self.heartbeat_interval:
+            connection.ping_sent = now
+            self._offer(connection, PING_JSON, droppable=True)
+
+    def shutdown(self):
+        """Останавливает сборщик (при остановке сервера)"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    async def _writer(self, connection: Connection):
+        """Отправляет сообщения из очереди соединения по порядку"""
+        queue = connection.queue
+        while not connection.closed:
+            if not queue:
+                connection.has_data.clear()
+                await connection.has_data.wait()
+                continue
+
+            data = queue.popleft()
+            connection.queued_bytes -= len(data)
+            connection.has_space.set()
+
+            started = time.perf_counter()
+            try:
+                await self._write(connection.websocket, data)
+            except Exception as e:
+                # Клиент ушел: дальнейшие сообщения не нужны, соединение уберет обработчик /ws
+                logger.error(f"Ошибка отправки сообщения: {e}")
+                self._stop(connection)
+                return
+            STAGE_SECONDS.observe(time.perf_counter() - started, "send")
+
+    @staticmethod
+    async def _write(websocket: WebSocket, data: Message):
+        if isinstance(data, bytes):
+            await websocket.send_bytes(data)
+        else:
+            await websocket.send_text(data)
+
     def _generate_session_id(self) -> str:
         """Генерирует уникальный ID сессии"""
-        import uuid
-        return str(uuid.uuid4())[:8] 
\ No newline at end of file
+        return secrets.token_urlsafe(16)
@@ -0,0 +1,193 @@
+from collections import deque
+from typing import Deque, List, Optional
+import asyncio
+import time
+
+# Грубая оценка без обращения к API: в русском тексте около 3 символов на токен
+CHARS_PER_TOKEN = 3
+
+# Повтор свертки после ошибки модели: через 5 с, 10 с, 20 с... но не реже раза в 5 минут
+SUMMARY_RETRY_SECONDS = 5.0
+SUMMARY_RETRY_MAX_SECONDS = 300.0
+
+ROLE_LABELS = {
+    "user": "Пользователь",
+    "assistant": "Ассистент",
+}
+
+def estimate_tokens(text: str) -> int:
+    """Оценивает число токенов в тексте"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+class Turn:
+    """Одно сообщение разговора с заранее подготовленной строкой промпта"""
+
+    __slots__ = ("role", "content", "line", "tokens")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        self.line = f"{ROLE_LABELS.get(role, role)}: {content}"
+        self.tokens = estimate_tokens(self.line)
+
+class ConversationContext:
+    """Контекст разговора, ограниченный бюджетом токенов.
+
+    Сообщения хранятся в deque вместе с посчитанным числом токенов, поэтому
+    добавление и вытеснение стоят O(1), а размер промпта не растет с длиной
+    разговора. Вытесненные сообщения копятся в pending и сворачиваются
+    в краткое содержание (summary) в фоне - см. GeminiService.
+    """
+
+    def __init__(self, max_tokens: int = 1500, summary_tokens: int = 300):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+
+        self.turns: Deque[Turn] = deque()
+        self.tokens = 0  # сумма токенов в turns
+
+        # Краткое содержание вытесненной части разговора
+        self.summary = ""
+        self.summary_line = ""
+        # Вытесненные сообщения, которые еще не вошли в summary
+        self.pending: List[Turn] = []
+        # Фоновая задача свертки (одна на контекст)
+        self.summary_task = None
+        # Неудачные свертки подряд и время (monotonic), раньше которого не повторять
+        self.summary_failures = 0
+        self.summary_retry_at = 0.0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    @property
+    def budget(self) -> int:
+        """Сколько токенов отводится на сообщения (остальное - на summary)"""
+        return self.max_tokens - self.summary_tokens if self.summary else self.max_tokens
+
+    def add(self, role: str, content: str):
+        """Добавляет сообщение и вытесняет самые старые, если бюджет превышен"""
+        turn = Turn(role, content)
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+        self._trim()
+
+    def recent(self, count: int) -> List[Turn]:
+        """Возвращает последние count сообщений"""
+        if count <= 0:
+            return []
+        start = max(0, len(self.turns) - count)
+        return [self.turns[i] for i in range(start, len(self.turns))]
+
+    @property
+    def needs_summary(self) -> bool:
+        """Есть вытесненные сообщения, свертка еще не запущена и не отложена после ошибки"""
+        return (bool(self.pending)
+                and (self.summary_task is None or self.summary_task.done())
+                and time.monotonic() >= self.summary_retry_at)
+
+    def take_pending(self) -> List[Turn]:
+        """Забирает вытесненные сообщения для свертки"""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def return_pending(self, turns: List[Turn]):
+        """Возвращает сообщения, свертка которых не состоялась, в начало pending"""
+        self.pending[:0] = turns
+
+        # Пока модель недоступна, pending растет - самое старое все равно
+        # не поместится в промпт свертки, его и забываем
+        tokens = sum(turn.tokens for turn in self.pending)
+        while tokens > self.max_tokens and len(self.pending) > 1:
+            tokens -= self.pending.pop(0).tokens
+
+    def summary_failed(self):
+        """Свертка не удалась: следующая попытка - с экспоненциальной задержкой"""
+        delay = min(SUMMARY_RETRY_SECONDS * 2 ** self.summary_failures, SUMMARY_RETRY_MAX_SECONDS)
+        self.summary_failures += 1
+        self.summary_retry_at = time.monotonic() + delay
+
+    async def settle_summary(self, timeout: float):
+        """Дожидается фоновой свертки перед сохранением снимка.
+
+        Если свертка не успела за timeout, она отменяется, и взятые ею
+        сообщения возвращаются в pending - снимок их не теряет.
+        """
+        task = self.summary_task
+        if task is None or task.done():
+            return
+        done, _ = await asyncio.wait((task,), timeout=timeout)
+        if not done:
+            task.cancel()
+            await asyncio.wait((task,))
+
+    def set_summary(self, summary: str):
+        """Сохраняет новое краткое содержание, обрезая его до summary_tokens"""
+        summary = summary.strip()
+        # Модель может не уложиться в просимую длину - тогда summary съело бы
+        # бюджет сообщений. Режем по оценке токенов, на границе слова
+        max_chars = self.summary_tokens * CHARS_PER_TOKEN
+        if len(summary) > max_chars:
+            cut = summary[:max_chars - 1]
+            space = cut.rfind(" ")
+            if space > max_chars // 2:
+                cut = cut[:space]
+            summary = cut.rstrip() + "…"
+        self.summary = summary
+        self.summary_failures = 0
+        self.summary_retry_at = 0.0
+        self.summary_line = f"Краткое содержание предыдущего разговора: {self.summary}" if self.summary else ""
+
+        # Summary занимает часть бюджета - при необходимости освобождаем место
+        self._trim()
+
+    def build_prompt(self, system_prompt: str) -> str:
+        """Собирает промпт: системный промпт, summary, сообщения и приглашение ассистенту"""
+        parts = [system_prompt]
+        if self.summary_line:
+            parts.append(self.summary_line)
+        parts.extend(turn.line for turn in self.turns)
+        parts.append(f"{ROLE_LABELS['assistant']}:")
+        return "\n".join(parts)
+
+    def to_dict(self) -> dict:
+        """Снимок контекста для внешнего хранилища сессий (без фоновой задачи свертки)"""
+        return {
+            "turns": [[turn.role, turn.content] for turn in self.turns],
+            "pending": [[turn.role, turn.content] for turn in self.pending],
+            "summary": self.summary,
+        }
+
+    def restore(self, data: Optional[dict]):
+        """Восстанавливает контекст из снимка to_dict"""
+        self.clear()
+        if not data:
+            return
+        self.pending = [Turn(role, content) for role, content in data.get("pending", [])]
+        for role, content in data.get("turns", []):
+            turn = Turn(role, content)
+            self.turns.append(turn)
+            self.tokens += turn.tokens
+        # set_summary заодно подрежет сообщения под бюджет этого процесса
+        self.set_summary(data.get("summary", ""))
+
+    def clear(self):
+        """Очищает контекст"""
+        if self.summary_task is not None:
+            self.summary_task.cancel()
+            self.summary_task = None
+        self.turns.clear()
+        self.tokens = 0
+        self.summary = ""
+        self.summary_line = ""
+        self.pending = []
+        self.summary_failures = 0
+        self.summary_retry_at = 0.0
+
+    def _trim(self):
+        """Вытесняет самые старые сообщения, пока контекст не уложится в бюджет"""
+        # Последнее сообщение остается всегда, даже если оно одно больше бюджета
+        while self.tokens > self.budget and len(self.turns) > 1:
+            evicted = self.turns.popleft()
+            self.tokens -= evicted.tokens
+            self.pending.append(evicted)
@@ -0,0 +1,196 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Границы корзин по умолчанию: от 5 мс до 30 с
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Размеры аудио: от 1 КБ до 8 МБ
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 8388608)
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (формат Prometheus).
+
+    observe стоит один bisect и два сложения, поэтому метрики можно
+    держать включенными в продакшене. Вызывается из event loop.
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # значения меток -> (счетчики по корзинам, включая +Inf, сумма)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0])
+            self._series[labels] = series
+        counts, total = series
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Замеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Counter:
+    """Монотонный счетчик"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+# Функция сбора: число или {значения меток: число}
+GaugeSource = Callable[[], Union[float, Dict[LabelValues, float]]]
+
+class Gauge:
+    """Мгновенное значение, которое считывается из источника в момент запроса /metrics.
+
+    Подходит для уже существующих счетчиков (статистика кэшей, пулов,
+    число соединений) - их не нужно дублировать и обновлять отдельно.
+    """
+
+    def __init__(self, name: str, help_text: str, source: GaugeSource, labelnames: Sequence[str] = (),
+                 metric_type: str = "gauge"):
+        self.name = name
+        self.help = help_text
+        self.source = source
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        value = self.source()
+        if isinstance(value, dict):
+            for labels, sample in value.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(sample)}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: List[Union[Histogram, Counter, Gauge]] = []
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, source: GaugeSource, labelnames: Sequence[str] = (),
+              metric_type: str = "gauge") -> Gauge:
+        return self._register(Gauge(name, help_text, source, labelnames, metric_type))
+
+    def get(self, name: str) -> Optional[Union[Histogram, Counter, Gauge]]:
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+def peak_rss_bytes() -> Optional[float]:
+    """Пиковый объем резидентной памяти процесса (None, если платформа не сообщает)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return float(peak if sys.platform == "darwin" else peak * 1024)
+
+# Метрики процесса
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "voice_stage_seconds",
+    "Длительность этапа конвейера, включая ожидание в очереди пула",
+    ["stage"]
+)
+TURN_SECONDS = registry.histogram(
+    "voice_turn_seconds",
+    "Длительность обработки реплики от приема аудио до последнего фрагмента ответа"
+)
+FIRST_AUDIO_SECONDS = registry.histogram(
+    "voice_time_to_first_audio_seconds",
+    "Время от приема реплики до отправки первого аудио ответа"
+)
+PAYLOAD_BYTES = registry.histogram(
+    "voice_payload_bytes",
+    "Размер аудио: входящая реплика (in) и фрагменты ответа (out)",
+    ["direction"],
+    SIZE_BUCKETS
+)
+AUDIO_BYTES = registry.counter(
+    "voice_audio_bytes_total",
+    "Всего байт аудио",
+    ["direction"]
+)
+TURNS = registry.counter(
+    "voice_turns_total",
+    "Реплики по результату",
+    ["outcome"]
+)
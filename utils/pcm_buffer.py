@@ -0,0 +1,137 @@
+import struct
+
+def wav_header(data_size: int, sample_rate: int = 16000, channels: int = 1,
+               sample_width: int = 2) -> bytes:
+    """Возвращает 44-байтовый заголовок WAV (PCM) для data_size байт аудио"""
+    byte_rate = sample_rate * channels * sample_width
+    block_align = channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, byte_rate, block_align, sample_width * 8,
+        b"data", data_size
+    )
+
+class PCMBuffer:
+    """Растущий кольцевой буфер для PCM аудио.
+
+    Буфер растет удвоением до max_bytes, после чего работает как кольцо:
+    новые данные вытесняют самые старые. Добавление стоит O(len(data)),
+    длительность считается за O(1). Позиции задаются абсолютными смещениями
+    в потоке (с момента последнего clear), поэтому остаются корректными
+    после вытеснения старых данных.
+    """
+
+    def __init__(self, max_bytes: int, sample_rate: int = 16000, channels: int = 1,
+                 sample_width: int = 2, initial_bytes: int = 64 * 1024):
+        self.max_bytes = max_bytes
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+        self._buf = bytearray(min(initial_bytes, max_bytes))
+        self._head = 0   # индекс самого старого байта в _buf
+        self._size = 0   # сколько байт занято
+        self.dropped = 0  # сколько байт вытеснено с начала потока
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def start_offset(self) -> int:
+        """Абсолютное смещение самого старого байта в буфере"""
+        return self.dropped
+
+    @property
+    def end_offset(self) -> int:
+        """Абсолютное смещение конца записанных данных"""
+        return self.dropped + self._size
+
+    @property
+    def duration(self) -> float:
+        """Длительность содержимого в секундах"""
+        return self._size / (self.sample_rate * self.channels * self.sample_width)
+
+    @property
+    def overflowed(self) -> bool:
+        """Были ли данные вытеснены из-за ограничения длительности"""
+        return self.dropped > 0
+
+    def append(self, data: bytes):
+        """Добавляет PCM в конец буфера"""
+        n = len(data)
+        if n == 0:
+            return
+
+        data = memoryview(data).cast("B")
+
+        if n >= self.max_bytes:
+            # Чанк сам по себе длиннее лимита - оставляем только его хвост
+            self._grow(self.max_bytes)
+            self.dropped += self._size + n - self.max_bytes
+            self._buf[:self.max_bytes] = data[n - self.max_bytes:]
+            self._head = 0
+            self._size = self.max_bytes
+            return
+
+        capacity = len(self._buf)
+        if self._size + n > capacity and capacity < self.max_bytes:
+            self._grow(min(self.max_bytes, max(self._size + n, capacity * 2)))
+            capacity = len(self._buf)
+
+        # Буфер достиг лимита - вытесняем самые старые данные
+        overflow = self._size + n - capacity
+        if overflow > 0:
+            self._head = (self._head + overflow) % capacity
+            self._size -= overflow
+            self.dropped += overflow
+
+        tail = (self._head + self._size) % capacity
+        first = min(n, capacity - tail)
+        self._buf[tail:tail + first] = data[:first]
+        if first < n:
+            self._buf[:n - first] = data[first:]
+        self._size += n
+
+    def read(self, start: int = None, end: int = None) -> bytes:
+        """Возвращает PCM между абсолютными смещениями start и end"""
+        start = self.start_offset if start is None else max(start, self.start_offset)
+        end = self.end_offset if end is None else min(end, self.end_offset)
+        if end <= start:
+            return b""
+
+        capacity = len(self._buf)
+        begin = (self._head + start - self.dropped) % capacity
+        length = end - start
+
+        if begin + length <= capacity:
+            return bytes(self._buf[begin:begin + length])
+
+        # Данные переходят через конец кольца
+        return bytes(self._buf[begin:]) + bytes(self._buf[:length - (capacity - begin)])
+
+    def to_wav(self, start: int = None, end: int = None) -> bytes:
+        """Возвращает PCM как WAV без перекодирования: заголовок + данные"""
+        pcm = self.read(start, end)
+        return wav_header(len(pcm), self.sample_rate, self.channels, self.sample_width) + pcm
+
+    def clear(self):
+        """Очищает буфер, сохраняя выделенную память"""
+        self._head = 0
+        self._size = 0
+        self.dropped = 0
+
+    def _grow(self, new_capacity: int):
+        """Увеличивает емкость, раскладывая данные с начала нового буфера"""
+        if new_capacity <= len(self._buf):
+            return
+
+        new_buf = bytearray(new_capacity)
+        capacity = len(self._buf)
+        first = min(self._size, capacity - self._head)
+        new_buf[:first] = self._buf[self._head:self._head + first]
+        if first < self._size:
+            new_buf[first:self._size] = self._buf[:self._size - first]
+
+        self._buf = new_buf
+        self._head = 0
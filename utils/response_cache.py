@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+
+from utils.conversation_context import Turn
+
+PUNCTUATION = re.compile(r"[^\w\s]+")
+WHITESPACE = re.compile(r"\s+")
+
+class RequestAbandoned(Exception):
+    """Ведущий запрос отменен (реплику перебили) - ответа нет, но и ошибки модели нет"""
+
+class ResponseCache:
+    """Кэш ответов LLM с TTL, ограничением размера и объединением одинаковых запросов.
+
+    Ключ - хэш от (нормализованный ввод, последние history_window сообщений истории,
+    системный промпт); окно истории выбирает вызывающий код. Одинаковые запросы, пришедшие одновременно, ждут один вызов
+    модели (single-flight) вместо того, чтобы отправлять каждый отдельно.
+    Если ведущий запрос отменен, один из ожидающих становится новым ведущим.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, history_window: int = 2):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.history_window = history_window
+
+        # ключ -> (время записи, ответ)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # ключ -> ответ, который сейчас генерируется
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # Статистика
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Приводит реплику к каноническому виду: регистр, пунктуация и пробелы не важны"""
+        text = unicodedata.normalize("NFC", text).casefold()
+        return WHITESPACE.sub(" ", PUNCTUATION.sub(" ", text)).strip()
+
+    def make_key(self, user_input: str, window: Iterable[Turn], system_prompt: str) -> str:
+        """Возвращает ключ кэша для реплики после сообщений window"""
+        raw = "\x00".join(
+            [system_prompt, self.normalize_text(user_input)] +
+            [f"{turn.role}:{self.normalize_text(turn.content)}" for turn in window]
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        """Возвращает ответ из кэша или None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: str):
+        """Сохраняет ответ в кэш"""
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+
+        # Вытесняем самые давно использованные записи
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, key: str) -> Tuple[Optional[str], Optional[asyncio.Future]]:
+        """Ищет ответ: (готовый ответ, None), (None, выполняющийся запрос) или (None, None)"""
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached, None
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return None, pending
+
+        self.misses += 1
+        return None, None
+
+    def begin(self, key: str) -> asyncio.Future:
+        """Регистрирует запрос как выполняющийся; остальные будут ждать его результат"""
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    def finish(self, key: str, response: Optional[str]):
+        """Завершает запрос: сохраняет ответ и будит ожидающих (None - ошибка, не кэшируем)"""
+        if response is not None:
+            self.put(key, response)
+            self._resolve(key, result=response)
+        else:
+            self._resolve(key, error=RuntimeError("Запрос к модели не удался"))
+
+    def abandon(self, key: str):
+        """Снимает отмененный запрос: ожидающие повторят поиск, и один из них станет ведущим"""
+        self._resolve(key, error=RequestAbandoned())
+
+    def _resolve(self, key: str, result: Optional[str] = None, error: Optional[Exception] = None):
+        future = self._inflight.pop(key, None)
+        if future is None or future.done():
+            return
+
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+            # Помечаем исключение полученным, даже если никто не ждал
+            future.exception()
+
+    async def join(self, key: str) -> Optional[str]:
+        """Ответ из кэша или из выполняющегося запроса.
+
+        None - ответа нет, и вызывающий зарегистрирован ведущим: он должен
+        вызвать модель и затем finish (или abandon, если его отменили).
+        Ошибка модели у ведущего пробрасывается ожидающим.
+        """
+        while True:
+            cached, pending = self.lookup(key)
+            if cached is not None:
+                return cached
+            if pending is None:
+                self.begin(key)
+                return None
+            try:
+                return await asyncio.shield(pending)
+            except RequestAbandoned:
+                # Ведущего перебили - пробуем снова
+                continue
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]]) -> str:
+        """Возвращает ответ из кэша, из выполняющегося запроса или вызывает generate"""
+        cached = await self.join(key)
+        if cached is not None:
+            return cached
+
+        try:
+            response = await generate()
+        except asyncio.CancelledError:
+            self.abandon(key)
+            raise
+        except BaseException:
+            self.finish(key, None)
+            raise
+        self.finish(key, response)
+        return response
+
+    def stats(self) -> dict:
+        """Возвращает статистику кэша"""
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0
+        }
@@ -0,0 +1,51 @@
+import re
+from typing import List
+
+# Конец предложения: знаки препинания (с закрывающими кавычками/скобками) и пробел после них
+SENTENCE_END = re.compile(r'(?<=[.!?…])["»)\]]*\s+|\n+')
+
+# Слишком короткие фрагменты ("Да.", "1.") склеиваем со следующими,
+# чтобы не делать отдельный запрос синтеза на пару слов
+MIN_SENTENCE_LENGTH = 20
+
+class SentenceSplitter:
+    """Инкрементальное разбиение потока текста (ответа LLM) на предложения"""
+
+    def __init__(self, min_length: int = MIN_SENTENCE_LENGTH):
+        self.min_length = min_length
+        self._buffer = ""   # незаконченное предложение
+        self._pending = ""  # законченные, но слишком короткие предложения
+
+    def feed(self, text: str) -> List[str]:
+        """Добавляет фрагмент текста и возвращает законченные предложения"""
+        self._buffer += text
+        parts = SENTENCE_END.split(self._buffer)
+
+        # Последняя часть может быть еще не дописана
+        self._buffer = parts.pop()
+        return self._collect(parts)
+
+    def flush(self) -> List[str]:
+        """Возвращает все, что осталось в буфере"""
+        sentences = self._collect([self._buffer])
+        self._buffer = ""
+
+        if self._pending:
+            sentences.append(self._pending)
+            self._pending = ""
+
+        return sentences
+
+    def _collect(self, parts: List[str]) -> List[str]:
+        sentences = []
+        for part in parts:
+            part = part.strip()
+            if not part:
+                continue
+
+            self._pending = f"{self._pending} {part}" if self._pending else part
+            if len(self._pending) >= self.min_length:
+                sentences.append(self._pending)
+                self._pending = ""
+
+        return sentences
@@ -0,0 +1,245 @@
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from utils.stage_executor import StageExecutor
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор процесса сервера: уникален и для воркеров uvicorn на одной машине,
+# и для реплик на разных машинах (в контейнере hostname - id контейнера)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class SessionBackend(ABC):
+    """Хранилище состояния разговоров, общее для воркеров, и реестр соединений.
+
+    Хранит только то, что нужно для продолжения разговора (контекст, калибровку STT),
+    в виде JSON-совместимого словаря. Сами соединения, задачи и декодеры остаются
+    в процессе, который держит WebSocket. Время - time.time(), а не monotonic:
+    отметки сравниваются между разными процессами.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def load(self, session_id: str) -> Optional[dict]:
+        """Возвращает снимок сессии или None"""
+
+    @abstractmethod
+    async def save(self, session_id: str, data: dict, worker_id: str = WORKER_ID) -> bool:
+        """Сохраняет снимок сессии.
+
+        Возвращает False и ничего не пишет, если сессия подключена к другому
+        воркеру: ее разговор продолжается там, а этот снимок устарел.
+        """
+
+    @abstractmethod
+    async def delete(self, session_id: str):
+        """Удаляет снимок сессии"""
+
+    @abstractmethod
+    async def register_connection(self, session_id: str, worker_id: str = WORKER_ID) -> Optional[str]:
+        """Отмечает, что сессия подключена к воркеру; возвращает прежний воркер, если он другой"""
+
+    @abstractmethod
+    async def unregister_connection(self, session_id: str, worker_id: str = WORKER_ID):
+        """Снимает отметку, если сессия все еще числится за этим воркером"""
+
+    @abstractmethod
+    async def connections_by_worker(self) -> Dict[str, int]:
+        """Число подключенных сессий по воркерам"""
+
+    def close(self):
+        """Освобождает ресурсы и снимает отметки соединений этого воркера"""
+
+class MemorySessionBackend(SessionBackend):
+    """Хранилище в памяти процесса: разговор продолжается при переподключении
+    к тому же процессу. Для нескольких воркеров или реплик нужен SQLiteSessionBackend.
+    """
+
+    name = "memory"
+
+    def __init__(self, ttl: float = 1800.0):
+        self.ttl = ttl
+        # session_id -> (время записи, JSON снимка); JSON - чтобы снимок не делил объекты с сессией
+        self._snapshots: Dict[str, Tuple[float, str]] = {}
+        self._connections: Dict[str, str] = {}
+        self._saves = 0
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        entry = self._snapshots.get(session_id)
+        if entry is None:
+            return None
+        saved_at, data = entry
+        if self.ttl > 0 and time.time() - saved_at > self.ttl:
+            del self._snapshots[session_id]
+            return None
+        return json.loads(data)
+
+    async def save(self, session_id: str, data: dict, worker_id: str = WORKER_ID) -> bool:
+        if self._connections.get(session_id, worker_id) != worker_id:
+            return False
+        self._snapshots[session_id] = (time.time(), json.dumps(data, ensure_ascii=False))
+        self._saves += 1
+        if self._saves % 256 == 0:
+            self._purge()
+        return True
+
+    async def delete(self, session_id: str):
+        self._snapshots.pop(session_id, None)
+
+    async def register_connection(self, session_id: str, worker_id: str = WORKER_ID) -> Optional[str]:
+        previous = self._connections.get(session_id)
+        self._connections[session_id] = worker_id
+        return previous if previous != worker_id else None
+
+    async def unregister_connection(self, session_id: str, worker_id: str = WORKER_ID):
+        if self._connections.get(session_id) == worker_id:
+            del self._connections[session_id]
+
+    async def connections_by_worker(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for worker_id in self._connections.values():
+            counts[worker_id] = counts.get(worker_id, 0) + 1
+        return counts
+
+    def _purge(self):
+        if self.ttl <= 0:
+            return
+        deadline = time.time() - self.ttl
+        for session_id in [key for key, (saved_at, _) in self._snapshots.items() if saved_at < deadline]:
+            del self._snapshots[session_id]
+
+class SQLiteSessionBackend(SessionBackend):
+    """Хранилище в файле SQLite в режиме WAL - общее для воркеров uvicorn на одной машине
+    (или для реплик с общим томом).
+
+    WAL позволяет читать параллельно с записью, а записи сессий короткие,
+    поэтому блокировки между процессами почти не ждут. Запросы выполняются
+    в отдельном пуле из одного потока, а не в event loop.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)",
+        "CREATE TABLE IF NOT EXISTS connections ("
+        " session_id TEXT PRIMARY KEY, worker_id TEXT NOT NULL, connected_at REAL NOT NULL)",
+    )
+
+    def __init__(self, path: str, ttl: float = 1800.0, timeout: float = 5.0):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.executor = StageExecutor("session", 1, timeout)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._saves = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Открывается лениво в потоке пула; close() может прийти из другого потока
+        with self._db_lock:
+            if self._db is None:
+                db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                     check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                # В WAL режиме NORMAL не теряет целостность, а fsync идет только на checkpoint
+                db.execute("PRAGMA synchronous=NORMAL")
+                for statement in self.SCHEMA:
+                    db.execute(statement)
+                # Отметки, оставшиеся от прошлого запуска процесса с тем же WORKER_ID
+                db.execute("DELETE FROM connections WHERE worker_id = ?", (WORKER_ID,))
+                self._db = db
+            return self._db
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        return await self.executor.run(self._load, session_id)
+
+    def _load(self, session_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            "SELECT data, updated_at FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        data, updated_at = row
+        if self.ttl > 0 and time.time() - updated_at > self.ttl:
+            self._connection().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            return None
+        return json.loads(data)
+
+    async def save(self, session_id: str, data: dict, worker_id: str = WORKER_ID) -> bool:
+        # Сериализуем в event loop: снимок не должен меняться, пока ждет потока
+        return await self.executor.run(self._save, session_id, json.dumps(data, ensure_ascii=False), worker_id)
+
+    def _save(self, session_id: str, data: str, worker_id: str) -> bool:
+        db = self._connection()
+        # Проверка владельца и запись - один запрос, без гонки с register_connection
+        cursor = db.execute(
+            "INSERT INTO sessions (session_id, data, updated_at) SELECT ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM connections WHERE session_id = ? AND worker_id != ?) "
+            "ON CONFLICT (session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (session_id, data, time.time(), session_id, worker_id)
+        )
+        if cursor.rowcount == 0:
+            return False
+        self._saves += 1
+        if self._saves % 256 == 0 and self.ttl > 0:
+            db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+        return True
+
+    async def delete(self, session_id: str):
+        await self.executor.run(self._execute, "DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def register_connection(self, session_id: str, worker_id: str = WORKER_ID) -> Optional[str]:
+        return await self.executor.run(self._register_connection, session_id, worker_id)
+
+    def _register_connection(self, session_id: str, worker_id: str) -> Optional[str]:
+        db = self._connection()
+        row = db.execute("SELECT worker_id FROM connections WHERE session_id = ?", (session_id,)).fetchone()
+        db.execute(
+            "INSERT OR REPLACE INTO connections (session_id, worker_id, connected_at) VALUES (?, ?, ?)",
+            (session_id, worker_id, time.time())
+        )
+        return row[0] if row is not None and row[0] != worker_id else None
+
+    async def unregister_connection(self, session_id: str, worker_id: str = WORKER_ID):
+        await self.executor.run(
+            self._execute, "DELETE FROM connections WHERE session_id = ? AND worker_id = ?", (session_id, worker_id)
+        )
+
+    async def connections_by_worker(self) -> Dict[str, int]:
+        rows = await self.executor.run(
+            self._fetchall, "SELECT worker_id, COUNT(*) FROM connections GROUP BY worker_id", ()
+        )
+        return {worker_id: count for worker_id, count in rows}
+
+    def _execute(self, sql: str, params: tuple):
+        self._connection().execute(sql, params)
+
+    def _fetchall(self, sql: str, params: tuple) -> list:
+        return self._connection().execute(sql, params).fetchall()
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM connections WHERE worker_id = ?", (WORKER_ID,))
+                finally:
+                    self._db.close()
+                    self._db = None
+        self.executor.shutdown()
+
+def create_session_backend(kind: str, path: str, ttl: float) -> SessionBackend:
+    """Создает хранилище по имени из SESSION_BACKEND"""
+    if kind == "sqlite":
+        logger.info(f"Сессии хранятся в SQLite: {path}")
+        return SQLiteSessionBackend(path, ttl)
+    return MemorySessionBackend(ttl)
@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+import logging
+import re
+import secrets
+import time
+
+from utils.conversation_context import ConversationContext
+from utils.session_backend import SessionBackend, MemorySessionBackend, WORKER_ID
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Сколько при закрытии соединения ждать фоновую свертку истории перед сохранением
+RELEASE_SUMMARY_TIMEOUT = 5.0
+
+# Идентификатор сессии - ключ к истории разговора, поэтому он должен быть неугадываемым:
+# 16 случайных байт (128 бит) в base64url - 22 символа
+SESSION_ID_BYTES = 16
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{22,64}$")
+
+def generate_session_id() -> str:
+    """Новый идентификатор сессии"""
+    return secrets.token_urlsafe(SESSION_ID_BYTES)
+
+def is_valid_session_id(session_id: Optional[str]) -> bool:
+    """Проверяет формат идентификатора сессии, присланного клиентом"""
+    return bool(session_id) and SESSION_ID_PATTERN.match(session_id) is not None
+
+class SessionState:
+    """Состояние одной сессии (одного WebSocket соединения)"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.created_at = time.monotonic()
+        self.last_access = self.created_at
+        # История разговора этой сессии, ограниченная бюджетом токенов
+        self.context = ConversationContext(
+            max_tokens=config.LLM_CONTEXT_TOKENS,
+            summary_tokens=config.LLM_SUMMARY_TOKENS
+        )
+        # Клиент поддерживает бинарные аудио фреймы (см. utils/audio_protocol.py)
+        self.binary_audio = False
+        # Клиент умеет проигрывать ответ по частям (audio_chunk по предложениям)
+        self.stream_audio = False
+        # Клиент показывает ответ по мере генерации (ai_response_delta)
+        self.stream_text = False
+        # Формат аудио ответа, выбранный из audio_formats клиента (wav, mp3, opus)
+        self.output_format = "wav"
+        # Порог энергии распознавателя, откалиброванный на первой реплике сессии
+        self.stt_energy_threshold = None
+        # Потоковая загрузка текущей реплики (audio_start / audio_chunk / audio_end)
+        self.audio_service = None
+        self.decoder = None
+        self.speech_notified = False
+        # Задача обработки текущей реплики (STT -> LLM -> TTS), идет параллельно с приемом
+        self.turn_task = None
+        # Начало текущей реплики (perf_counter) и отправлено ли уже первое аудио ответа
+        self.turn_started = 0.0
+        self.first_audio_sent = False
+        # К сессии подключен WebSocket этого процесса
+        self.connected = False
+        # Сессию продолжили на другом воркере: это соединение нужно закрыть
+        self.superseded = False
+
+    def snapshot(self) -> dict:
+        """Состояние, нужное для продолжения разговора в другом процессе"""
+        return {
+            "context": self.context.to_dict(),
+            "stt_energy_threshold": self.stt_energy_threshold,
+        }
+
+    def restore(self, data: dict):
+        """Восстанавливает состояние из snapshot"""
+        self.context.restore(data.get("context"))
+        self.stt_energy_threshold = data.get("stt_energy_threshold")
+
+    def touch(self):
+        """Обновляет время последнего обращения"""
+        self.last_access = time.monotonic()
+
+class SessionStore:
+    """Хранилище сессий с O(1) доступом и вытеснением по LRU/TTL.
+
+    Сессии с живыми соединениями процесса лежат здесь; разговор сохраняется
+    в backend (SESSION_BACKEND), чтобы его можно было продолжить после
+    переподключения, в том числе к другому воркеру или реплике.
+    Подключенные сессии (connected) не вытесняются ни по LRU, ни по TTL:
+    их держит обработчик соединения, и копия в хранилище должна быть той же.
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 1800.0,
+                 backend: Optional[SessionBackend] = None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl  # секунды простоя до удаления
+        # OrderedDict хранит сессии в порядке последнего обращения (LRU)
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self.backend = backend or MemorySessionBackend(ttl)
+
+    def is_connected(self, session_id: str) -> bool:
+        """К сессии уже подключен WebSocket этого процесса"""
+        session = self._sessions.get(session_id)
+        return session is not None and session.connected
+
+    async def open(self, requested_id: Optional[str] = None) -> SessionState:
+        """Сессия для нового соединения.
+
+        requested_id продолжает разговор, только если эту сессию выдал сервер
+        (она есть в процессе или в backend) и к ней не подключено другое
+        соединение процесса; иначе создается новая сессия. Соединение
+        занимает сессию до первого await, поэтому два одновременных
+        подключения с одним ID не получат общее состояние.
+        """
+        session = None
+        if is_valid_session_id(requested_id):
+            session, fresh = self._claim(requested_id)
+            if session is not None and fresh and not await self._restore(session):
+                # Сервер такую сессию не выдавал (или она истекла) - ID клиента не принимаем
+                session.connected = False
+                self.remove(requested_id)
+                session = None
+
+        if session is None:
+            session, _ = self._claim(generate_session_id())
+
+        try:
+            previous = await self.backend.register_connection(session.session_id, WORKER_ID)
+            if previous is not None:
+                # Прежний воркер узнает об этом при сохранении и закроет свое соединение
+                logger.info(f"Сессия {session.session_id} перешла с воркера {previous} на {WORKER_ID}")
+        except Exception as e:
+            logger.warning(f"Не удалось зарегистрировать соединение {session.session_id}: {e}")
+        return session
+
+    def _claim(self, session_id: str) -> Tuple[Optional[SessionState], bool]:
+        """Занимает сессию для соединения (без await): (сессия, создана ли она сейчас).
+
+        None - сессия уже занята другим соединением этого процесса.
+        """
+        session = self.get(session_id)
+        fresh = session is None
+        if fresh:
+            session = self.get_or_create(session_id)
+        elif session.connected:
+            return None, False
+        session.connected = True
+        session.superseded = False
+        return session, fresh
+
+    async def _restore(self, session: SessionState) -> bool:
+        """Загружает разговор из backend; False - снимка нет"""
+        try:
+            data = await self.backend.load(session.session_id)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить сессию {session.session_id}: {e}")
+            return False
+        if not data:
+            return False
+        session.restore(data)
+        logger.info(f"Разговор сессии {session.session_id} восстановлен ({len(session.context)} сообщений)")
+        return True
+
+    async def save(self, session: SessionState):
+        """Сохраняет разговор в backend; ошибка хранилища не прерывает разговор.
+
+        Если сессию тем временем продолжили на другом воркере, снимок
+        не перезаписывается, а сессия помечается superseded.
+        """
+        try:
+            if not await self.backend.save(session.session_id, session.snapshot(), WORKER_ID):
+                session.superseded = True
+                logger.info(f"Сессия {session.session_id} продолжена на другом воркере - снимок не сохранен")
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить сессию {session.session_id}: {e}")
+
+    async def release(self, session_id: str):
+        """Соединение закрыто: сохраняет разговор и освобождает сессию в процессе"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.connected = False
+            # Свертка забрала вытесненные сообщения из pending - без нее снимок их потеряет
+            await session.context.settle_summary(RELEASE_SUMMARY_TIMEOUT)
+            await self.save(session)
+            if session.connected:
+                # Пока сохраняли, сессию заняло новое соединение процесса - она остается за ним
+                return
+        try:
+            await self.backend.unregister_connection(session_id, WORKER_ID)
+        except Exception as e:
+            logger.warning(f"Не удалось снять регистрацию соединения {session_id}: {e}")
+        if not self.is_connected(session_id):
+            self.remove(session_id)
+
+    def get(self, session_id: str) -> Optional[SessionState]:
+        """Возвращает сессию или None, если она не найдена или устарела"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+
+        if not session.connected and self._is_expired(session, time.monotonic()):
+            self.remove(session_id)
+            return None
+
+        session.touch()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def get_or_create(self, session_id: str) -> SessionState:
+        """Возвращает существующую сессию или создает новую"""
+        session = self.get(session_id)
+        if session is not None:
+            return session
+
+        session = SessionState(session_id)
+        self._sessions[session_id] = session
+        self._evict()
+        return session
+
+    def remove(self, session_id: str):
+        """Удаляет сессию"""
+        if self._sessions.pop(session_id, None) is not None:
+            logger.info(f"Сессия удалена: {session_id}")
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def _is_expired(self, session: SessionState, now: float) -> bool:
+        return self.ttl > 0 and now - session.last_access > self.ttl
+
+    def _evict(self):
+        """Удаляет устаревшие сессии и лишние сессии сверх лимита (кроме подключенных)"""
+        now = time.monotonic()
+
+        # Самые старые сессии всегда в начале, поэтому проверяем только их.
+        # Подключенные переносим в конец: они заняты, вытеснять их нельзя
+        for _ in range(len(self._sessions)):
+            session_id, session = next(iter(self._sessions.items()))
+            if session.connected:
+                self._sessions.move_to_end(session_id)
+                continue
+            if self._is_expired(session, now):
+                self._sessions.popitem(last=False)
+                logger.info(f"Сессия удалена по TTL: {session_id}")
+            elif len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                logger.info(f"Сессия вытеснена по лимиту: {session_id}")
+            else:
+                break
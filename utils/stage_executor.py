@@ -0,0 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+import asyncio
+import logging
+import threading
+import time
+
+from utils.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class StageTimeoutError(TimeoutError):
+    """Этап конвейера не уложился в отведенное время"""
+
+class StageExecutor:
+    """Отдельный ограниченный пул потоков для одного этапа конвейера (decode, stt, tts, llm).
+
+    У каждого этапа свой размер пула и таймаут, поэтому медленный этап
+    не занимает потоки остальных. Считает глубину очереди (задачи, ждущие
+    свободного потока), число выполняемых задач и таймауты.
+    """
+
+    def __init__(self, name: str, max_workers: int, timeout: float):
+        self.name = name
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+        self._lock = threading.Lock()
+        self.queued = 0    # ждут свободного потока
+        self.active = 0    # выполняются
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, func: Callable[..., T], *args) -> "asyncio.Future[T]":
+        """Ставит func(*args) в пул этапа без таймаута (для долгих задач, например потоков)"""
+        with self._lock:
+            self.queued += 1
+
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(self._call, func, args)
+        # Отмена ожидания (например, реплику перебили) снимает задачу с очереди пула,
+        # если она еще не начала выполняться
+        future.add_done_callback(self._on_done)
+        return asyncio.wrap_future(future, loop=loop)
+
+    def _on_done(self, future):
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """Выполняет func(*args) в пуле этапа с таймаутом"""
+        started = time.perf_counter()
+        future = self.submit(func, *args)
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+            STAGE_SECONDS.observe(time.perf_counter() - started, self.name)
+            return result
+        except asyncio.TimeoutError:
+            # Поток продолжит работу до конца, но результат уже никому не нужен
+            self.timeouts += 1
+            logger.warning(f"Этап {self.name} не уложился в {self.timeout} с")
+            raise StageTimeoutError(f"{self.name}: превышен таймаут {self.timeout} с")
+
+    def _call(self, func: Callable[..., T], args: tuple) -> T:
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.busy_seconds += time.perf_counter() - started
+
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        """Возвращает состояние пула этапа"""
+        return {
+            "workers": self.max_workers,
+            "queued": self.queued,
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+    def shutdown(self):
+        """Останавливает пул, не дожидаясь зависших задач"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+import importlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """Длительность фаз запуска: импорт, создание сервисов, прогрев клиентов.
+
+    Отсчет идет от импорта этого модуля (первая строка main). Последовательные
+    фазы отмечаются mark(), фоновые (идут параллельно) - phase().
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: Dict[str, float] = {}
+        self.ready_seconds: Optional[float] = None
+
+    def mark(self, name: str):
+        """Закрывает фазу, начавшуюся в конце предыдущей"""
+        now = time.perf_counter()
+        self.phases[name] = now - self._last
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Замеряет фазу, которая идет параллельно с другими"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def ready(self):
+        """Прогрев завершен - пишем отчет о запуске"""
+        self.ready_seconds = self.elapsed()
+        phases = ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.phases.items())
+        logger.info(f"Запуск: готов через {self.ready_seconds:.2f} с ({phases})")
+
+    def stats(self) -> dict:
+        return {
+            "phases": {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            "ready_seconds": round(self.ready_seconds, 4) if self.ready_seconds is not None else None,
+        }
+
+def preload(modules: Iterable[str]) -> Dict[str, float]:
+    """Импортирует модули заранее (в потоке прогрева), возвращает время каждого.
+
+    Отсутствующие необязательные пакеты пропускаются.
+    """
+    timings = {}
+    for name in modules:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Модуль {name} не загружен: {e}")
+            continue
+        timings[name] = time.perf_counter() - started
+    return timings
+
+startup_timer = StartupTimer()
@@ -0,0 +1,194 @@
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Dict, List, Optional
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # необязательная зависимость: без нее отдаем только gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Версионированные ресурсы (?v=<хэш содержимого>) не меняются - кэшируются на год
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Остальное браузер перепроверяет по ETag - при совпадении получает 304 без тела
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Сжимаем только текст: аудио и картинки уже сжаты
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Порядок предпочтения кодировок, если клиент принимает несколько
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+class StaticAsset:
+    """Файл в памяти: тело, сжатые варианты и заголовки кэширования"""
+
+    __slots__ = ("source", "transform", "mtime", "media_type", "body", "encoded", "version", "etag",
+                 "last_modified")
+
+    def __init__(self, source: str, transform: Optional[Callable[[bytes], bytes]] = None):
+        self.source = source
+        self.transform = transform
+        self.load()
+
+    def load(self):
+        with open(self.source, "rb") as f:
+            body = f.read()
+        if self.transform is not None:
+            body = self.transform(body)
+
+        self.mtime = os.stat(self.source).st_mtime
+        self.media_type = mimetypes.guess_type(self.source)[0] or "application/octet-stream"
+        if self.media_type == "application/javascript":
+            # К text/* Starlette сам добавляет charset
+            self.media_type += "; charset=utf-8"
+        self.body = body
+        self.version = hashlib.sha1(body).hexdigest()[:12]
+        self.etag = f'"{self.version}"'
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.encoded: Dict[str, bytes] = {}
+        if self.media_type.startswith(COMPRESSIBLE_TYPES):
+            self._compress()
+
+    def _compress(self):
+        # Сжимаем один раз с максимальным уровнем: на запросе только выбор варианта
+        variants = {"gzip": gzip.compress(self.body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(self.body, quality=11)
+        for encoding, data in variants.items():
+            # Для маленьких файлов сжатие может оказаться больше исходника
+            if len(data) < len(self.body):
+                self.encoded[encoding] = data
+
+class StaticAssets:
+    """Статика и главная страница, загруженные в память при старте.
+
+    На запрос не читается диск: выбирается заранее сжатый вариант по
+    Accept-Encoding, проверяются If-None-Match / If-Modified-Since.
+    Ссылки на ресурсы в HTML получают ?v=<хэш>, поэтому такие ресурсы
+    кэшируются навсегда, а новая версия приходит по новой ссылке.
+    С reload=True (DEBUG) измененные файлы перечитываются на запросе.
+    """
+
+    def __init__(self, reload: bool = False):
+        self.reload = reload
+        self._assets: Dict[str, StaticAsset] = {}
+        # Страницы, в которые подставляются версии ресурсов
+        self._pages: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._assets)
+
+    def add_directory(self, directory: str, prefix: str):
+        """Загружает все файлы каталога под URL prefix/<путь>"""
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                source = os.path.join(root, name)
+                relative = os.path.relpath(source, directory).replace(os.sep, "/")
+                self._assets[f"{prefix}/{relative}"] = StaticAsset(source)
+
+    def add_page(self, url_path: str, source: str):
+        """Загружает HTML страницу, подставляя версии уже загруженных ресурсов"""
+        self._assets[url_path] = StaticAsset(source, self._versioned)
+        self._pages.append(url_path)
+
+    def total_bytes(self) -> int:
+        return sum(len(a.body) + sum(map(len, a.encoded.values())) for a in self._assets.values())
+
+    def _versioned(self, html: bytes) -> bytes:
+        for url_path, asset in self._assets.items():
+            if url_path not in self._pages:
+                html = html.replace(f'"{url_path}"'.encode(), f'"{url_path}?v={asset.version}"'.encode())
+        return html
+
+    def _refresh(self):
+        """Перечитывает измененные файлы (только в режиме reload)"""
+        changed = False
+        # Сначала ресурсы, затем страницы: в страницы подставляются новые версии
+        ordered = [u for u in self._assets if u not in self._pages] + self._pages
+        for url_path in ordered:
+            asset = self._assets[url_path]
+            try:
+                if os.stat(asset.source).st_mtime != asset.mtime or (changed and url_path in self._pages):
+                    asset.load()
+                    changed = True
+            except OSError as e:
+                logger.warning(f"Не удалось перечитать {asset.source}: {e}")
+
+    def response(self, url_path: str, request: Request) -> Optional[Response]:
+        """Ответ для ресурса или None, если такого нет"""
+        if self.reload:
+            self._refresh()
+        asset = self._assets.get(url_path)
+        if asset is None:
+            return None
+
+        if url_path in self._pages:
+            cache_control = REVALIDATE_CACHE_CONTROL
+        elif request.query_params.get("v") == asset.version and not self.reload:
+            cache_control = IMMUTABLE_CACHE_CONTROL
+        else:
+            cache_control = REVALIDATE_CACHE_CONTROL
+
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""), asset.encoded)
+        # У каждого варианта свой ETag: прокси не должны путать сжатое и несжатое тело
+        etag = asset.etag if encoding is None else f'"{asset.version}-{encoding}"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": cache_control,
+        }
+        if asset.encoded:
+            headers["Vary"] = "Accept-Encoding"
+
+        if not_modified(request, etag, asset.mtime):
+            return Response(status_code=304, headers=headers)
+
+        body = asset.body if encoding is None else asset.encoded[encoding]
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        # На HEAD сервер не отправит тело, но Content-Length останется верным
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+def choose_encoding(accept_encoding: str, available: Dict[str, bytes]) -> Optional[str]:
+    """Лучшая из заранее сжатых кодировок, которую принимает клиент"""
+    if not available or not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Проверка условного запроса: If-None-Match важнее If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Слабое сравнение: W/"x" совпадает с "x"
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
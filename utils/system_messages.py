@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import json
+import logging
+from typing import Dict, Optional
+
+from utils.audio_protocol import pack_frame, MSG_AUDIO_RESPONSE, CODEC_MIME_TYPES, OUTPUT_FORMAT_CODECS
+
+logger = logging.getLogger(__name__)
+
+# Фиксированные тексты системных сообщений
+GREETING = "Соединение установлено. Можете начать говорить!"
+ERROR_NO_AUDIO = "Не удалось записать аудио"
+ERROR_NOT_RECOGNIZED = "Не удалось распознать речь"
+ERROR_PROCESSING = "Ошибка обработки аудио"
+ERROR_BAD_FRAME = "Некорректный формат аудио"
+ERROR_STREAM_UNAVAILABLE = "Потоковая запись недоступна на сервере"
+ERROR_AUDIO_TOO_LONG = "Запись слишком длинная"
+ERROR_SERVER_BUSY = "Сервер перегружен, попробуйте позже"
+LLM_APOLOGY = "Извините, произошла ошибка при обработке вашего запроса."
+
+# Ошибки, которые отправляются клиенту (и озвучиваются)
+ERROR_MESSAGES = (
+    ERROR_NO_AUDIO,
+    ERROR_NOT_RECOGNIZED,
+    ERROR_PROCESSING,
+    ERROR_BAD_FRAME,
+    ERROR_STREAM_UNAVAILABLE,
+    ERROR_AUDIO_TOO_LONG,
+    ERROR_SERVER_BUSY,
+)
+
+# Машиночитаемые коды ошибок, на которые клиент реагирует сам
+ERROR_CODES = {
+    ERROR_STREAM_UNAVAILABLE: "stream_unavailable",
+}
+
+# Фразы, которые синтезируются заранее при старте. Недоступность потока
+# не озвучиваем: клиент молча переотправляет запись целиком
+SPOKEN_MESSAGES = tuple(text for text in ERROR_MESSAGES if text != ERROR_STREAM_UNAVAILABLE) + (LLM_APOLOGY,)
+
+class PrerenderedMessage:
+    """Системное сообщение, подготовленное к отправке без сериализации и синтеза.
+
+    Озвучка хранится для каждого формата ответа (wav, mp3, opus): сессия
+    получает ее в том формате, который выбрала при подключении.
+    """
+
+    __slots__ = ("text", "error_json", "audio", "audio_frames", "audio_jsons")
+
+    def __init__(self, text: str, audio: Optional[Dict[str, bytes]] = None):
+        self.text = text
+        error = {"type": "error", "message": text}
+        if text in ERROR_CODES:
+            error["code"] = ERROR_CODES[text]
+        self.error_json = json.dumps(error)
+        # формат -> аудио, бинарный фрейм и JSON с base64 (собираются один раз)
+        self.audio: Dict[str, bytes] = {}
+        self.audio_frames: Dict[str, bytes] = {}
+        self.audio_jsons: Dict[str, str] = {}
+
+        for output_format, data in (audio or {}).items():
+            if not data:
+                continue
+            codec = OUTPUT_FORMAT_CODECS[output_format]
+            self.audio[output_format] = data
+            self.audio_frames[output_format] = pack_frame(MSG_AUDIO_RESPONSE, codec, data)
+            self.audio_jsons[output_format] = json.dumps({
+                "type": "audio_response",
+                "mime_type": CODEC_MIME_TYPES[codec],
+                "data": base64.b64encode(data).decode()
+            })
+
+class SystemMessages:
+    """Реестр заранее подготовленных системных сообщений"""
+
+    def __init__(self):
+        self._messages: Dict[str, PrerenderedMessage] = {
+            text: PrerenderedMessage(text) for text in ERROR_MESSAGES
+        }
+        self.warmed_up = False
+
+    def get(self, text: str) -> Optional[PrerenderedMessage]:
+        return self._messages.get(text)
+
+    async def warm_up(self, speech_service):
+        """Синтезирует озвучку фиксированных фраз один раз при старте - во всех форматах ответа"""
+        formats = speech_service.supported_output_formats()
+        results = await asyncio.gather(
+            *(speech_service.prerender(SPOKEN_MESSAGES, output_format=output_format) for output_format in formats)
+        )
+        # формат -> {текст: аудио}
+        rendered = dict(zip(formats, results))
+
+        for text in ERROR_MESSAGES:
+            audio = {output_format: by_text[text] for output_format, by_text in rendered.items() if text in by_text}
+            self._messages[text] = PrerenderedMessage(text, audio)
+
+        self.warmed_up = True
+        counts = ", ".join(f"{output_format} {len(by_text)}" for output_format, by_text in rendered.items())
+        logger.info(f"Системные сообщения подготовлены: из {len(SPOKEN_MESSAGES)} фраз озвучено {counts}")
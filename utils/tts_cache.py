@@ -0,0 +1,220 @@
+from collections import OrderedDict
+from typing import Callable, Optional, TypeVar
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+
+from utils.stage_executor import StageExecutor
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = re.compile(r"\s+")
+
+T = TypeVar("T")
+
+class TTSCache:
+    """Кэш синтезированного аудио с адресацией по содержимому.
+
+    Ключ - хэш от (нормализованный текст, язык, голос, формат). Первый уровень -
+    LRU в памяти, ограниченный суммарным размером в байтах. Второй (необязательный) -
+    каталог на диске, файлы которого переживают перезапуск.
+
+    Диск трогается только в пуле executor (своем, а не в пуле синтеза: попадание
+    не должно ждать медленный gTTS) и никогда в event loop. Содержимое каталога
+    сканируется один раз при старте; дальше размер и порядок LRU ведутся в памяти.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 512 * 1024 * 1024, executor: Optional[StageExecutor] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.executor = executor
+
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+
+        # Индекс диска: ключ -> размер файла, от давно использованных к недавним.
+        # Меняется из потоков пула, поэтому под блокировкой
+        self._disk_index: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._disk_lock = threading.Lock()
+
+        # Статистика
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Приводит текст к каноническому виду для ключа кэша"""
+        return WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+    @classmethod
+    def make_key(cls, text: str, lang: str, voice: str, output_format: str) -> str:
+        """Возвращает ключ кэша для параметров синтеза"""
+        raw = "\x00".join((cls.normalize_text(text), lang, voice, output_format))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def size(self) -> int:
+        """Занято байт в памяти"""
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Возвращает аудио из кэша или None"""
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+        # По индексу заранее известно, есть ли файл: на промах диск не читается
+        if key in self._disk_index:
+            data = await self._run(self._read_disk, key)
+            if data:
+                # Поднимаем в память, чтобы следующие обращения не трогали диск
+                self._put_memory(key, data)
+                self.disk_hits += 1
+                return data
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        """Сохраняет аудио в кэш; запись на диск идет в фоне"""
+        if not data:
+            return
+
+        self._put_memory(key, data)
+        if self.disk_dir and key not in self._disk_index:
+            if self.executor is None:
+                self._write_disk(key, data)
+            else:
+                # Ответ не ждет записи; ошибки ввода-вывода логируются в _write_disk
+                self.executor.submit(self._write_disk, key, data)
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        if self.executor is None:
+            return func(*args)
+        return await self.executor.run(func, *args)
+
+    def stats(self) -> dict:
+        """Возвращает статистику кэша"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "disk_bytes": self._disk_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+
+        self._entries[key] = data
+        self._size += len(data)
+
+        # Вытесняем самые давно использованные записи
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.audio")
+
+    def _load_disk_index(self):
+        """Строит индекс по файлам каталога (один раз при старте), старые - первыми"""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith(".audio"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(".audio")], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk_index[key] = size
+            self._disk_size += size
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._disk_path(key)
+        try:
+            # Файлы - короткие фразы и целиком поднимаются в память, поэтому обычное чтение
+            with open(path, "rb") as f:
+                data = f.read()
+            # mtime - порядок LRU после перезапуска
+            os.utime(path)
+        except FileNotFoundError:
+            # Файл удалили снаружи
+            self._forget_disk(key)
+            return None
+        except OSError as e:
+            logger.error(f"Ошибка чтения кэша TTS с диска: {e}")
+            return None
+
+        with self._disk_lock:
+            if key in self._disk_index:
+                self._disk_index.move_to_end(key)
+        return data
+
+    def _write_disk(self, key: str, data: bytes):
+        with self._disk_lock:
+            if key in self._disk_index:
+                return
+
+        path = self._disk_path(key)
+        try:
+            # Пишем во временный файл и атомарно переименовываем
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Ошибка записи кэша TTS на диск: {e}")
+            return
+
+        with self._disk_lock:
+            if key in self._disk_index:
+                # Тот же ключ успел записать другой поток
+                return
+            self._disk_index[key] = len(data)
+            self._disk_size += len(data)
+
+        self._evict_disk()
+
+    def _forget_disk(self, key: str):
+        with self._disk_lock:
+            size = self._disk_index.pop(key, None)
+            if size is not None:
+                self._disk_size -= size
+
+    def _evict_disk(self):
+        """Удаляет давно использованные файлы, пока кэш на диске не уложится в лимит"""
+        while True:
+            with self._disk_lock:
+                if self._disk_size <= self.disk_max_bytes or not self._disk_index:
+                    return
+                key, size = self._disk_index.popitem(last=False)
+                self._disk_size -= size
+            try:
+                os.unlink(self._disk_path(key))
+            except OSError:
+                pass